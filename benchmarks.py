@@ -0,0 +1,331 @@
+__author__ = 'rvuine'
+
+# Benchmarks for the native modules and the schema tools, on synthetic nodenets of configurable size.
+#
+# A synthetic nodenet is shaped like PalmBoulderMapleBoulder: the importer and protocol wiring of TestSceneImport,
+# a number of scenes with fovea features built from FOVEA_FEATURE_TEMPLATE, and a protocol chain whose elements
+# record each scene as imported and the next one as recognized. The world is scripted: a StructuredObjects world
+# showing a sequence of random shapes made of the given number of colors and types, switching every few steps.
+#
+# For every configuration the benchmarks measure
+#   steps_per_second        full nodenet steps (with the world), per engine: dict and array by default, sharded
+#                           (see nodenetshards) with --engines, i.e. to see from what size sharding pays off
+#   scene_importer          the time spent in the scene importer during those steps
+#   protocol_builder        forced protocol builder runs
+#   structure_abstraction_builder   repeated runs over the protocol
+#   copy_schema             copies of every scene the nodenet was built with
+#   delete_schema           deletion of those copies
+#   peak_memory_per_node    the peak memory allocated during the build, the steps and each of the benchmarks above,
+#                           per node (via tracemalloc). Tracing slows python down, so it is measured in a second,
+#                           untimed run of the same phases
+# and write the results as json, sorted, so result files of different commits can be diffed or compared:
+#   python benchmarks.py --scenes 4 16 64 --output before.json
+#   python benchmarks.py --scenes 4 16 64 --output after.json
+#   python benchmarks.py --compare before.json after.json
+
+import argparse
+import json
+import os
+import random
+import time
+import tracemalloc
+
+import nodefunctions
+from nettools import *
+from schematools import *
+from nodenetengine import DictNodenet, ArrayNodenet, np
+from nodenetshards import ShardedNodenet
+from structuredobjects import StructuredObjectsWorld, FOVEA_RANGE
+
+BASE_NODENET = os.path.join(os.path.dirname(os.path.abspath(__file__)), "nodenets",
+                            "851def94d5f011e382990023dfa615aa.json")
+
+DEFAULT_CONFIG = {
+    "scenes": 8,
+    "features_per_scene": 10,
+    "protocol_length": 16,
+    "sensors": 8,
+    "steps": 200,
+    "scene_steps": 40,
+    "protocol_builder_calls": 20,
+    "abstraction_builder_calls": 5,
+    "seed": 0,
+}
+
+TYPES = ["com", "ver", "cir", "hor", "tri", "sqr", "dot", "crs"]
+
+
+def make_palette(sensors):
+    """
+    Returns the shape colors and types of a scripted world with the given number of fovea sensors
+    """
+    types = TYPES[:max(1, min(len(TYPES), sensors // 2))]
+    colors = ["color%i" % i for i in range(max(1, sensors - len(types)))]
+    return colors, types
+
+
+def make_world_data(sensors, scene_count, seed):
+    """
+    Returns a world file's data for a StructuredObjects world with random shapes made of the given number of
+    colors and types, and the shape grids of scene_count scenes to show in turn
+    """
+    colors, types = make_palette(sensors)
+    properties = colors + types
+    datasources = ["fovea-" + key for key in properties] + ["presence-" + key for key in properties] + \
+                  ["fov-x", "fov-y", "major-newscene"]
+    shape_random = random.Random(seed)
+    size = 2 * FOVEA_RANGE + 1
+    scenes = []
+    for i in range(scene_count):
+        grid = [[None] * size for row in range(size)]
+        for y in range(size):
+            for x in range(size):
+                if shape_random.random() < 0.5:
+                    grid[y][x] = {"color": shape_random.choice(colors), "type": shape_random.choice(types)}
+        scenes.append({"shape_grid": grid, "fovea_x": 0, "fovea_y": 0, "type": "structured_object"})
+    world_data = {
+        "worldadapters": {"StructuredObjects": {"datasources": datasources,
+                                                "datatargets": ["fov_x", "fov_y", "fov_reset"]}},
+        "agents": {"benchmark": {"scene": scenes[0]}}
+    }
+    return world_data, scenes
+
+
+def build_synthetic_nodenet(config, engine_class):
+    """
+    Builds a synthetic nodenet for the given configuration
+    :return: the nodenet, its world and the scripted scenes for the world
+    """
+    with open(BASE_NODENET) as file:
+        nodenet_data = json.load(file)
+    world_data, scenes = make_world_data(config["sensors"], max(1, config["scenes"]), config["seed"])
+    world = StructuredObjectsWorld(world_data)
+    counter = iter(range(1 << 62))
+    nodenet = engine_class(nodenet_data, world, uid_generator=lambda: "%032x" % next(counter))
+    netapi = nodenet.netapi
+    seed_random(netapi, config["seed"])
+    build_random = random.Random(config["seed"])
+    nodespace = "Root"
+
+    import_sensors(nodespace, netapi)
+    import_actors(nodespace, netapi)
+    fovea_sensors = [node for node in netapi.get_nodes(nodespace) if node.type == "Sensor" and
+                     node.name.startswith("fovea")]
+    positions = [(x, y) for y in FOVEA_POSITIONS for x in FOVEA_POSITIONS]
+
+    scene_nodes = []
+    for i in range(config["scenes"]):
+        scene = create_node("Pipe", nodespace, "Scene-%i" % i, netapi)
+        for j in range(config["features_per_scene"]):
+            x, y = positions[j % len(positions)]
+            sensors = build_random.sample(fovea_sensors, min(2, len(fovea_sensors)))
+            feature = instantiate_schema_template(FOVEA_FEATURE_TEMPLATE, nodespace, netapi, parent=scene,
+                                                  sensors=sensors, name="F(%i/%i)" % (x, y), x=x, y=y)
+            index_fovea_feature(scene, feature["feature"], netapi)
+        scene_nodes.append(scene)
+
+    if config["protocol_length"] > 0 and len(scene_nodes) > 0:
+        chain = create_node("Pipe", nodespace, "Chain", netapi)
+        previous = None
+        for i in range(config["protocol_length"]):
+            protocol_element = create_node("Pipe", nodespace, "proto-%i" % i, netapi)
+            set_state(protocol_element, "index", str(i), netapi)
+            link_with_reciprocal(chain, protocol_element, "subsur", netapi)
+            if previous is not None:
+                link_with_reciprocal(previous, protocol_element, "porret", netapi)
+            protocolled_scene = create_node("Pipe", nodespace, "ProtScene-%i" % i, netapi)
+            link_with_reciprocal(protocol_element, protocolled_scene, "subsur", netapi)
+            link_with_reciprocal(protocolled_scene, scene_nodes[i % len(scene_nodes)], "subsur", netapi)
+            occurrence = create_node("Pipe", nodespace, "Occurrence", netapi)
+            link_with_reciprocal(protocolled_scene, occurrence, "subsur", netapi)
+            link_with_reciprocal(occurrence, scene_nodes[(i + 1) % len(scene_nodes)], "catexp", netapi)
+            previous = protocol_element
+    return nodenet, world, scenes
+
+
+def _time_calls(function, calls):
+    start = time.perf_counter()
+    for i in range(calls):
+        function()
+    seconds = time.perf_counter() - start
+    return {"calls": calls, "seconds": seconds, "calls_per_second": calls / seconds if seconds > 0 else None}
+
+
+def _find_node(nodenet, type):
+    for node in nodenet.nodes.values():
+        if node.type == type:
+            return node
+    return None
+
+
+def run_steps(nodenet, world, scenes, steps, scene_steps):
+    """
+    Steps a nodenet with its scripted world, and measures the time spent in the scene importer
+    :return: the steps per second, and the calls and seconds of the scene importer
+    """
+    scene_importer = nodefunctions.scene_importer
+    importer_time = [0, 0.0]
+
+    def timed_scene_importer(netapi, node=None, **params):
+        start = time.perf_counter()
+        scene_importer(netapi, node=node, **params)
+        importer_time[0] += 1
+        importer_time[1] += time.perf_counter() - start
+
+    nodefunctions.scene_importer = timed_scene_importer
+    try:
+        start = time.perf_counter()
+        for step in range(steps):
+            if step > 0 and step % scene_steps == 0:
+                world.show_scene(scenes[(step // scene_steps) % len(scenes)])
+            nodenet.step()
+            world.update()
+        seconds = time.perf_counter() - start
+    finally:
+        nodefunctions.scene_importer = scene_importer
+    return steps / seconds, {"calls": importer_time[0], "seconds": importer_time[1],
+                             "calls_per_second": importer_time[0] / importer_time[1] if importer_time[1] > 0 else None}
+
+
+def _module_benchmarks(nodenet, scene_nodes, config):
+    # yields the benchmarks of the native modules and schema tools as (name, function, calls), one after the other,
+    # so that every benchmark is set up for the nodenet the previous ones have left
+    netapi = nodenet.netapi
+    protocol_builder = _find_node(nodenet, "ProtocolBuilder")
+
+    def forced_protocol_builder():
+        nodenet.slot_activations["trigger"][protocol_builder.index] = 1
+        nodefunctions.protocol_builder(netapi, node=protocol_builder)
+
+    yield "protocol_builder", forced_protocol_builder, config["protocol_builder_calls"]
+
+    abstraction_builder = _find_node(nodenet, "StructureAbstractionBuilder")
+    if abstraction_builder is None:
+        abstraction_builder = nodenet.create_node("StructureAbstractionBuilder", "Root", "AbstractionBuilder")
+    yield "structure_abstraction_builder", lambda: nodefunctions.structure_abstraction_builder(
+        netapi, node=abstraction_builder), config["abstraction_builder_calls"]
+
+    # the scenes the nodenet was built with, not those the scene importer has created since
+    scene_nodes = [node for node in scene_nodes if node.uid in nodenet.nodes]
+    copies = []
+    yield "copy_schema", lambda: copies.append(copy_schema(scene_nodes[len(copies)], netapi)), len(scene_nodes)
+    yield "delete_schema", lambda: delete_schema(copies.pop(), netapi), len(copies)
+
+
+def measure_peak_memory(config, engine_class):
+    """
+    Runs the build, the steps and the module benchmarks of a configuration once, untimed, under tracemalloc
+    :return: a dict of the phases to the peak memory allocated during them, per node of the nodenet after them
+    """
+    peaks = {}
+    tracemalloc.start()
+    try:
+        nodenet, world, scenes = build_synthetic_nodenet(config, engine_class)
+        peaks["build"] = tracemalloc.get_traced_memory()[1] / max(1, len(nodenet.nodes))
+        scene_nodes = find_nodes("Root", "Scene-", nodenet.netapi)
+        tracemalloc.reset_peak()
+        run_steps(nodenet, world, scenes, config["steps"], config["scene_steps"])
+        peaks["steps"] = tracemalloc.get_traced_memory()[1] / max(1, len(nodenet.nodes))
+        for name, function, calls in _module_benchmarks(nodenet, scene_nodes, config):
+            tracemalloc.reset_peak()
+            for i in range(calls):
+                function()
+            peaks[name] = tracemalloc.get_traced_memory()[1] / max(1, len(nodenet.nodes))
+    finally:
+        tracemalloc.stop()
+    if hasattr(nodenet, "close"):
+        nodenet.close()
+    return peaks
+
+
+def run_benchmark(config, engines=None):
+    """
+    Runs all benchmarks for one configuration (see DEFAULT_CONFIG)
+    :param engines: the names of the engines to measure steps per second for, defaults to all available ones.
+    The module benchmarks and the peak memory are measured with the last one.
+    :return: the results, as a json serializable dict
+    """
+    config = dict(DEFAULT_CONFIG, **config)
+    if engines is None:
+        engines = ["dict", "array"] if np is not None else ["dict"]
+    engine_classes = {"dict": DictNodenet, "array": ArrayNodenet, "sharded": ShardedNodenet}
+    results = {"config": config, "steps_per_second": {}, "modules": {}}
+
+    for engine in engines:
+        start = time.perf_counter()
+        nodenet, world, scenes = build_synthetic_nodenet(config, engine_classes[engine])
+        if engine == engines[-1]:
+            results["build_seconds"] = time.perf_counter() - start
+            results["nodes"] = len(nodenet.nodes)
+            results["links"] = sum(len(group) for group in nodenet.link_groups.values())
+        scene_nodes = find_nodes("Root", "Scene-", nodenet.netapi)
+        steps_per_second, importer_time = run_steps(nodenet, world, scenes, config["steps"], config["scene_steps"])
+        results["steps_per_second"][engine] = steps_per_second
+        if engine == engines[-1]:
+            results["modules"]["scene_importer"] = importer_time
+            for name, function, calls in _module_benchmarks(nodenet, scene_nodes, config):
+                results["modules"][name] = _time_calls(function, calls)
+        if hasattr(nodenet, "close"):
+            nodenet.close()
+
+    results["peak_memory_per_node"] = measure_peak_memory(config, engine_classes[engines[-1]])
+    return results
+
+
+def compare_results(old_results, new_results):
+    """
+    Returns lines comparing the rates of two benchmark result lists, per configuration and benchmark
+    """
+    lines = []
+    for old, new in zip(old_results, new_results):
+        label = "scenes=%(scenes)i features=%(features_per_scene)i protocol=%(protocol_length)i sensors=%(sensors)i" % \
+            new["config"]
+        rates = [("steps/s " + engine, old["steps_per_second"].get(engine), value)
+                 for engine, value in sorted(new["steps_per_second"].items())]
+        rates += [(module + " calls/s", old["modules"].get(module, {}).get("calls_per_second"),
+                   value["calls_per_second"]) for module, value in sorted(new["modules"].items())]
+        old_peaks = old["peak_memory_per_node"]
+        if not isinstance(old_peaks, dict):
+            old_peaks = {"build": old_peaks}     # results from before the other phases were measured
+        rates += [("nodes/MB " + phase, 1e6 / old_peaks[phase] if phase in old_peaks else None, 1e6 / value)
+                  for phase, value in sorted(new["peak_memory_per_node"].items())]
+        for name, old_rate, new_rate in rates:
+            if old_rate and new_rate:
+                lines.append("%s  %-40s %12.2f -> %12.2f  (x%.2f)" % (label, name, old_rate, new_rate,
+                                                                      new_rate / old_rate))
+    return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the native modules on synthetic nodenets.")
+    parser.add_argument("--scenes", type=int, nargs="+", default=[DEFAULT_CONFIG["scenes"]],
+                        help="the scene counts to benchmark, one configuration each")
+    parser.add_argument("--features", type=int, default=DEFAULT_CONFIG["features_per_scene"])
+    parser.add_argument("--protocol-length", type=int, default=DEFAULT_CONFIG["protocol_length"])
+    parser.add_argument("--sensors", type=int, default=DEFAULT_CONFIG["sensors"])
+    parser.add_argument("--steps", type=int, default=DEFAULT_CONFIG["steps"])
+    parser.add_argument("--seed", type=int, default=DEFAULT_CONFIG["seed"])
+    parser.add_argument("--engines", nargs="+", choices=["dict", "array", "sharded"],
+                        help="the engines to measure steps per second for, by default dict and array")
+    parser.add_argument("--output", help="a json file to write the results to")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compares two result files")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as old_file, open(args.compare[1]) as new_file:
+            for line in compare_results(json.load(old_file), json.load(new_file)):
+                print(line)
+    else:
+        all_results = []
+        for scenes in args.scenes:
+            config = {"scenes": scenes, "features_per_scene": args.features, "protocol_length": args.protocol_length,
+                      "sensors": args.sensors, "steps": args.steps, "seed": args.seed}
+            results = run_benchmark(config, args.engines)
+            print("%i scenes, %i nodes, %i links: %s steps/s, %.0f bytes/node at peak" % (
+                scenes, results["nodes"], results["links"],
+                ", ".join("%s %.1f" % item for item in sorted(results["steps_per_second"].items())),
+                max(results["peak_memory_per_node"].values())))
+            all_results.append(results)
+        if args.output:
+            with open(args.output, "w") as file:
+                json.dump(all_results, file, sort_keys=True, indent=4)
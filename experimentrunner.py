@@ -0,0 +1,259 @@
+__author__ = 'rvuine'
+
+# Runs nodenets against the StructuredObjects world headless, many runs at a time.
+#
+# A batch is a nodenet file, a world file, a number of steps and a list of runs, each run being a seed and
+# optionally a dict of parameter overrides ({node name: {parameter: value}}) applied to the nodenet before
+# it starts. The runs are spread over a process pool and return their metrics as dicts:
+#   nodes_created           the number of nodes created during the run
+#   node_count              the number of nodes in the nodenet at the end of the run
+#   features_imported       the number of fovea features in the nodenet at the end of the run that were not in it before
+#   steps_to_stable_scene   the number of steps until the last feature was imported before a pause of
+#                           STABLE_SCENE_STEPS steps without imports, or None if no such pause followed an import
+#   wall_time               the seconds the run took
+#
+# Runs are reproducible: a run's seed seeds the random generator of its native modules (see nettools.seed_random)
+# and the uids of the nodes it creates, and nothing else is random.
+#
+# By default, the nodenet and the world step in lock-step: the world is updated with the datatargets of a nodenet
+# step before the next nodenet step reads the datasources. Pipelined runs are meant for worlds whose update waits
+# on I/O, i.e. a world in another process or on the network: the world is updated while the nodenet computes its
+# next step in a thread, so a step takes as long as the slower of the two instead of both. Only waits that release
+# the interpreter lock overlap with the nodenet. The bundled StructuredObjects world is pure python and does not wait,
+# so pipelining it gains nothing; world_latency (--world-latency) makes its updates wait, like an I/O-bound world.
+# The nodenet then reads the datasources of the world update before the last one: its world adapter has a sensor_lag
+# of 1 (see WorldAdapter.sensor_lag for the lag contract).
+# Pipelined runs are reproducible as well, but their metrics differ from those of lock-step runs.
+#
+# As a script:
+#   python experimentrunner.py nodenets/<uid>.json worlds/<uid>.json --steps 500 --seeds 0 1 2 3 --output results.json
+#   [--pipelined] [--world-latency 0.001]
+
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import multiprocessing
+import random
+import time
+import uuid
+
+from nettools import seed_random
+from nodenetengine import DictNodenet, ArrayNodenet, WorldAdapter, np
+from structuredobjects import StructuredObjectsWorld
+
+STABLE_SCENE_STEPS = 50
+
+ENGINES = {
+    "dict": DictNodenet,
+    "array": ArrayNodenet,
+}
+
+
+def apply_overrides(nodenet_data, overrides):
+    """
+    Returns a copy of the nodenet data with the given parameters set
+    :param overrides: a dict of node names to dicts of parameter names and values
+    """
+    nodenet_data = dict(nodenet_data)
+    nodenet_data["nodes"] = dict(nodenet_data["nodes"])
+    for uid, node_data in nodenet_data["nodes"].items():
+        if node_data["name"] in overrides:
+            node_data = dict(node_data)
+            node_data["parameters"] = dict(node_data.get("parameters") or {})
+            node_data["parameters"].update(overrides[node_data["name"]])
+            nodenet_data["nodes"][uid] = node_data
+    return nodenet_data
+
+
+class PipelinedWorldAdapter(WorldAdapter):
+    """
+    The world adapter of a nodenet whose world is updated while the nodenet steps, see step_pipelined.
+    The nodenet reads the datasources of the world's previous update from it, and writes its datatargets to it,
+    so neither side sees the other's values change during a step.
+    """
+
+    sensor_lag = 1
+
+    def __init__(self, world):
+        WorldAdapter.__init__(self, world.datasources, world.datatargets)
+        self.world = world
+        self.datasources.update(world.datasources)
+
+    def exchange(self):
+        # hands the datatargets of the last nodenet step to the world, and the datasources of the last world
+        # update to the nodenet
+        self.world.datatargets.update(self.datatargets)
+        self.datasources.update(self.world.datasources)
+
+
+class LatentStructuredObjectsWorld(StructuredObjectsWorld):
+    """
+    A StructuredObjects world whose updates wait for a number of seconds first, like the update of a world
+    in another process or on the network waits for it, to measure pipelined runs with
+    """
+
+    def __init__(self, world_data, agent_uid=None, latency=0.0):
+        StructuredObjectsWorld.__init__(self, world_data, agent_uid)
+        self.latency = latency
+
+    def update(self):
+        time.sleep(self.latency)
+        StructuredObjectsWorld.update(self)
+
+
+async def _step_pipelined(nodenet, steps, callback, executor):
+    loop = asyncio.get_running_loop()
+    world = nodenet.world_adapter.world
+    for step in range(steps):
+        # the nodenet computes this step in the executor while the world applies the datatargets of the previous one.
+        # The world is updated here, so whenever it waits (i.e. for a world out of process) and releases the
+        # interpreter lock, the nodenet gets to run
+        nodenet_step = loop.run_in_executor(executor, nodenet.step)
+        world.update()
+        await nodenet_step
+        nodenet.world_adapter.exchange()
+        if callback is not None:
+            callback(step)
+
+
+def step_pipelined(nodenet, steps, callback=None):
+    """
+    Steps a nodenet created with a PipelinedWorldAdapter, updating its world during every nodenet step
+    :param callback: a function called with the number of every step after it
+    """
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        asyncio.run(_step_pipelined(nodenet, steps, callback, executor))
+
+
+def _feature_uids(nodenet):
+    # fovea features are the nodes the scene importer has given a fovea position
+    return set(node.uid for node in nodenet.nodes.values()
+               if node.get_state("x") is not None and node.get_state("y") is not None)
+
+
+def run_experiment(nodenet_data, world_data, steps, seed=0, overrides=None, engine="array", pipelined=False,
+                   world_latency=0.0):
+    """
+    Runs a nodenet against the StructuredObjects world for the given number of steps
+    :param nodenet_data: the nodenet, as loaded from its json file
+    :param world_data: the world, as loaded from its json file
+    :param seed: the seed for the random generator of the run
+    :param overrides: parameter overrides, see apply_overrides
+    :param engine: "array" or "dict", see nodenetengine
+    :param pipelined: update the world while the nodenet steps instead of after every step
+    :param world_latency: the seconds every world update waits, see LatentStructuredObjectsWorld
+    :return: the metrics of the run
+    """
+    start = time.time()
+    if overrides:
+        nodenet_data = apply_overrides(nodenet_data, overrides)
+    uid_random = random.Random(seed)
+    created = []
+
+    def create_uid():
+        created.append(None)
+        return str(uuid.UUID(int=uid_random.getrandbits(128), version=4))
+
+    agent_uid = nodenet_data["uid"] if nodenet_data["uid"] in world_data.get("agents", {}) else None
+    if world_latency:
+        world = LatentStructuredObjectsWorld(world_data, agent_uid, world_latency)
+    else:
+        world = StructuredObjectsWorld(world_data, agent_uid)
+    world_adapter = PipelinedWorldAdapter(world) if pipelined else world
+    nodenet = ENGINES[engine](nodenet_data, world_adapter, uid_generator=create_uid)
+    seed_random(nodenet.netapi, seed)
+
+    initial_features = _feature_uids(nodenet)
+    counts = {"features": 0, "nodes": len(nodenet.nodes), "last_import_step": 0, "steps_to_stable_scene": None}
+
+    def measure(step):
+        # features can only have been imported if nodes were created or deleted
+        if len(nodenet.nodes) != counts["nodes"]:
+            counts["nodes"] = len(nodenet.nodes)
+            count = len(_feature_uids(nodenet) - initial_features)
+            if count != counts["features"]:
+                counts["features"] = count
+                counts["last_import_step"] = step + 1
+        if counts["steps_to_stable_scene"] is None and counts["features"] > 0 and \
+                step + 1 - counts["last_import_step"] >= STABLE_SCENE_STEPS:
+            counts["steps_to_stable_scene"] = counts["last_import_step"]
+
+    if pipelined:
+        step_pipelined(nodenet, steps, measure)
+    else:
+        for step in range(steps):
+            nodenet.step()
+            world.update()
+            measure(step)
+
+    return {
+        "seed": seed,
+        "overrides": overrides,
+        "steps": steps,
+        "pipelined": pipelined,
+        "world_latency": world_latency,
+        "nodes_created": len(created),
+        "node_count": len(nodenet.nodes),
+        "features_imported": len(_feature_uids(nodenet) - initial_features),
+        "steps_to_stable_scene": counts["steps_to_stable_scene"],
+        "wall_time": time.time() - start
+    }
+
+
+def _run_job(job):
+    nodenet_path, world_path, steps, seed, overrides, engine, pipelined, world_latency = job
+    with open(nodenet_path) as file:
+        nodenet_data = json.load(file)
+    with open(world_path) as file:
+        world_data = json.load(file)
+    return run_experiment(nodenet_data, world_data, steps, seed, overrides, engine, pipelined, world_latency)
+
+
+def run_experiments(nodenet_path, world_path, steps, seeds=(0, ), overrides=(None, ), processes=None, engine=None,
+                    pipelined=False, world_latency=0.0):
+    """
+    Runs every combination of the given seeds and overrides in a process pool
+    :param processes: the number of worker processes, defaults to the number of cores
+    :param engine: "array" or "dict", defaults to "array" if numpy is available
+    :param pipelined: update the world while the nodenet steps, see run_experiment
+    :param world_latency: the seconds every world update waits, see run_experiment
+    :return: the metrics of all runs, in the order of the combinations
+    """
+    if engine is None:
+        engine = "array" if np is not None else "dict"
+    jobs = [(nodenet_path, world_path, steps, seed, override, engine, pipelined, world_latency)
+            for override in overrides for seed in seeds]
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(_run_job, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs a nodenet against a StructuredObjects world, headless.")
+    parser.add_argument("nodenet", help="the nodenet json file")
+    parser.add_argument("world", help="the world json file")
+    parser.add_argument("--steps", type=int, default=500)
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0])
+    parser.add_argument("--overrides", type=json.loads, default=[None],
+                        help='a json list of parameter overrides, i.e. [{"Importer": {"x": 1}}, null]')
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--engine", choices=sorted(ENGINES), default=None)
+    parser.add_argument("--pipelined", action="store_true",
+                        help="update the world while the nodenet steps, with the datasources one step later")
+    parser.add_argument("--world-latency", type=float, default=0.0,
+                        help="the seconds every world update waits, to simulate a world out of process")
+    parser.add_argument("--output", help="a json file to write the metrics of all runs to")
+    args = parser.parse_args()
+
+    results = run_experiments(args.nodenet, args.world, args.steps, args.seeds, args.overrides, args.processes,
+                              args.engine, args.pipelined, args.world_latency)
+    for result in results:
+        print("seed %(seed)i: %(nodes_created)i nodes created, %(features_imported)i features imported, "
+              "stable after %(steps_to_stable_scene)s steps, %(wall_time).2fs" % result)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, sort_keys=True, indent=4)
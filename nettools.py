@@ -0,0 +1,851 @@
+__author__ = 'rvuine'
+
+import bisect
+import random
+import weakref
+
+# per netapi instance: a dict of nodespace uids to their name registries
+_name_registries = weakref.WeakKeyDictionary()
+
+# per netapi instance: a dict of nodespace uids to their interface registries
+_interface_registries = weakref.WeakKeyDictionary()
+
+# the parameter that ties a sensor or actor to the world adapter
+INTERFACE_PARAMETERS = {"Sensor": "datasource", "Actor": "datatarget"}
+
+# per netapi instance: a dict of (nodespace uid, name prefix, threshold) to activation watches
+_activation_watches = weakref.WeakKeyDictionary()
+
+# per netapi instance: the random generator the native modules running on it draw from
+_random_generators = weakref.WeakKeyDictionary()
+
+# callbacks to be notified of nodes whose links are about to change or have changed
+_structure_listeners = []
+
+# callbacks to be notified of nodes whose state or parameters have changed
+_state_listeners = []
+
+# per netapi instance: the open forks, innermost last, see NodenetFork
+_forks = weakref.WeakKeyDictionary()
+
+# per netapi instance: a dict of the uids of the nodes deleted in forks that have not been committed yet to the nodes
+_deleted_nodes = weakref.WeakKeyDictionary()
+
+# the gates linked by netapi.link_with_reciprocal for a link type
+_RECIPROCAL_GATES = {"subsur": ("sub", "sur"), "porret": ("por", "ret"), "catexp": ("cat", "exp"),
+                     "symref": ("sym", "ref")}
+
+
+class NodeNameRegistry(object):
+    """
+    A sorted index of the node names in a nodespace.
+    Prefix lookups cost O(log n + matches) instead of a scan over all nodes in the nodespace. Adding and removing
+    a node inserts into and deletes from a sorted list, which is cheap next to a scan, but linear in n.
+    Nodes are removed by the name they have been registered under, so nodes renamed without going through
+    this module (i.e. in the editor) are still removed correctly, and found by their old name until then.
+    """
+
+    def __init__(self, nodes):
+        self.keys = sorted((node.name, node.uid) for node in nodes)
+        self.nodes = dict((node.uid, node) for node in nodes)
+        self.names = dict((node.uid, node.name) for node in nodes)
+
+    def add(self, node):
+        if node.uid not in self.nodes:
+            bisect.insort(self.keys, (node.name, node.uid))
+            self.nodes[node.uid] = node
+            self.names[node.uid] = node.name
+
+    def remove(self, node):
+        if node.uid in self.nodes:
+            key = (self.names.pop(node.uid), node.uid)
+            i = bisect.bisect_left(self.keys, key)
+            if i < len(self.keys) and self.keys[i] == key:
+                del self.keys[i]
+            del self.nodes[node.uid]
+
+    def find(self, name_prefix):
+        result = []
+        i = bisect.bisect_left(self.keys, (name_prefix, ))
+        while i < len(self.keys) and self.keys[i][0].startswith(name_prefix):
+            result.append(self.nodes[self.keys[i][1]])
+            i += 1
+        return result
+
+
+class InterfaceNodeRegistry(object):
+    """
+    The sensors and actors of a nodespace, by datasource and datatarget, so they are found without a scan over the
+    nodespace. Also remembers the datasources and datatargets it has imported nodes for, so repeated imports
+    for an unchanged world adapter are no-ops.
+    """
+
+    def __init__(self, nodes):
+        self.nodes = dict((type, {}) for type in INTERFACE_PARAMETERS)
+        self.imported = dict((type, None) for type in INTERFACE_PARAMETERS)
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        parameter = INTERFACE_PARAMETERS.get(node.type)
+        if parameter is not None and node.get_parameter(parameter) is not None:
+            self.nodes[node.type].setdefault(node.get_parameter(parameter), node)
+
+    def get(self, type, key):
+        return self.nodes[type].get(key)
+
+
+def get_interface_registry(nodespace, netapi):
+    """
+    Returns the interface registry of the given nodespace, building it on first use
+    :param nodespace: the uid of the nodespace
+    :param netapi: netapi
+    """
+    registries = _interface_registries.setdefault(netapi, {})
+    if nodespace not in registries:
+        registries[nodespace] = InterfaceNodeRegistry(_get_nodes(nodespace, netapi))
+    return registries[nodespace]
+
+
+def invalidate_interface_registry(netapi, nodespace=None):
+    """
+    Drops the interface registry of the given nodespace (or of all nodespaces), to be rebuilt on next use.
+    Needed after sensors or actors have been created, changed or deleted without going through this module,
+    i.e. in the editor, and after the world adapter has been replaced.
+    """
+    registries = _interface_registries.get(netapi, {})
+    if nodespace is None:
+        registries.clear()
+    else:
+        registries.pop(nodespace, None)
+
+
+def _forget_interface_node(node, netapi):
+    # sensors and actors change rarely, their registry is simply rebuilt
+    if node.type in INTERFACE_PARAMETERS:
+        invalidate_interface_registry(netapi, node.parent_nodespace)
+
+
+def get_name_registry(nodespace, netapi):
+    """
+    Returns the name registry of the given nodespace, building it on first use
+    :param nodespace: the uid of the nodespace
+    :param netapi: netapi
+    """
+    registries = _name_registries.setdefault(netapi, {})
+    if nodespace not in registries:
+        registries[nodespace] = NodeNameRegistry(_get_nodes(nodespace, netapi))
+    return registries[nodespace]
+
+
+def invalidate_name_registry(netapi, nodespace=None):
+    """
+    Drops the name registry of the given nodespace (or of all nodespaces), to be rebuilt on next use.
+    Needed after nodes have been created or deleted without going through create_node and delete_node,
+    i.e. in the editor.
+    """
+    registries = _name_registries.get(netapi, {})
+    if nodespace is None:
+        registries.clear()
+    else:
+        registries.pop(nodespace, None)
+    # activation watches find their nodes by name as well
+    watches = _activation_watches.get(netapi, {})
+    for key in [key for key in watches if nodespace is None or key[0] == nodespace]:
+        watches.pop(key).close()
+
+
+class ActivationWatch(object):
+    """
+    Tells whether any node of a nodespace with a given name prefix has an activation above a threshold.
+    Where the netapi reports threshold crossings (netapi.watch_activation), the watch is kept current by them
+    and asking it costs nothing. Elsewhere, asking it polls the nodes.
+    Nodes created and deleted through this module are watched and unwatched as they come and go,
+    active nodes deleted through the netapi directly are unwatched when the watch is asked.
+    """
+
+    def __init__(self, nodespace, name_prefix, threshold, netapi):
+        self.nodespace = nodespace
+        self.name_prefix = name_prefix
+        self.threshold = threshold
+        self.netapi = netapi
+        self.evented = hasattr(netapi, "watch_activation")
+        self.watched = {}
+        self.active = set()
+        if self.evented:
+            for node in find_nodes(nodespace, name_prefix, netapi):
+                self.watch(node)
+
+    def watch(self, node):
+        if self.evented and node.uid not in self.watched:
+            self.watched[node.uid] = node
+            if self.netapi.watch_activation(node, self.threshold, self._crossed):
+                self.active.add(node.uid)
+
+    def unwatch(self, node):
+        if node.uid in self.watched:
+            del self.watched[node.uid]
+            self.active.discard(node.uid)
+            self.netapi.unwatch_activation(node, self._crossed)
+
+    def close(self):
+        for node in list(self.watched.values()):
+            self.unwatch(node)
+
+    def _crossed(self, node, above):
+        if above:
+            self.active.add(node.uid)
+        else:
+            self.active.discard(node.uid)
+
+    def any_active(self):
+        if self.evented:
+            # the netapi drops the watches of the nodes it deletes without reporting that they are no longer active
+            for uid in [uid for uid in self.active if not _exists(self.watched[uid], self.netapi)]:
+                self.unwatch(self.watched[uid])
+            return len(self.active) > 0
+        for node in find_nodes(self.nodespace, self.name_prefix, self.netapi):
+            if node.activation > self.threshold:
+                return True
+        return False
+
+
+def get_activation_watch(nodespace, name_prefix, threshold, netapi):
+    """
+    Returns the activation watch for the nodes in the given nodespace whose names start with name_prefix,
+    creating it on first use
+    :param threshold: the activation a node needs to exceed to count as active
+    """
+    watches = _activation_watches.setdefault(netapi, {})
+    key = (nodespace, name_prefix, threshold)
+    if key not in watches:
+        watches[key] = ActivationWatch(nodespace, name_prefix, threshold, netapi)
+    return watches[key]
+
+
+def _unwatch_node(node, netapi):
+    for watch in _activation_watches.get(netapi, {}).values():
+        watch.unwatch(node)
+
+
+def find_nodes(nodespace, name_prefix, netapi):
+    """
+    Returns the nodes in the given nodespace whose names start with name_prefix, like netapi.get_nodes
+    :param nodespace: the uid of the nodespace
+    :param name_prefix: the name prefix to look for
+    :param netapi: netapi
+    :return: a list of nodes, ordered by name
+    """
+    return get_name_registry(nodespace, netapi).find(name_prefix)
+
+
+def seed_random(netapi, seed):
+    """
+    Gives the native modules running on the given netapi a random generator of their own, seeded with seed,
+    so runs of a nodenet can be reproduced independently of each other
+    """
+    _random_generators[netapi] = random.Random(seed)
+
+
+def get_random(netapi):
+    """
+    Returns the random generator for the given netapi: its own one if it has been seeded, else the random module
+    """
+    return _random_generators.get(netapi, random)
+
+
+def add_structure_listener(callback):
+    """
+    Registers a callback(nodes, netapi) to be called with the nodes that are created or whose links change through
+    the functions in this module. Callbacks are invoked after nodes and links have been created and before links
+    are removed.
+    """
+    if callback not in _structure_listeners:
+        _structure_listeners.append(callback)
+
+
+def remove_structure_listener(callback):
+    if callback in _structure_listeners:
+        _structure_listeners.remove(callback)
+
+
+def notify_structure_change(nodes, netapi):
+    for callback in _structure_listeners:
+        callback(nodes, netapi)
+
+
+def add_state_listener(callback):
+    """
+    Registers a callback(node, netapi) to be called after a node's state or parameters have been changed
+    through set_state or set_parameter
+    """
+    if callback not in _state_listeners:
+        _state_listeners.append(callback)
+
+
+def remove_state_listener(callback):
+    if callback in _state_listeners:
+        _state_listeners.remove(callback)
+
+
+def notify_state_change(node, netapi):
+    for callback in _state_listeners:
+        callback(node, netapi)
+
+
+def set_state(node, key, value, netapi):
+    """
+    Sets a state value like node.set_state, notifying the state listeners
+    """
+    _record(netapi, "state", node, key, node.get_state(key))
+    node.set_state(key, value)
+    notify_state_change(node, netapi)
+
+
+def set_parameter(node, key, value, netapi):
+    """
+    Sets a parameter like node.set_parameter, notifying the state listeners
+    """
+    _record(netapi, "parameter", node, key, node.get_parameter(key))
+    node.set_parameter(key, value)
+    if key == INTERFACE_PARAMETERS.get(node.type):
+        _forget_interface_node(node, netapi)
+    notify_state_change(node, netapi)
+
+
+def set_gate_parameter(node, gate_type, parameter, value, netapi):
+    """
+    Sets a gate parameter like node.set_gate_parameter, notifying the state listeners
+    """
+    gate_parameters = (getattr(node, "gate_parameters", None) or {}).get(gate_type) or {}
+    _record(netapi, "gate_parameter", node, gate_type, parameter, gate_parameters.get(parameter))
+    node.set_gate_parameter(gate_type, parameter, value)
+    notify_state_change(node, netapi)
+
+
+def create_node(type, nodespace, name, netapi):
+    """
+    Creates a node like netapi.create_node, keeping the name registry of the nodespace up to date
+    and notifying the structure listeners
+    """
+    node = netapi.create_node(type, nodespace, name)
+    _register_node(node, netapi)
+    _record(netapi, "created", node)
+    notify_structure_change([node], netapi)
+    return node
+
+
+def _register_node(node, netapi):
+    registries = _name_registries.get(netapi, {})
+    if node.parent_nodespace in registries:
+        registries[node.parent_nodespace].add(node)
+    for (nodespace, name_prefix, threshold), watch in _activation_watches.get(netapi, {}).items():
+        if nodespace == node.parent_nodespace and node.name.startswith(name_prefix):
+            watch.watch(node)
+    _forget_interface_node(node, netapi)
+
+
+def delete_node(node, netapi):
+    """
+    Deletes a node like netapi.delete_node, keeping the name registry of its nodespace up to date
+    """
+    delete_nodes([node], netapi)
+
+
+def delete_nodes(nodes, netapi):
+    """
+    Deletes all the given nodes in one pass, keeping the name registries up to date
+    and notifying the structure listeners once.
+    While a fork is open, the nodes are only unlinked, see NodenetFork.
+    """
+    nodes = [node for node in nodes if not is_deleted(node, netapi)]
+    _forget_nodes(nodes, netapi)
+    fork = _get_fork(netapi)
+    for node in nodes:
+        if fork is None:
+            netapi.delete_node(node)
+        else:
+            fork.delete_node(node)
+
+
+def _forget_nodes(nodes, netapi):
+    # removes nodes about to be deleted from the registries and watches, notifying the structure listeners
+    registries = _name_registries.get(netapi, {})
+    affected_nodes = []
+    for node in nodes:
+        if node.parent_nodespace in registries:
+            registries[node.parent_nodespace].remove(node)
+        _forget_interface_node(node, netapi)
+        _unwatch_node(node, netapi)
+        affected_nodes.extend(_linked_nodes(node))
+    notify_structure_change(affected_nodes, netapi)
+
+
+def link(source_node, source_gate, target_node, target_slot, netapi, weight=1, certainty=1):
+    """
+    Links two nodes like netapi.link, notifying the structure listeners
+    """
+    _record_link(source_node, source_gate, target_node, target_slot, netapi)
+    netapi.link(source_node, source_gate, target_node, target_slot, weight, certainty)
+    notify_structure_change([source_node, target_node], netapi)
+
+
+def link_with_reciprocal(source_node, target_node, linktype, netapi, weight=1, certainty=1):
+    """
+    Links two nodes in both directions like netapi.link_with_reciprocal, notifying the structure listeners
+    """
+    _record_reciprocal_link(source_node, target_node, linktype, netapi)
+    netapi.link_with_reciprocal(source_node, target_node, linktype, weight, certainty)
+    notify_structure_change([source_node, target_node], netapi)
+
+
+def link_full(nodes, linktype, netapi, weight=1, certainty=1):
+    """
+    Links all the given nodes with each other like netapi.link_full, notifying the structure listeners
+    """
+    for source_node in nodes:
+        for target_node in nodes:
+            if source_node is not target_node:
+                _record_reciprocal_link(source_node, target_node, linktype, netapi)
+    netapi.link_full(nodes, linktype, weight, certainty)
+    notify_structure_change(nodes, netapi)
+
+
+def link_actor(node, datatarget, netapi, weight=1, certainty=1):
+    """
+    Links a node to the actor for the given datatarget like netapi.link_actor, notifying the structure listeners
+    """
+    notify_structure_change([node] + _link_actor(node, datatarget, netapi, weight, certainty), netapi)
+
+
+def link_sensor(node, datasource, netapi):
+    """
+    Links the sensor for the given datasource to a node like netapi.link_sensor, notifying the structure listeners
+    """
+    notify_structure_change([node] + _link_sensor(node, datasource, netapi), netapi)
+
+
+def _link_actor(node, datatarget, netapi, weight=1, certainty=1):
+    # links a known actor directly, leaves finding or creating it to netapi.link_actor otherwise.
+    # returns the linked actors
+    actor = get_interface_registry(node.parent_nodespace, netapi).get("Actor", datatarget)
+    if actor is not None:
+        _record_link(node, "sub", actor, "gen", netapi)
+        netapi.link(node, "sub", actor, "gen", weight, certainty)
+        return [actor]
+    netapi.link_actor(node, datatarget, weight, certainty)
+    actors = _linked_actors(node, datatarget)
+    for actor in actors:
+        _register_node(actor, netapi)
+        # the registry did not know an actor for the datatarget, so netapi.link_actor has created it
+        _record(netapi, "created", actor)
+        _record(netapi, "link", node, "sub", actor, "gen", None)
+    return actors
+
+
+def _link_sensor(node, datasource, netapi):
+    # links a known sensor directly, leaves finding or creating it to netapi.link_sensor otherwise.
+    # returns the linked sensors
+    sensor = get_interface_registry(node.parent_nodespace, netapi).get("Sensor", datasource)
+    if sensor is not None:
+        _record_link(sensor, "gen", node, "sur", netapi)
+        netapi.link(sensor, "gen", node, "sur")
+        return [sensor]
+    netapi.link_sensor(node, datasource)
+    sensors = _linked_sensors(node, datasource)
+    for sensor in sensors:
+        _register_node(sensor, netapi)
+        # the registry did not know a sensor for the datasource, so netapi.link_sensor has created it
+        _record(netapi, "created", sensor)
+        _record(netapi, "link", sensor, "gen", node, "sur", None)
+    return sensors
+
+
+def _linked_actors(node, datatarget):
+    # the actors for the given datatarget linked from the node's sub gate, as created by netapi.link_actor
+    return [link.target_node for link in node.get_gate("sub").get_links()
+            if link.target_node.type == "Actor" and link.target_node.get_parameter("datatarget") == datatarget]
+
+
+def _linked_sensors(node, datasource):
+    # the sensors for the given datasource linked to the node's sur slot, as created by netapi.link_sensor
+    return [link.source_node for link in node.get_slot("sur").get_links()
+            if link.source_node.type == "Sensor" and link.source_node.get_parameter("datasource") == datasource]
+
+
+def import_actors(nodespace, netapi):
+    """
+    Creates the missing actors for the world adapter's datatargets like netapi.import_actors,
+    keeping the name registry up to date and notifying the structure listeners of the new actors.
+    Does nothing if the nodenet has no world, or if the actors have been imported before and the datatargets
+    have not changed since.
+    """
+    world = netapi.world
+    if world is None:
+        return
+    _import_nodes(nodespace, "Actor", world.get_available_datatargets(), netapi.import_actors, netapi)
+
+
+def import_sensors(nodespace, netapi):
+    """
+    Creates the missing sensors for the world adapter's datasources like netapi.import_sensors,
+    keeping the name registry up to date and notifying the structure listeners of the new sensors.
+    Does nothing if the nodenet has no world, or if the sensors have been imported before and the datasources
+    have not changed since.
+    """
+    world = netapi.world
+    if world is None:
+        return
+    _import_nodes(nodespace, "Sensor", world.get_available_datasources(), netapi.import_sensors, netapi)
+
+
+def _import_nodes(nodespace, type, keys, import_function, netapi):
+    registry = get_interface_registry(nodespace, netapi)
+    if registry.imported[type] == keys:
+        return
+    if any(registry.get(type, key) is None for key in keys):
+        known_uids = set(node.uid for node in netapi.get_nodes(nodespace) if node.type == type)
+        import_function(nodespace)
+        created_nodes = [node for node in netapi.get_nodes(nodespace)
+                         if node.type == type and node.uid not in known_uids]
+        if len(created_nodes) > 0:
+            for node in created_nodes:
+                _register_node(node, netapi)
+                _record(netapi, "created", node)
+            notify_structure_change(created_nodes, netapi)
+        registry = get_interface_registry(nodespace, netapi)
+    registry.imported[type] = keys
+
+
+def unlink(source_node, source_gate, target_node, netapi):
+    """
+    Removes the links from the given gate like netapi.unlink, notifying the structure listeners
+    :param target_node: if not None, only the links to this node will be removed
+    """
+    if target_node is None:
+        affected_nodes = [source_node] + [link.target_node for link in source_node.get_gate(source_gate).get_links()]
+    else:
+        affected_nodes = [source_node, target_node]
+    notify_structure_change(affected_nodes, netapi)
+    _record_unlink([link for link in source_node.get_gate(source_gate).get_links()
+                    if target_node is None or link.target_node.uid == target_node.uid], netapi)
+    netapi.unlink(source_node, source_gate, target_node)
+
+
+def unlink_direction(node, gateslot, netapi):
+    """
+    Removes the links of a node's gate and slot of the given type like netapi.unlink_direction,
+    notifying the structure listeners
+    """
+    notify_structure_change(_linked_nodes(node, gateslot), netapi)
+    _record_unlink(_links(node, gateslot), netapi)
+    netapi.unlink_direction(node, gateslot)
+
+
+def _linked_nodes(node, gateslot=None):
+    # the given node and all nodes linked to it, optionally only through the given gate and slot type
+    nodes = [node]
+    for gate_type in node.get_gate_types():
+        if gateslot is None or gate_type == gateslot:
+            nodes.extend(link.target_node for link in node.get_gate(gate_type).get_links())
+    for slot_type in node.get_slot_types():
+        if gateslot is None or slot_type == gateslot:
+            nodes.extend(link.source_node for link in node.get_slot(slot_type).get_links())
+    return nodes
+
+
+def _links(node, gateslot=None):
+    # the links of the given node, optionally only those of the given gate and slot type
+    links = {}
+    for gate_type in node.get_gate_types():
+        if gateslot is None or gate_type == gateslot:
+            links.update((id(link), link) for link in node.get_gate(gate_type).get_links())
+    for slot_type in node.get_slot_types():
+        if gateslot is None or slot_type == gateslot:
+            links.update((id(link), link) for link in node.get_slot(slot_type).get_links())
+    return list(links.values())
+
+
+class StructureBatch(object):
+    """
+    Creates nodes and links as one unit.
+    The bookkeeping of this module (name registries, structure listeners) is done once when the batch is committed.
+    If anything fails before that, the nodes created so far are deleted again through delete_nodes, including the
+    sensors and actors link_sensor and link_actor have created, so no partial structure is left behind and open forks
+    and the structure listeners see the deletion.
+    Use it as a context manager:
+        with StructureBatch(netapi) as batch:
+            node = batch.create_node("Pipe", nodespace, "name")
+            batch.link(node, "gen", node, "gen", 0.98)
+    """
+
+    def __init__(self, netapi):
+        self.netapi = netapi
+        self.created_nodes = []
+        # the sensors and actors created by link_sensor and link_actor, registered as they are created
+        self.created_interface_nodes = []
+        self.linked_nodes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+    def create_node(self, type, nodespace, name):
+        node = self.netapi.create_node(type, nodespace, name)
+        self.created_nodes.append(node)
+        _record(self.netapi, "created", node)
+        return node
+
+    def link(self, source_node, source_gate, target_node, target_slot, weight=1, certainty=1):
+        _record_link(source_node, source_gate, target_node, target_slot, self.netapi)
+        self.netapi.link(source_node, source_gate, target_node, target_slot, weight, certainty)
+        self.linked_nodes.extend((source_node, target_node))
+
+    def link_with_reciprocal(self, source_node, target_node, linktype, weight=1, certainty=1):
+        _record_reciprocal_link(source_node, target_node, linktype, self.netapi)
+        self.netapi.link_with_reciprocal(source_node, target_node, linktype, weight, certainty)
+        self.linked_nodes.extend((source_node, target_node))
+
+    def link_actor(self, node, datatarget, weight=1, certainty=1):
+        known = get_interface_registry(node.parent_nodespace, self.netapi).get("Actor", datatarget)
+        actors = _link_actor(node, datatarget, self.netapi, weight, certainty)
+        self.linked_nodes.append(node)
+        self.linked_nodes.extend(actors)
+        if known is None:
+            self.created_interface_nodes.extend(actors)
+
+    def link_sensor(self, node, datasource):
+        known = get_interface_registry(node.parent_nodespace, self.netapi).get("Sensor", datasource)
+        sensors = _link_sensor(node, datasource, self.netapi)
+        self.linked_nodes.append(node)
+        self.linked_nodes.extend(sensors)
+        if known is None:
+            self.created_interface_nodes.extend(sensors)
+
+    def commit(self):
+        for node in self.created_nodes:
+            _register_node(node, self.netapi)
+        notify_structure_change(self.created_nodes + self.linked_nodes, self.netapi)
+        self.created_nodes = []
+        self.created_interface_nodes = []
+        self.linked_nodes = []
+
+    def rollback(self):
+        nodes = self.created_nodes + self.created_interface_nodes
+        delete_nodes([node for node in reversed(nodes) if _exists(node, self.netapi)], self.netapi)
+        self.created_nodes = []
+        self.created_interface_nodes = []
+        self.linked_nodes = []
+
+
+# forks: while a NodenetFork is open, the functions of this module record the changes they make in it, as an undo log.
+# A fork shares all nodes and links it does not change with the nodenet, so it costs what is changed in it,
+# and rolling it back undoes these changes only.
+# Changes made to the nodenet without going through this module are not recorded, code that keeps its own
+# structures in memory can record how to undo changes to them with record_undo.
+
+class NodenetFork(object):
+    """
+    Records the changes made through this module, so they can be rolled back.
+        fork = NodenetFork(netapi)
+        fork.open()
+        ... changes, possibly over several steps
+        fork.rollback()     # or fork.commit() to keep the changes
+    A fork can be suspended to let the nodenet run and change outside of it, i.e. while its changes are being
+    evaluated, and opened again later; only the changes made while it has been open are rolled back.
+    A fork opened while another one is open is nested in it: committing it hands its changes to the outer fork.
+    Nodes deleted in a fork are only unlinked (see is_deleted), and deleted when the outermost fork is committed.
+    Use it as a context manager to commit it, or to roll it back if an exception is raised:
+        with NodenetFork(netapi):
+            create_common_feature_abstraction(schema1, schema2, netapi)
+    """
+
+    def __init__(self, netapi):
+        self.netapi = netapi
+        # the changes made in the fork, oldest first, as tuples of a kind and what is needed to undo the change
+        self.log = []
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+    def is_open(self):
+        return self in _forks.get(self.netapi, ())
+
+    def open(self):
+        forks = _forks.setdefault(self.netapi, [])
+        if self not in forks:
+            forks.append(self)
+        return self
+
+    def suspend(self):
+        forks = _forks.get(self.netapi, [])
+        if self in forks:
+            if forks[-1] is not self:
+                raise RuntimeError("Only the innermost open fork of a netapi can be suspended, committed "
+                                   "or rolled back")
+            forks.pop()
+
+    def delete_node(self, node):
+        # unlinks the node, keeping it for a rollback
+        _record_unlink(_links(node), self.netapi)
+        self.netapi.unlink_direction(node)
+        self.log.append(("deleted", node))
+        _deleted_nodes.setdefault(self.netapi, {})[node.uid] = node
+
+    def commit(self):
+        """
+        Keeps the changes made in the fork, handing them to the fork it is nested in, if it is open
+        """
+        self.suspend()
+        netapi = self.netapi
+        outer = _get_fork(netapi)
+        if outer is not None:
+            outer.log.extend(self.log)
+        else:
+            deleted_nodes = _deleted_nodes.get(netapi, {})
+            nodes = [entry[1] for entry in self.log if entry[0] == "deleted" and entry[1].uid in deleted_nodes]
+            if len(nodes) > 0:
+                notify_structure_change(nodes, netapi)
+            for node in nodes:
+                del deleted_nodes[node.uid]
+                if _exists(node, netapi):
+                    netapi.delete_node(node)
+        self.log = []
+
+    def rollback(self):
+        """
+        Undoes the changes made in the fork, latest first
+        """
+        self.suspend()
+        netapi = self.netapi
+        linked_nodes = [node for entry in self.log if entry[0] == "link" for node in (entry[1], entry[3])]
+        linked_nodes = [node for node in linked_nodes if _exists(node, netapi)]
+        notify_structure_change(linked_nodes, netapi)
+
+        created_nodes = []
+        changed_nodes = []
+        for entry in reversed(self.log):
+            kind, node = entry[0], entry[1]
+            if kind == "call":
+                node()
+            elif kind == "created":
+                created_nodes.append(node)
+            elif kind == "deleted":
+                _deleted_nodes[netapi].pop(node.uid, None)
+                _register_node(node, netapi)
+            elif kind == "link":
+                source_gate, target_node, target_slot, previous = entry[2:]
+                if not (_exists(node, netapi) and _exists(target_node, netapi)):
+                    continue
+                if previous is None:
+                    netapi.unlink(node, source_gate, target_node, target_slot)
+                else:
+                    netapi.link(node, source_gate, target_node, target_slot, *previous)
+            elif kind == "state":
+                if entry[3] is None and isinstance(getattr(node, "state", None), dict):
+                    node.state.pop(entry[2], None)      # the node had no such state before
+                else:
+                    node.set_state(entry[2], entry[3])
+                changed_nodes.append(node)
+            elif kind == "parameter":
+                node.set_parameter(entry[2], entry[3])
+                if entry[2] == INTERFACE_PARAMETERS.get(node.type):
+                    _forget_interface_node(node, netapi)
+                changed_nodes.append(node)
+            elif kind == "gate_parameter":
+                node.set_gate_parameter(entry[2], entry[3], entry[4])
+                changed_nodes.append(node)
+        self.log = []
+
+        notify_structure_change(linked_nodes, netapi)
+        for node in changed_nodes:
+            if _exists(node, netapi):
+                notify_state_change(node, netapi)
+        created_nodes = [node for node in created_nodes if _exists(node, netapi)]
+        _forget_nodes(created_nodes, netapi)
+        for node in created_nodes:
+            netapi.delete_node(node)
+
+
+def is_deleted(node, netapi):
+    """
+    Returns True if the node has been deleted in a fork that has not been committed yet.
+    Such nodes have no links and are not found through the registries of this module, but are still in the nodenet.
+    """
+    return node.uid in _deleted_nodes.get(netapi, ())
+
+
+def record_undo(undo, netapi):
+    """
+    Records a function to be called without arguments if the changes made in the innermost open fork are rolled
+    back, to undo a change this module does not know of. Does nothing if no fork is open.
+    """
+    _record(netapi, "call", undo)
+
+
+def _get_fork(netapi):
+    forks = _forks.get(netapi)
+    return forks[-1] if forks else None
+
+
+def _record(netapi, *entry):
+    fork = _get_fork(netapi)
+    if fork is not None:
+        fork.log.append(entry)
+
+
+def _record_link(source_node, source_gate, target_node, target_slot, netapi):
+    # records a link about to be created, with the weight and certainty of the link it replaces, if any
+    fork = _get_fork(netapi)
+    if fork is not None:
+        previous = None
+        for link in source_node.get_gate(source_gate).get_links():
+            if link.target_node.uid == target_node.uid and link.target_slot.type == target_slot:
+                previous = (link.weight, link.certainty)
+        fork.log.append(("link", source_node, source_gate, target_node, target_slot, previous))
+
+
+def _record_reciprocal_link(source_node, target_node, linktype, netapi):
+    if _get_fork(netapi) is not None:
+        forward, backward = _RECIPROCAL_GATES[linktype]
+        _record_link(source_node, forward, target_node, forward, netapi)
+        _record_link(target_node, backward, source_node, backward, netapi)
+
+
+def _record_unlink(links, netapi):
+    # records links about to be removed
+    fork = _get_fork(netapi)
+    if fork is not None:
+        for link in links:
+            fork.log.append(("link", link.source_node, link.source_gate.type, link.target_node, link.target_slot.type,
+                             (link.weight, link.certainty)))
+
+
+def _exists(node, netapi):
+    try:
+        netapi.get_node(node.uid)
+    except KeyError:
+        return False
+    return True
+
+
+def _get_nodes(nodespace, netapi):
+    # the nodes of the nodespace like netapi.get_nodes, without those deleted in forks that have not been committed
+    deleted_nodes = _deleted_nodes.get(netapi)
+    if not deleted_nodes:
+        return netapi.get_nodes(nodespace)
+    return [node for node in netapi.get_nodes(nodespace) if node.uid not in deleted_nodes]
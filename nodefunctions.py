@@ -1,14 +1,13 @@
 __author__ = 'rvuine'
 
-import random
-import time
+from nettools import *
 from schematools import *
 
 
 def scene_importer(netapi, node=None, sheaf='default', **params):
 
-    netapi.import_actors(node.parent_nodespace)
-    netapi.import_sensors(node.parent_nodespace)
+    import_actors(node.parent_nodespace, netapi)
+    import_sensors(node.parent_nodespace, netapi)
 
     node.get_gate("reset").gate_function(0)
     #node.get_gate("fov_x").gate_function(node.get_slot("fov-x").activation)
@@ -18,24 +17,26 @@ def scene_importer(netapi, node=None, sheaf='default', **params):
     #node.get_gate("fov_y").gate_function(node.get_slot("fov-y").activation)
 
     # make sure we have an importer scene register
-    importer_scene_registers = netapi.get_nodes(node.parent_nodespace, "ImporterScene")
+    importer_scene_registers = find_nodes(node.parent_nodespace, "ImporterScene", netapi)
     if len(importer_scene_registers) is 0:
-        importer_scene_register = netapi.create_node("Register", node.parent_nodespace, "ImporterScene")
+        importer_scene_register = create_node("Register", node.parent_nodespace, "ImporterScene", netapi)
     else:
         importer_scene_register = importer_scene_registers[0]
 
     # make sure we have an importer scene node
     scene = None
-    for link in importer_scene_register.get_gate('gen').get_links():
-        if link.target_node.name.startswith("Scene"):
-            scene = link.target_node
+    for gen_link in importer_scene_register.get_gate('gen').get_links():
+        if gen_link.target_node.name.startswith("Scene"):
+            scene = gen_link.target_node
             break
 
     # when triggered, we create a new scene to add features to
     if node.get_slot("newscene").activation >= 1:
-        scene = netapi.create_node("Pipe", node.parent_nodespace, "Scene-"+str(time.time()))
-        netapi.unlink(importer_scene_register, 'gen')
-        netapi.link(importer_scene_register, 'gen', scene, 'sub')
+        scene = create_node("Pipe", node.parent_nodespace, "Scene-"+str(netapi.step), netapi)
+        unlink(importer_scene_register, 'gen', None, netapi)
+        link(importer_scene_register, 'gen', scene, 'sub', netapi)
+        # what the fovea has seen so far belongs to the previous scene
+        clear_fovea_observations(node.parent_nodespace, netapi)
         # signal we have been importing
         node.get_gate("import").gate_function(1)
         netapi.logger.debug("SceneImporter created new scene node %s.", scene.name)
@@ -46,20 +47,21 @@ def scene_importer(netapi, node=None, sheaf='default', **params):
 
     randomize = True
 
+    # current fovea position and the fovea sensors active there
+    x = int(node.get_slot("fov-x").activation)
+    y = int(node.get_slot("fov-y").activation)
+    fovea_sensors = [sensor for sensor in netapi.get_nodes_active(node.parent_nodespace, 'Sensor', 1, 'gen')
+                     if sensor.name.startswith("fovea")]
+
+    # remember what the fovea sees, to recognize known scenes by (see recognize_scenes)
+    record_fovea_observation(node.parent_nodespace, x, y, fovea_sensors, netapi)
+
     # if the scene is fully recognized, check if there's something we can add to it in the world
     if (scene.activation > 0.8 or scene.get_slot('sur').empty) and node.get_slot("dontgrow").activation < 1:
         # what we're looking for: a feature that is active but hasn't been linked
         # for this, we move the fovea to a position we haven't looked at yet
 
-        # build a list of fovea positions that are taken care of
-        sub_field = netapi.get_nodes_in_gate_field(scene, 'sub')
-        fovea_positions = []
-        for sub_node in sub_field:
-            fovea_positions.append((sub_node.get_state('x'), sub_node.get_state('y')))
-
-        # current fovea position and resulting feature name
-        x = int(node.get_slot("fov-x").activation)
-        y = int(node.get_slot("fov-y").activation)
+        # resulting feature name for the current fovea position
         featurename = "F(" + str(x) + "/" + str(y)+")"
 
         netapi.logger.debug("SceneImporter has stable scene, checking if current feature %s is imported.", featurename)
@@ -67,97 +69,42 @@ def scene_importer(netapi, node=None, sheaf='default', **params):
         randomize = False
 
         # now, do we have a feature for the current sensor situation?
-        if (x, y) not in fovea_positions:
+        if not is_fovea_position_covered(scene, x, y, netapi):
 
             netapi.logger.debug("SceneImporter: %s is not imported, importing.", featurename)
 
-            # find the sensors to link
-            active_sensors = netapi.get_nodes_active(node.parent_nodespace, 'Sensor', 1, 'gen')
-            fovea_sensors_for_new_feature = []
-            presence_sensors_for_new_feature = []
-            for sensor in active_sensors:
-                if sensor.name.startswith("fovea"):
-                    fovea_sensors_for_new_feature.append(sensor)
-                if sensor.name.startswith("presence"):
-                    presence_sensors_for_new_feature.append(sensor)
-
-            if len(fovea_sensors_for_new_feature) == 0:
+            if len(fovea_sensors) == 0:
                 netapi.logger.debug("SceneImporter: Aborting import of %s, no sensors", featurename)
                 randomize = True
 
-            # and build the schema for them
-            if len(fovea_sensors_for_new_feature) > 0:
-
-                feature = netapi.create_node("Pipe", node.parent_nodespace, featurename)
-                feature.set_state('x', x)
-                feature.set_state('y', y)
-                #feature.set_parameter('sublock', 'fovea')
-                netapi.link(feature, 'gen', feature, 'gen', 0.98)     # gen loop
-                #feature.set_gate_parameter('threshold', 0.1)
-                netapi.link_with_reciprocal(scene, feature, "subsur")
-
-                #recognition = netapi.create_node("Pipe", node.parent_nodespace, featurename+".Rec")
-                #netapi.link_with_reciprocal(feature, recognition, "subsur")
-
-                # create recognition script
-                act = netapi.create_node("Pipe", node.parent_nodespace, featurename+".Act")
-                netapi.link_with_reciprocal(feature, act, "subsur")
-
-                sense = netapi.create_node("Pipe", node.parent_nodespace, featurename+".Sense")
-                netapi.link_with_reciprocal(feature, sense, "subsur")
-
-                netapi.link_with_reciprocal(act, sense, "porret")
-
-                mov_x = netapi.create_node("Trigger", node.parent_nodespace, featurename+".mov-x")
-                mov_y = netapi.create_node("Trigger", node.parent_nodespace, featurename+".mov-y")
-                mov_x.set_parameter('response', x)
-                mov_y.set_parameter('response', y)
-                mov_x.set_parameter('timeout', 3)
-                mov_y.set_parameter('timeout', 3)
-                netapi.link_with_reciprocal(act, mov_x, "subsur")
-                netapi.link_with_reciprocal(act, mov_y, "subsur")
-                netapi.link(mov_x, 'sur', act, 'sur', 0.5)
-                netapi.link(mov_y, 'sur', act, 'sur', 0.5)
-
-                netapi.link_actor(mov_x, 'fov_reset')
-                if x != 0:
-                    netapi.link_actor(mov_x, 'fov_x', x)
-                if y != 0:
-                    netapi.link_actor(mov_y, 'fov_y', y)
-
-                netapi.link_sensor(mov_x, "fov-x")
-                netapi.link_sensor(mov_y, "fov-y")
-
-                # create conditional sensor classificator
-                sense_features = []
-                for sensor in fovea_sensors_for_new_feature:
-                    sense_feature = netapi.create_node("Pipe", node.parent_nodespace, featurename+"."+sensor.name)
-                    sense_features.append(sense_feature)
-                    netapi.link_with_reciprocal(sense, sense_feature, "subsur")
-
-                    #senseproxy = netapi.create_node("Pipe", node.parent_nodespace, featurename+"."+sensor.name+".Prx")
-                    #netapi.link_with_reciprocal(sense_feature, senseproxy, "subsur")
-
-                    #netapi.link(senseproxy, 'gen', senseproxy, 'gen', 0.98)
-                    netapi.link_sensor(sense_feature, sensor.name)
-
-                sub_field = netapi.get_nodes_in_gate_field(scene, 'sub')
+            # build the schema for the active fovea sensors
+            if len(fovea_sensors) > 0:
+
+                # the whole recognition script is built in one batch and only linked to the scene when complete
+                feature_schema = instantiate_schema_template(
+                    FOVEA_FEATURE_TEMPLATE,
+                    node.parent_nodespace,
+                    netapi,
+                    parent=scene,
+                    sensors=fovea_sensors,
+                    name=featurename,
+                    x=x,
+                    y=y)
+                index_fovea_feature(scene, feature_schema["feature"], netapi)
+
                 netapi.logger.debug("SceneImporter imported %s.", featurename)
         else:
             netapi.logger.debug("SceneImporter: %s already imported, aborting.", featurename)
             randomize = True
 
-        # finally some fovea randomisation for the next round if no schema is accessing the fovea right now
+        # finally move the fovea to the next position worth looking at, if no schema is accessing the fovea right now
         if not netapi.is_locked('fovea') and randomize:
-            fovea_position_candidate = (random.randint(-2, 2), random.randint(-2, 2))
-            i = 10
-            while fovea_position_candidate not in fovea_positions and i < 10:
-                i += 1
-                fovea_position_candidate = (random.randint(-2, 2), random.randint(-2, 2))
+            planner = SACCADE_PLANNERS[node.get_parameter('saccade_planner') or DEFAULT_SACCADE_PLANNER]
+            fovea_position_candidate = planner(scene, x, y, netapi)
 
-            if fovea_position_candidate not in fovea_positions:
+            if fovea_position_candidate is not None:
 
-                netapi.logger.debug("Randomizing fovea to %i/%i", fovea_position_candidate[0], fovea_position_candidate[1])
+                netapi.logger.debug("Moving fovea to %i/%i", fovea_position_candidate[0], fovea_position_candidate[1])
 
                 node.get_gate("reset").gate_function(1)
                 node.get_gate("fov_x").gate_function(fovea_position_candidate[0])
@@ -174,15 +121,10 @@ def inactivity_monitor(netapi, node=None, sheaf='default', **params):
     else:
         name_prefix = node.get_parameter('name')
         if name_prefix is None or len(name_prefix) == 0 or name_prefix == '*':
-            node.set_parameter('name', 'Scene')  # TODO: replace 'Scene' with '*' to make the module generic
+            set_parameter(node, 'name', 'Scene', netapi)  # TODO: replace 'Scene' with '*' to make the module generic
             name_prefix = 'Scene'  # TODO: same here, once TOL-18 is resolved
 
-        is_one_of_them_active = False
-        nodes = netapi.get_nodes(node.parent_nodespace, name_prefix)
-        for candidate in nodes:
-            if candidate.activation > 0.5:
-                is_one_of_them_active = True
-                break
+        is_one_of_them_active = get_activation_watch(node.parent_nodespace, name_prefix, 0.5, netapi).any_active()
 
         if not is_one_of_them_active:
             inact += 0.05
@@ -199,31 +141,20 @@ def protocol_builder(netapi, node=None, sheaf='default', **params):
         return
 
     # collect new things to add to the previous protocol node
-    importer_scene_registers = netapi.get_nodes(node.parent_nodespace, "ImporterScene")
+    importer_scene_registers = find_nodes(node.parent_nodespace, "ImporterScene", netapi)
     if len(importer_scene_registers) > 0:
         importer_scene_register = importer_scene_registers[0]
     new_elements_scene = None
-    for link in importer_scene_register.get_gate('gen').get_links():
-        if link.target_node.name.startswith("Scene"):
-            new_elements_scene = link.target_node
+    for gen_link in importer_scene_register.get_gate('gen').get_links():
+        if gen_link.target_node.name.startswith("Scene"):
+            new_elements_scene = gen_link.target_node
             break
 
-    # find the protocol chain in the node space
-    protocol_super_nodes = netapi.get_nodes(node.parent_nodespace, "Chain")
-
-    # no protocol chain found, create one
-    if len(protocol_super_nodes) < 1:
-        protocol_super_node = netapi.create_node("Pipe", node.parent_nodespace, "Chain")
-        initial_protocol_head = netapi.create_node("Pipe", node.parent_nodespace, "proto-0")
-        initial_protocol_head.set_state("index", "0")
-        netapi.link_with_reciprocal(protocol_super_node, initial_protocol_head, "subsur")
-        protocol_super_nodes.append(protocol_super_node)
-
-    # pick a protocol to extend
-    protocol_super_node = protocol_super_nodes[0]   # todo: Handle cases with multiple protocols
+    # find the protocol chain in the node space, or create one
+    protocol_super_node = get_protocol_chain(node.parent_nodespace, netapi, create=True)
 
     # get the current head of the protocol, the pormost node
-    protocol_head = netapi.get_nodes_in_gate_field(protocol_super_node, "sub", ["por"])[0]
+    protocol_head = get_protocol_head(protocol_super_node, netapi)
 
     # if the head is already referring to something, we need to record new_elements_scene,
     # extend the protocol and move the head
@@ -233,33 +164,38 @@ def protocol_builder(netapi, node=None, sheaf='default', **params):
         # before moving forward and creating a new protocol head
         if new_elements_scene is not None:
             old_protocolled_scene = netapi.get_nodes_in_gate_field(protocol_head, "sub")[0]
-            netapi.link_with_reciprocal(old_protocolled_scene, new_elements_scene, "subsur")
+            link_with_reciprocal(old_protocolled_scene, new_elements_scene, "subsur", netapi)
             old_protocolled_elements = netapi.get_nodes_in_gate_field(old_protocolled_scene, "sub")
 
-        head_index = int(protocol_head.get_state("index"))
-        new_head_index = head_index + 1
-        new_protocol_head = netapi.create_node("Pipe", node.parent_nodespace, "proto-"+str(new_head_index))
-        new_protocol_head.set_state("index", str(new_head_index))
-        netapi.link_with_reciprocal(protocol_super_node, new_protocol_head, "subsur")
-        netapi.link_with_reciprocal(protocol_head, new_protocol_head, "porret")
-        protocol_head = new_protocol_head
+        protocol_head = extend_protocol_chain(protocol_super_node, netapi)
+
+        # forget the oldest protocol elements, if the protocol is to be kept short
+        compact_protocol_chain(protocol_super_node, node.get_parameter('protocol_retention'), netapi)
 
     # now we have a clean protocol head, ready to be used for protocolling something
 
     # create a new scene as registered in the protocol
-    protocolled_scene = netapi.create_node("Pipe", node.parent_nodespace, "ProtScene-"+str(time.time()))
-    netapi.link_with_reciprocal(protocol_head, protocolled_scene, "subsur")
+    protocolled_scene = create_node("Pipe", node.parent_nodespace, "ProtScene-"+str(netapi.step), netapi)
+    link_with_reciprocal(protocol_head, protocolled_scene, "subsur", netapi)
 
     # link all occurrences of things we already know
-    candidates = netapi.get_nodes_active(node.parent_nodespace, "Pipe", 0.8)
+    candidates = [candidate for candidate in netapi.get_nodes_active(node.parent_nodespace, "Pipe", 0.8)
+                  if candidate.name.startswith("Scene")]
+
+    # a known scene that has everything the fovea has seen is recognized, even if activation has not spread to it yet
+    for candidate, matches in recognize_scenes(node.parent_nodespace, netapi, complete=True):
+        if candidate != new_elements_scene:
+            if candidate not in candidates:
+                candidates.append(candidate)
+            break
+
     scenes = []
     for candidate in candidates:
-        if candidate.name.startswith("Scene"):
-            occurrence = netapi.create_node("Pipe", node.parent_nodespace, "Occurrence")
-            netapi.link_with_reciprocal(protocolled_scene, occurrence, "subsur")
-            netapi.link_with_reciprocal(occurrence, candidate, "catexp")
-            netapi.link_with_reciprocal(protocolled_scene, candidate, "subsur")
-            scenes.append(candidate)
+        occurrence = create_node("Pipe", node.parent_nodespace, "Occurrence", netapi)
+        link_with_reciprocal(protocolled_scene, occurrence, "subsur", netapi)
+        link_with_reciprocal(occurrence, candidate, "catexp", netapi)
+        link_with_reciprocal(protocolled_scene, candidate, "subsur", netapi)
+        scenes.append(candidate)
 
     # make sure we have a current scene register
     #current_scene_registers = netapi.get_nodes(node.parent_nodespace, "Sepp")
@@ -292,12 +228,16 @@ def protocol_builder(netapi, node=None, sheaf='default', **params):
 
 def structure_abstraction_builder(netapi, node=None, sheaf='default', **params):
 
+    # while abstractions are being tried, nothing else is done
+    if get_abstraction_trial(node, netapi) is not None:
+        advance_abstraction_trial(node, netapi)
+        return
+
     # build a list of schemas encountered
-    protocol_super_nodes = netapi.get_nodes(node.parent_nodespace, "Chain")
-    if len(protocol_super_nodes) < 1:
+    protocol_super_node = get_protocol_chain(node.parent_nodespace, netapi)
+    if protocol_super_node is None:
         return
-    protocol_super_node = protocol_super_nodes[0]   # todo: Handle cases with multiple protocols
-    protocol_head = netapi.get_nodes_in_gate_field(protocol_super_node, "sub", ["por"])[0]
+    protocol_head = get_protocol_head(protocol_super_node, netapi)
 
     schemas = []
     current_protocol_element = protocol_head
@@ -347,10 +287,16 @@ def structure_abstraction_builder(netapi, node=None, sheaf='default', **params):
         #    if newly_imported_schema_element is not None and recognized_schema_element is not None:
         #        create_merged_schema([newly_imported_schema_element, recognized_schema_element], netapi)
 
-    for candidate1 in abstraction_candidates:
-        for candidate2 in abstraction_candidates:
-            if candidate1 is not candidate2:
-                create_common_feature_abstraction(candidate1, candidate2, netapi)
+    # only pairs that share enough features to pass the abstraction threshold are tried, each of them once
+    pairs = find_abstraction_candidate_pairs(abstraction_candidates, netapi)
+    trial_steps = node.get_parameter('trial_steps')
+    if trial_steps and len(pairs) > 0:
+        # evaluate the abstractions for a few steps each and keep the best one only
+        tolerance = node.get_parameter('trial_tolerance')
+        start_abstraction_trial(node, pairs, netapi, int(trial_steps), 0.1 if tolerance is None else float(tolerance))
+        return
+    for candidate1, candidate2 in pairs:
+        create_common_feature_abstraction(candidate1, candidate2, netapi)
 
         # for every schema, check if there is sufficient overlap (what is sufficient?)
         # with any other existing schema (the most useful ones?)
@@ -373,12 +319,29 @@ def structure_abstraction_builder(netapi, node=None, sheaf='default', **params):
     # - two schemas are structurally similar, an abstraction should be offered
 
 
+def schema_compactor(netapi, node=None, sheaf='default', **params):
+
+    # a few nodes per step, so that compaction does not hold up the net
+    budget = node.get_parameter('budget')
+    if budget is None:
+        budget = 32
+    idle_steps = node.get_parameter('idle_steps')
+
+    if compact_schemas(node.parent_nodespace, netapi, int(budget), idle_steps):
+        # signal that a pass over all nodes has been completed
+        node.get_gate("done").gate_function(1)
+
+
 def signalsource(netapi, node=None, sheaf='default', **params):
-    step = node.get_parameter('step')
-    if step is None:
-        step = -1
-    step += 1
-    node.set_parameter('step', step)
+    # the steps since the source has started, counted from the nodenet step it started in. That step is set once,
+    # instead of a counter in every step, which would notify the state listeners (i.e. the journal) every step
+    start_step = node.get_parameter('start_step')
+    if start_step is None:
+        # sources saved with a step counter continue where it left off
+        step = node.get_parameter('step')
+        start_step = netapi.step - (0 if step is None else step + 1)
+        set_parameter(node, 'start_step', start_step, netapi)
+    step = netapi.step - start_step
 
     step %= 100
     step -= 50
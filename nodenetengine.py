@@ -0,0 +1,1079 @@
+__author__ = 'rvuine'
+
+# A standalone engine that runs the Pipe nets in nodenets/, with the native modules in nodetypes.json.
+#
+# This is not the runtime's engine, and does not claim to step a net exactly the way the runtime does.
+# The runtime's node and gate functions are not part of this repository, so the standard node functions below are
+# this module's own, simplified model of them: enough to run the native modules and the recognition scripts they
+# build, and documented below, so that results obtained with this engine can be read with that in mind.
+#
+# DictNodenet is the reference implementation of that model: it steps a net link by link and node by node,
+# in plain python. ArrayNodenet runs the same step on numpy arrays: activations are kept in one column per gate and
+# slot type, links are grouped by (gate type, slot type) into sparse (source row, target row, weight) arrays,
+# and the standard node functions and gate functions are computed on whole columns at once.
+# compare_engines (and tests/test_nodenetengine.py) checks that both engines agree, step by step.
+# Both engines share the node objects and the netapi the native modules are called with, so the
+# native modules see the same net whichever engine runs it. numpy is only needed for ArrayNodenet.
+#
+# ArrayNodenet pays off on larger nets only: its per-step overhead is higher than a small net's whole step.
+# Running this module as a script measures both engines on the given nets, or on nets grown with --copies:
+#   python nodenetengine.py                 the bundled nets: ArrayNodenet is faster on PalmBoulderMapleBoulder
+#                                           (248 nodes), and slower on TestSceneImport (19 nodes)
+#   python nodenetengine.py --copies 40     PalmBoulderMapleBoulder grown to 8928 nodes
+#
+# A step is:
+#   1. propagation: every slot gets the sum of weight * activation of the gates linked to it
+#   2. standard node functions, for all Pipe, Trigger, Sensor, Actor and Register nodes
+#   3. native modules, in node order; the structure they create or change is used from the next step on
+#
+# In this model, Pipe nodes compute their gates from their slots like this:
+#   sub = sub slot, if it is positive and the node has no por links or a positive por slot, else 0
+#   sur = sur slot, if sub is positive, else 0
+#   gen = gen slot + sur,  por = sur,  ret = sub,  cat = sub,  exp = sur
+# Trigger nodes wait for a condition on their sur slot while they are requested:
+#   sub = sub slot, if it is positive, else 0
+#   sur = 1 if sub is positive and the sur slot equals the node's "response" parameter (or is positive, if the node
+#   has no response), -1 if sub has been positive for "timeout" steps (default 1) without that, else 0
+#   gen = sur
+# Every gate then applies its gate function: values below the threshold become 0, the rest is multiplied
+# by the amplification and clipped to minimum/maximum. Gate parameters come from the node's gate_parameters,
+# the type's gate_defaults (in nodetypes.json, or STANDARD_NODETYPES) and GATE_PARAMETER_DEFAULTS, in that order.
+# A node's gate_parameters only hold the values that differ from its type's defaults. They are interned: nodes
+# with the same overrides (usually none) share one dict, which Node.set_gate_parameter copies before changing it.
+# Nodenet files are read and written the same way: gate parameters equal to the defaults are left out, and so
+# are the gate activations and sheaves of gates and nodes that are not active.
+# Registers use the defaults, so they only pass activation between 0 and 1; the other standard node types pass
+# activation between -100 and 100, like the gates of the native modules.
+# Native modules set their gates anew in every step, gates they do not set are 0.
+#
+# The node activation of all nodes with a gen gate is the activation of that gate.
+#
+# get_nodes_active does not scan the net: DictNodenet keeps the rows with a positive activation per gate type
+# as the gate functions set them, ArrayNodenet compares the gate column of the rows of the requested type at once.
+# Native modules can also be told when a node's gate crosses an activation threshold instead of polling it
+# (NodenetAPI.watch_activation). Crossings are checked once per step, after the standard node functions,
+# so a native module sees the same activations it would have seen polling.
+
+import json
+import logging
+import os
+import random
+import sys
+import time
+import uuid
+
+import nodefunctions
+from nettools import seed_random
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# gates that pass values in the range the native modules use, i.e. fovea positions and inhibition
+_WIDE_GATE = {"minimum": -100, "maximum": 100, "threshold": -100}
+
+STANDARD_NODETYPES = {
+    "Pipe": {
+        "slottypes": ["gen", "por", "ret", "sub", "sur", "cat", "exp"],
+        "gatetypes": ["gen", "por", "ret", "sub", "sur", "cat", "exp"],
+        "gate_defaults": dict((gate_type, _WIDE_GATE) for gate_type in ["gen", "por", "ret", "sub", "sur", "cat", "exp"])
+    },
+    "Sensor": {"slottypes": [], "gatetypes": ["gen"], "gate_defaults": {"gen": _WIDE_GATE}},
+    "Actor": {"slottypes": ["gen"], "gatetypes": ["gen"], "gate_defaults": {"gen": _WIDE_GATE}},
+    "Register": {"slottypes": ["gen"], "gatetypes": ["gen"]},
+    "Trigger": {
+        "slottypes": ["gen", "sub", "sur"],
+        "gatetypes": ["gen", "sub", "sur"],
+        "gate_defaults": dict((gate_type, _WIDE_GATE) for gate_type in ["gen", "sub", "sur"])
+    },
+}
+
+# node parameters the standard node functions use, mirrored into columns
+PARAMETER_COLUMNS = {"response": float("nan"), "timeout": 1.0}
+
+GATE_PARAMETER_DEFAULTS = {"amplification": 1.0, "minimum": -1.0, "maximum": 1.0, "threshold": 0.0}
+
+# the gate parameters of the runtime this engine does not use, with their defaults, so files saved by the runtime
+# do not carry them as overrides
+UNUSED_GATE_PARAMETER_DEFAULTS = {"certainty": 1.0, "decay": 0.0, "rho": 0.0, "spreadsheaves": 0, "theta": 0.0}
+
+# the gate parameters of nodes without overrides, shared by all of them and never changed
+_NO_GATE_PARAMETERS = {}
+
+# the links of gates and slots that have none, shared by all of them until create_link gives them a list
+_NO_LINKS = ()
+
+RECIPROCAL_LINKTYPES = {
+    "subsur": ("sub", "sur"),
+    "porret": ("por", "ret"),
+    "catexp": ("cat", "exp"),
+}
+
+
+def load_nodetypes(path=None):
+    """
+    Returns the native module definitions from nodetypes.json
+    """
+    if path is None:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "nodetypes.json")
+    with open(path) as file:
+        return json.load(file)
+
+
+class WorldAdapter(object):
+    """
+    The datasources and datatargets of an agent, as plain values set by whoever simulates the world
+    """
+
+    # the lag contract: the datasources a nodenet step reads reflect the datatargets written sensor_lag + 1 steps
+    # before it. 0 for worlds updated between two nodenet steps, 1 for worlds updated while the nodenet steps
+    # (see experimentrunner). Native modules read the datasources through sensors, so all of them see the same lag,
+    # and the sensors, actors and link delays of the nodenet add their own steps on top. Native modules that wait
+    # for the effect of their datatargets have to wait sensor_lag steps longer; the native modules here do not wait
+    sensor_lag = 0
+
+    def __init__(self, datasources=(), datatargets=()):
+        self.datasources = dict((key, 0.0) for key in datasources)
+        self.datatargets = dict((key, 0.0) for key in datatargets)
+        # the values the nodenet reads instead of the datasources while they are replayed, see replay_datasources
+        self.replayed_datasources = None
+
+    @classmethod
+    def from_world(cls, world_data, worldadapter):
+        """
+        Creates a world adapter with the datasources and datatargets declared in a world file
+        """
+        declaration = world_data["worldadapters"][worldadapter]
+        return cls(declaration["datasources"], declaration["datatargets"])
+
+    def get_available_datasources(self):
+        return list(self.datasources)
+
+    def get_available_datatargets(self):
+        return list(self.datatargets)
+
+    def get_datasource(self, key):
+        if self.replayed_datasources is not None and key in self.replayed_datasources:
+            return self.replayed_datasources[key]
+        return self.datasources.get(key, 0.0)
+
+    def replay_datasources(self, values):
+        """
+        Makes the nodenet read the given datasource values instead of the ones the world sets, i.e. to evaluate
+        alternatives on the same inputs. The world keeps being updated.
+        :param values: a dict of datasource keys to values, None to read the world's values again
+        """
+        self.replayed_datasources = values
+
+    def add_to_datatarget(self, key, value):
+        if key in self.datatargets:
+            self.datatargets[key] += value
+
+    def reset_datatargets(self):
+        for key in self.datatargets:
+            self.datatargets[key] = 0.0
+
+
+class Link(object):
+
+    def __init__(self, source_node, source_gate, target_node, target_slot, weight=1, certainty=1):
+        self.source_node = source_node
+        self.source_gate = source_gate
+        self.target_node = target_node
+        self.target_slot = target_slot
+        self.weight = weight
+        self.certainty = certainty
+        self.uid = "%s:%s:%s:%s" % (source_node.uid, source_gate.type, target_slot.type, target_node.uid)
+
+
+class Gate(object):
+    __slots__ = ("node", "type", "links")
+
+    def __init__(self, node, type):
+        self.node = node
+        self.type = type
+        self.links = _NO_LINKS
+
+    @property
+    def activation(self):
+        return self.node.nodenet.gate_activations[self.type][self.node.index]
+
+    def get_activation(self, sheaf="default"):
+        return self.activation
+
+    def gate_function(self, input_activation, sheaf="default"):
+        self.node.nodenet.set_gate_activation(self.type, self.node.index, input_activation)
+
+    def get_links(self):
+        return list(self.links)
+
+    @property
+    def empty(self):
+        return len(self.links) == 0
+
+
+class Slot(object):
+    __slots__ = ("node", "type", "links")
+
+    def __init__(self, node, type):
+        self.node = node
+        self.type = type
+        self.links = _NO_LINKS
+
+    @property
+    def activation(self):
+        return self.node.nodenet.slot_activations[self.type][self.node.index]
+
+    def get_activation(self, sheaf="default"):
+        return self.activation
+
+    def get_links(self):
+        return list(self.links)
+
+    @property
+    def empty(self):
+        return len(self.links) == 0
+
+
+class Node(object):
+
+    def __init__(self, nodenet, uid, type, name, parent_nodespace, index, nodetype):
+        self.nodenet = nodenet
+        self.uid = uid
+        self.type = type
+        self.name = name
+        self.parent_nodespace = parent_nodespace
+        self.index = index
+        self.position = [0, 0]
+        self.state = {}
+        self.parameters = {}
+        self.gate_parameters = _NO_GATE_PARAMETERS
+        self.gates = dict((gate_type, Gate(self, gate_type)) for gate_type in nodetype["gatetypes"])
+        self.slots = dict((slot_type, Slot(self, slot_type)) for slot_type in nodetype["slottypes"])
+        # shared with the node type, never changed
+        self.gate_types = nodetype["gatetypes"]
+        self.slot_types = nodetype["slottypes"]
+
+    @property
+    def activation(self):
+        if "gen" in self.gates:
+            return self.gates["gen"].activation
+        return 0.0
+
+    def get_gate(self, type):
+        return self.gates.get(type)
+
+    def get_slot(self, type):
+        return self.slots.get(type)
+
+    def get_gate_types(self):
+        return list(self.gate_types)
+
+    def get_slot_types(self):
+        return list(self.slot_types)
+
+    def get_state(self, key):
+        return self.state.get(key)
+
+    def set_state(self, key, value):
+        self.state[key] = value
+
+    def get_parameter(self, key):
+        return self.parameters.get(key)
+
+    def set_parameter(self, key, value):
+        self.parameters[key] = value
+        if key in PARAMETER_COLUMNS:
+            self.nodenet.parameter_columns[key][self.index] = PARAMETER_COLUMNS[key] if value is None else float(value)
+
+    def get_gate_parameters(self):
+        """
+        Returns the parameters of all gates of the node, the defaults of its type included
+        """
+        defaults = self.nodenet.get_gate_parameter_defaults(self.type)
+        return dict((gate_type, dict(defaults[gate_type], **self.gate_parameters.get(gate_type, {})))
+                    for gate_type in self.gate_types)
+
+    def set_gate_parameter(self, gate_type, parameter, value):
+        """
+        Sets a parameter of a gate of the node, None resets it to the default of the node's type
+        """
+        overrides = dict(self.gate_parameters.get(gate_type, {}))
+        overrides[parameter] = value
+        # copy on write, the dict may be shared with other nodes
+        gate_parameters = dict(self.gate_parameters)
+        gate_parameters[gate_type] = overrides
+        self.gate_parameters = self.nodenet.intern_gate_parameters(self.type, gate_parameters)
+        self.nodenet._set_gate_parameters(self)
+
+    def __repr__(self):
+        return "<%s %s>" % (self.type, self.name)
+
+
+class NodenetAPI(object):
+    """
+    The netapi the native modules are called with: the subset of the runtime's netapi used in this repository
+    """
+
+    def __init__(self, nodenet):
+        self.nodenet = nodenet
+        self.logger = logging.getLogger("nodenet")
+
+    @property
+    def uid(self):
+        return self.nodenet.uid
+
+    @property
+    def step(self):
+        return self.nodenet.current_step
+
+    @property
+    def world(self):
+        return self.nodenet.world_adapter
+
+    def get_node(self, uid):
+        return self.nodenet.nodes[uid]
+
+    def get_nodes(self, nodespace=None, node_name_prefix=None):
+        return [node for node in self.nodenet.nodes.values()
+                if (nodespace is None or node.parent_nodespace == nodespace) and
+                (node_name_prefix is None or node.name.startswith(node_name_prefix))]
+
+    def get_nodes_in_gate_field(self, node, gate=None, no_links_to=None, nodespace=None):
+        nodes = []
+        for link in node.get_gate(gate).links:
+            candidate = link.target_node
+            if nodespace is not None and candidate.parent_nodespace != nodespace:
+                continue
+            if no_links_to and any(candidate.get_gate(gate_type) is not None and
+                                   not candidate.get_gate(gate_type).empty for gate_type in no_links_to):
+                continue
+            if candidate not in nodes:
+                nodes.append(candidate)
+        return nodes
+
+    def get_nodes_in_slot_field(self, node, slot=None, no_links=None, nodespace=None):
+        nodes = []
+        for link in node.get_slot(slot).links:
+            candidate = link.source_node
+            if nodespace is not None and candidate.parent_nodespace != nodespace:
+                continue
+            if no_links and any(candidate.get_slot(slot_type) is not None and
+                                not candidate.get_slot(slot_type).empty for slot_type in no_links):
+                continue
+            if candidate not in nodes:
+                nodes.append(candidate)
+        return nodes
+
+    def get_nodes_active(self, nodespace, type=None, min_activation=1, gate=None, sheaf="default"):
+        rows = self.nodenet.rows
+        return [rows[row] for row in self.nodenet.get_active_rows(type, gate, min_activation)
+                if rows[row].parent_nodespace == nodespace]
+
+    def watch_activation(self, node, threshold, callback, gate="gen"):
+        """
+        Calls callback(node, above) whenever the activation of the node's gate crosses the threshold,
+        above being True if it is now above the threshold
+        :return: True if the activation is above the threshold now
+        """
+        return self.nodenet.watch_activation(node, gate, threshold, callback)
+
+    def unwatch_activation(self, node, callback, gate="gen"):
+        self.nodenet.unwatch_activation(node, gate, callback)
+
+    def create_node(self, type, nodespace, name=None):
+        return self.nodenet.create_node(type, nodespace, name)
+
+    def delete_node(self, node):
+        self.nodenet.delete_node(node)
+
+    def link(self, source_node, source_gate, target_node, target_slot, weight=1, certainty=1):
+        self.nodenet.create_link(source_node, source_gate, target_node, target_slot, weight, certainty)
+
+    def link_with_reciprocal(self, source_node, target_node, linktype, weight=1, certainty=1):
+        forward, backward = RECIPROCAL_LINKTYPES[linktype]
+        self.link(source_node, forward, target_node, forward, weight, certainty)
+        self.link(target_node, backward, source_node, backward, weight, certainty)
+
+    def link_full(self, nodes, linktype="porret", weight=1, certainty=1):
+        for source_node in nodes:
+            for target_node in nodes:
+                if source_node is not target_node:
+                    self.link_with_reciprocal(source_node, target_node, linktype, weight, certainty)
+
+    def link_actor(self, node, datatarget, weight=1, certainty=1, gate="sub", slot="sur"):
+        actor = self._find_interface_node(node.parent_nodespace, "Actor", "datatarget", datatarget)
+        if actor is None:
+            actor = self.create_node("Actor", node.parent_nodespace, datatarget)
+            actor.set_parameter("datatarget", datatarget)
+        self.link(node, gate, actor, "gen", weight, certainty)
+
+    def link_sensor(self, node, datasource, slot="sur"):
+        sensor = self._find_interface_node(node.parent_nodespace, "Sensor", "datasource", datasource)
+        if sensor is None:
+            sensor = self.create_node("Sensor", node.parent_nodespace, datasource)
+            sensor.set_parameter("datasource", datasource)
+        self.link(sensor, "gen", node, slot)
+
+    def _find_interface_node(self, nodespace, type, parameter, value):
+        for node in self.nodenet.nodes.values():
+            if node.type == type and node.parent_nodespace == nodespace and node.get_parameter(parameter) == value:
+                return node
+        return None
+
+    def import_sensors(self, nodespace, datasource_prefix=None):
+        self._import_interface_nodes(nodespace, "Sensor", "datasource",
+                                     self.world.get_available_datasources(), datasource_prefix)
+
+    def import_actors(self, nodespace, datatarget_prefix=None):
+        self._import_interface_nodes(nodespace, "Actor", "datatarget",
+                                     self.world.get_available_datatargets(), datatarget_prefix)
+
+    def _import_interface_nodes(self, nodespace, type, parameter, keys, prefix):
+        existing = set(node.get_parameter(parameter) for node in self.nodenet.nodes.values()
+                       if node.type == type and node.parent_nodespace == nodespace)
+        for key in keys:
+            if key not in existing and (prefix is None or key.startswith(prefix)):
+                self.create_node(type, nodespace, key).set_parameter(parameter, key)
+
+    def unlink(self, node, gate=None, target_node=None, target_slot=None):
+        for gate_type in node.get_gate_types():
+            if gate is None or gate_type == gate:
+                for link in node.get_gate(gate_type).get_links():
+                    if (target_node is None or link.target_node is target_node) and \
+                            (target_slot is None or link.target_slot.type == target_slot):
+                        self.nodenet.delete_link(link)
+
+    def unlink_direction(self, node, gateslot=None):
+        self.unlink(node, gateslot)
+        for slot_type in node.get_slot_types():
+            if gateslot is None or slot_type == gateslot:
+                for link in node.get_slot(slot_type).get_links():
+                    self.nodenet.delete_link(link)
+
+    def is_locked(self, lock):
+        return lock in self.nodenet.locks
+
+    def lock(self, lock):
+        self.nodenet.locks.add(lock)
+
+    def unlock(self, lock):
+        self.nodenet.locks.discard(lock)
+
+
+class DictNodenet(object):
+    """
+    A nodenet stepped link by link and node by node, in plain python
+    """
+
+    def __init__(self, nodenet_data=None, world_adapter=None, nodetypes=None, uid_generator=None):
+        """
+        :param nodenet_data: the nodenet as loaded from its json file
+        :param world_adapter: a WorldAdapter, or None for a world without datasources and datatargets
+        :param nodetypes: the native module definitions, defaults to the ones in nodetypes.json
+        :param uid_generator: a function returning the uids of new nodes, defaults to random uuids
+        """
+        self.data = dict(nodenet_data or {})
+        self.uid = self.data.get("uid")
+        self.current_step = self.data.get("current_step", 0)
+        self.world_adapter = world_adapter or WorldAdapter()
+        self.nodetypes = dict(STANDARD_NODETYPES)
+        self.nodetypes.update(load_nodetypes() if nodetypes is None else nodetypes)
+        self.uid_generator = uid_generator or (lambda: str(uuid.uuid4()))
+        self.nodes = {}
+        self.rows = []
+        self.rows_by_type = {}
+        self.link_groups = {}
+        self.locks = set()
+        self.monitors = dict(self.data.get("monitors") or {})
+        # rows with a positive activation, per gate type
+        self.positive_rows = {}
+        # (node uid, gate type, callback) to [threshold, above] for the activation watches of native modules
+        self.activation_watches = {}
+        # a NodenetProfiler the native modules are called through while profiling, see nodenetprofiler
+        self.profiler = None
+        self.capacity = 0
+        self.gate_activations = {}
+        self.slot_activations = {}
+        self.gate_parameters = {}
+        # per node type, the defaults of the parameters of every gate, and the interned gate parameter overrides
+        self.gate_parameter_defaults = {}
+        self.interned_gate_parameters = {}
+        self.parameter_columns = {}
+        self.trigger_countdowns = []
+        self.netapi = NodenetAPI(self)
+        self._grow(max(16, len(self.data.get("nodes", {}))))
+        for node_data in sorted(self.data.get("nodes", {}).values(), key=lambda node_data: node_data.get("index", 0)):
+            self._load_node(node_data)
+        for link_data in self.data.get("links", {}).values():
+            self.create_link(self.nodes[link_data["source_node_uid"]], link_data["source_gate_name"],
+                             self.nodes[link_data["target_node_uid"]], link_data["target_slot_name"],
+                             link_data["weight"], link_data["certainty"])
+
+    # columns: one value per row, rows being the nodes in the order they were created.
+    # this engine keeps them in lists, ArrayNodenet in numpy arrays
+
+    def _new_column(self, size):
+        return [0.0] * size
+
+    def _resize_column(self, column, size):
+        return column + [0.0] * (size - len(column))
+
+    def _grow(self, capacity):
+        size = self.capacity
+        self.capacity = capacity
+        for columns in [self.gate_activations, self.slot_activations] + list(self.gate_parameters.values()):
+            for key in columns:
+                columns[key] = self._resize_column(columns[key], capacity)
+        for key, default in PARAMETER_COLUMNS.items():
+            column = self._resize_column(self.parameter_columns.get(key, self._new_column(0)), capacity)
+            column[size:] = [default] * (capacity - size)
+            self.parameter_columns[key] = column
+        self.trigger_countdowns = self._resize_column(self.trigger_countdowns, capacity)
+
+    def _ensure_columns(self, node):
+        for gate_type in node.gate_types:
+            if gate_type not in self.gate_activations:
+                self.positive_rows[gate_type] = set()
+                self.gate_activations[gate_type] = self._new_column(self.capacity)
+                self.gate_parameters[gate_type] = dict(
+                    (parameter, self._new_column(self.capacity)) for parameter in GATE_PARAMETER_DEFAULTS)
+        for slot_type in node.slot_types:
+            if slot_type not in self.slot_activations:
+                self.slot_activations[slot_type] = self._new_column(self.capacity)
+
+    # structure
+
+    def _add_node(self, uid, type, name, nodespace):
+        if type not in self.nodetypes:
+            raise ValueError("Unsupported node type %s" % type)
+        if len(self.rows) == self.capacity:
+            self._grow(self.capacity * 2)
+        node = Node(self, uid, type, name, nodespace, len(self.rows), self.nodetypes[type])
+        self.nodes[uid] = node
+        self.rows.append(node)
+        self.rows_by_type.setdefault(type, []).append(node.index)
+        self._ensure_columns(node)
+        return node
+
+    def get_gate_parameter_defaults(self, type):
+        """
+        Returns the parameters of the gates of nodes of the given type that do not override them
+        """
+        if type not in self.gate_parameter_defaults:
+            gate_defaults = self.nodetypes[type].get("gate_defaults", {})
+            self.gate_parameter_defaults[type] = {}
+            for gate_type in self.nodetypes[type]["gatetypes"]:
+                parameters = dict(UNUSED_GATE_PARAMETER_DEFAULTS)
+                parameters.update(GATE_PARAMETER_DEFAULTS)
+                parameters.update(gate_defaults.get(gate_type, {}))
+                # the column values are converted once, so the columns of all nodes refer to the same floats
+                for parameter in GATE_PARAMETER_DEFAULTS:
+                    parameters[parameter] = float(parameters[parameter])
+                self.gate_parameter_defaults[type][gate_type] = parameters
+        return self.gate_parameter_defaults[type]
+
+    def intern_gate_parameters(self, type, gate_parameters):
+        """
+        Returns the overrides of the given gate parameters for a node of the given type: the parameters that differ
+        from the defaults of the type, as a dict shared with all nodes with the same overrides. Do not change it.
+        """
+        if not gate_parameters:
+            return _NO_GATE_PARAMETERS
+        defaults = self.get_gate_parameter_defaults(type)
+        overrides = {}
+        for gate_type, parameters in gate_parameters.items():
+            gate_defaults = defaults.get(gate_type, {})
+            gate_overrides = dict((parameter, value) for parameter, value in (parameters or {}).items()
+                                  if value is not None and (parameter not in gate_defaults or
+                                                            value != gate_defaults[parameter]))
+            if len(gate_overrides) > 0:
+                overrides[gate_type] = gate_overrides
+        if len(overrides) == 0:
+            return _NO_GATE_PARAMETERS
+        key = (type, json.dumps(overrides, sort_keys=True))
+        return self.interned_gate_parameters.setdefault(key, overrides)
+
+    def _set_gate_parameters(self, node):
+        defaults = self.get_gate_parameter_defaults(node.type)
+        for gate_type in node.gate_types:
+            parameters = defaults[gate_type]
+            overrides = node.gate_parameters.get(gate_type)
+            for parameter, column in self.gate_parameters[gate_type].items():
+                if overrides is None or parameter not in overrides:
+                    column[node.index] = parameters[parameter]
+                else:
+                    column[node.index] = float(overrides[parameter])
+
+    def _load_node(self, node_data):
+        node = self._add_node(node_data["uid"], node_data["type"], node_data["name"], node_data["parent_nodespace"])
+        node.position = list(node_data.get("position", [0, 0]))
+        node.state = dict(node_data.get("state") or {})
+        for key, value in (node_data.get("parameters") or {}).items():
+            node.set_parameter(key, value)
+        node.gate_parameters = self.intern_gate_parameters(node.type, node_data.get("gate_parameters"))
+        self._set_gate_parameters(node)
+        for gate_type, sheaves in (node_data.get("gate_activations") or {}).items():
+            if gate_type in node.gates and "default" in sheaves:
+                self._write_gate_activation(gate_type, node.index, float(sheaves["default"]["activation"]))
+        return node
+
+    def create_node(self, type, nodespace, name=None):
+        node = self._add_node(self.uid_generator(), type, name or "", nodespace)
+        self._set_gate_parameters(node)
+        return node
+
+    def delete_node(self, node):
+        for gate in node.gates.values():
+            for link in list(gate.links):
+                self.delete_link(link)
+        for slot in node.slots.values():
+            for link in list(slot.links):
+                self.delete_link(link)
+        for gate_type in node.gate_types:
+            self._write_gate_activation(gate_type, node.index, 0.0)
+        for slot_type in node.slot_types:
+            self.slot_activations[slot_type][node.index] = 0.0
+        for key in [key for key in self.activation_watches if key[0] == node.uid]:
+            del self.activation_watches[key]
+        # rows are not reused, a deleted node's row stays empty
+        for key, default in PARAMETER_COLUMNS.items():
+            self.parameter_columns[key][node.index] = default
+        self.rows[node.index] = None
+        self.rows_by_type[node.type].remove(node.index)
+        del self.nodes[node.uid]
+
+    def create_link(self, source_node, source_gate, target_node, target_slot, weight=1, certainty=1):
+        for link in source_node.get_gate(source_gate).links:
+            if link.target_node is target_node and link.target_slot.type == target_slot:
+                link.weight = weight
+                link.certainty = certainty
+                self._link_group_changed((source_gate, target_slot))
+                return link
+        link = Link(source_node, source_node.get_gate(source_gate), target_node, target_node.get_slot(target_slot),
+                    weight, certainty)
+        for links_owner in (link.source_gate, link.target_slot):
+            if len(links_owner.links) == 0:
+                links_owner.links = [link]
+            else:
+                links_owner.links.append(link)
+        self.link_groups.setdefault((source_gate, target_slot), {})[link.uid] = link
+        self._link_group_changed((source_gate, target_slot))
+        return link
+
+    def delete_link(self, link):
+        link.source_gate.links.remove(link)
+        link.target_slot.links.remove(link)
+        del self.link_groups[(link.source_gate.type, link.target_slot.type)][link.uid]
+        self._link_group_changed((link.source_gate.type, link.target_slot.type))
+
+    def _link_group_changed(self, key):
+        pass
+
+    # stepping
+
+    def set_gate_activation(self, gate_type, row, value):
+        # the gate function
+        parameters = self.gate_parameters[gate_type]
+        if value < parameters["threshold"][row]:
+            value = 0.0
+        value = min(max(value * parameters["amplification"][row], parameters["minimum"][row]),
+                    parameters["maximum"][row])
+        # inlined _write_gate_activation, this is called for every gate in every step
+        self.gate_activations[gate_type][row] = value
+        if value > 0:
+            self.positive_rows[gate_type].add(row)
+        else:
+            self.positive_rows[gate_type].discard(row)
+
+    def _write_gate_activation(self, gate_type, row, value):
+        self.gate_activations[gate_type][row] = value
+        if value > 0:
+            self.positive_rows[gate_type].add(row)
+        else:
+            self.positive_rows[gate_type].discard(row)
+
+    def step(self):
+        self.propagate_link_activation()
+        self.world_adapter.reset_datatargets()
+        self.calculate_standard_node_functions()
+        self.check_activation_watches()
+        self.calculate_native_node_functions()
+        self.current_step += 1
+
+    # activation queries
+
+    def get_active_rows(self, type=None, gate=None, min_activation=1):
+        """
+        Returns the rows of the nodes of the given type (or of all types) whose gate (or node activation)
+        is at least min_activation, in row order
+        """
+        gate_type = gate or "gen"
+        column = self.gate_activations.get(gate_type)
+        if min_activation <= 0:
+            # inactive nodes qualify as well, so all nodes of the type have to be looked at.
+            # nodes without the gate are left out, unless the node activation was asked for: theirs is 0
+            if type is None:
+                rows = [row for row, node in enumerate(self.rows) if node is not None]
+            else:
+                rows = self.rows_by_type.get(type, [])
+            return [row for row in rows if (column[row] >= min_activation if gate_type in self.rows[row].gates
+                                             else gate is None)]
+        return sorted(row for row in self.positive_rows.get(gate_type, ())
+                      if column[row] >= min_activation and (type is None or self.rows[row].type == type))
+
+    def watch_activation(self, node, gate_type, threshold, callback):
+        above = bool(node.gates[gate_type].activation > threshold)
+        self.activation_watches[(node.uid, gate_type, callback)] = [threshold, above]
+        return above
+
+    def unwatch_activation(self, node, gate_type, callback):
+        self.activation_watches.pop((node.uid, gate_type, callback), None)
+
+    def check_activation_watches(self):
+        crossings = []
+        for (uid, gate_type, callback), watch in self.activation_watches.items():
+            above = self.gate_activations[gate_type][self.nodes[uid].index] > watch[0]
+            if above != watch[1]:
+                watch[1] = above
+                crossings.append((callback, self.nodes[uid], above))
+        # callbacks may watch and unwatch nodes
+        for callback, node, above in crossings:
+            callback(node, bool(above))
+
+    def propagate_link_activation(self):
+        gates = self.gate_activations
+        for node in self.rows:
+            if node is None:
+                continue
+            for slot_type, slot in node.slots.items():
+                activation = 0.0
+                for link in slot.links:
+                    activation += link.weight * gates[link.source_gate.type][link.source_node.index]
+                self.slot_activations[slot_type][node.index] = activation
+
+    def calculate_standard_node_functions(self):
+        slots = self.slot_activations
+        for row in self.rows_by_type.get("Pipe", []):
+            node = self.rows[row]
+            sub = slots["sub"][row]
+            if sub <= 0 or (not node.slots["por"].empty and slots["por"][row] <= 0):
+                sub = 0.0
+            sur = slots["sur"][row] if sub > 0 else 0.0
+            for gate_type, value in (("gen", slots["gen"][row] + sur), ("por", sur), ("ret", sub), ("sub", sub),
+                                     ("sur", sur), ("cat", sub), ("exp", sur)):
+                self.set_gate_activation(gate_type, row, value)
+        for row in self.rows_by_type.get("Trigger", []):
+            sub = slots["sub"][row] if slots["sub"][row] > 0 else 0.0
+            response = self.parameter_columns["response"][row]
+            if response != response:
+                # nan, the node has no response
+                met = slots["sur"][row] > 0
+            else:
+                met = abs(slots["sur"][row] - response) < 1e-9
+            if sub <= 0:
+                self.trigger_countdowns[row] = self.parameter_columns["timeout"][row]
+                sur = 0.0
+            elif met:
+                sur = 1.0
+            else:
+                self.trigger_countdowns[row] -= 1
+                sur = -1.0 if self.trigger_countdowns[row] <= 0 else 0.0
+            for gate_type, value in (("gen", sur), ("sub", sub), ("sur", sur)):
+                self.set_gate_activation(gate_type, row, value)
+        for row in self.rows_by_type.get("Sensor", []):
+            datasource = self.rows[row].get_parameter("datasource")
+            self.set_gate_activation("gen", row, self.world_adapter.get_datasource(datasource))
+        for row in self.rows_by_type.get("Actor", []):
+            self.world_adapter.add_to_datatarget(self.rows[row].get_parameter("datatarget"), slots["gen"][row])
+            self.set_gate_activation("gen", row, slots["gen"][row])
+        for row in self.rows_by_type.get("Register", []):
+            self.set_gate_activation("gen", row, slots["gen"][row])
+
+    def calculate_native_node_functions(self):
+        native_nodes = [node for node in self.rows if node is not None and node.type not in STANDARD_NODETYPES]
+        for node in native_nodes:
+            if node.uid in self.nodes:
+                for gate_type in node.gate_types:
+                    self._write_gate_activation(gate_type, node.index, 0.0)
+                nodefunction = getattr(nodefunctions, self.nodetypes[node.type]["nodefunction_name"])
+                if self.profiler is not None:
+                    self.profiler.call(nodefunction, node)
+                else:
+                    nodefunction(self.netapi, node=node, sheaf="default", **node.parameters)
+
+    def get_data(self):
+        """
+        Returns the nodenet in the format of the nodenet json files
+        """
+        data = dict(self.data)
+        data["current_step"] = self.current_step
+        data["monitors"] = self.monitors
+        data["nodes"] = {}
+        data["links"] = {}
+        for node in self.rows:
+            if node is None:
+                continue
+            node_data = data["nodes"][node.uid] = {
+                "activation": float(node.activation),
+                "gate_activations": dict(
+                    (gate_type, {"default": {"activation": float(node.gates[gate_type].activation),
+                                             "name": "default", "uid": "default"}}) for gate_type in node.gate_types
+                    if node.gates[gate_type].activation != 0),
+                "gate_parameters": node.gate_parameters,
+                "index": node.index,
+                "name": node.name,
+                "parameters": node.parameters,
+                "parent_nodespace": node.parent_nodespace,
+                "position": node.position,
+                "state": node.state,
+                "type": node.type,
+                "uid": node.uid
+            }
+            if node_data["activation"] != 0:
+                node_data["sheaves"] = {"default": {"activation": node_data["activation"], "name": "default",
+                                                    "uid": "default"}}
+        for group in self.link_groups.values():
+            for link in group.values():
+                data["links"][link.uid] = {
+                    "certainty": link.certainty,
+                    "source_gate_name": link.source_gate.type,
+                    "source_node_uid": link.source_node.uid,
+                    "target_node_uid": link.target_node.uid,
+                    "target_slot_name": link.target_slot.type,
+                    "uid": link.uid,
+                    "weight": link.weight
+                }
+        return data
+
+
+class ArrayNodenet(DictNodenet):
+    """
+    A nodenet stepped on numpy arrays. Behaves exactly like DictNodenet, up to floating point rounding.
+    """
+
+    def __init__(self, nodenet_data=None, world_adapter=None, nodetypes=None, uid_generator=None):
+        if np is None:
+            raise ImportError("ArrayNodenet needs numpy")
+        # (source rows, target rows, weights) of the link groups, rebuilt when a group has changed
+        self.link_arrays = {}
+        self.changed_link_groups = set()
+        self.has_por_links = None
+        # the rows of each node type as an array, rebuilt when nodes of the type have been added or deleted
+        self.type_row_arrays = {}
+        DictNodenet.__init__(self, nodenet_data, world_adapter, nodetypes, uid_generator)
+
+    def _new_column(self, size):
+        return np.zeros(size)
+
+    def _add_node(self, uid, type, name, nodespace):
+        self.type_row_arrays.pop(type, None)
+        return DictNodenet._add_node(self, uid, type, name, nodespace)
+
+    def delete_node(self, node):
+        self.type_row_arrays.pop(node.type, None)
+        DictNodenet.delete_node(self, node)
+
+    def get_active_rows(self, type=None, gate=None, min_activation=1):
+        # the positive rows are not kept for the columns set at once, the gate column is compared instead
+        if min_activation <= 0:
+            return DictNodenet.get_active_rows(self, type, gate, min_activation)
+        column = self.gate_activations.get(gate or "gen")
+        if column is None:
+            return []
+        if type is None:
+            return np.flatnonzero(column >= min_activation).tolist()
+        if type not in self.type_row_arrays:
+            self.type_row_arrays[type] = np.array(self.rows_by_type.get(type, []), dtype=np.intp)
+        rows = self.type_row_arrays[type]
+        return rows[column[rows] >= min_activation].tolist()
+
+    def _resize_column(self, column, size):
+        resized = np.zeros(size)
+        resized[:len(column)] = column
+        return resized
+
+    def _link_group_changed(self, key):
+        self.changed_link_groups.add(key)
+
+    def _update_link_arrays(self):
+        for key in self.changed_link_groups:
+            links = list(self.link_groups.get(key, {}).values())
+            if len(links) == 0:
+                self.link_arrays.pop(key, None)
+                continue
+            self.link_arrays[key] = (
+                np.array([link.source_node.index for link in links], dtype=np.intp),
+                np.array([link.target_node.index for link in links], dtype=np.intp),
+                np.array([link.weight for link in links], dtype=float))
+        self.changed_link_groups = set()
+        self.has_por_links = np.zeros(self.capacity, dtype=bool)
+        for (gate_type, slot_type), (sources, targets, weights) in self.link_arrays.items():
+            if slot_type == "por":
+                self.has_por_links[targets] = True
+
+    def propagate_link_activation(self):
+        if self.changed_link_groups or self.has_por_links is None or len(self.has_por_links) != self.capacity:
+            self._update_link_arrays()
+        for slot_type in self.slot_activations:
+            self.slot_activations[slot_type] = np.zeros(self.capacity)
+        for (gate_type, slot_type), (sources, targets, weights) in self.link_arrays.items():
+            self.slot_activations[slot_type] += np.bincount(
+                targets, weights=weights * self.gate_activations[gate_type][sources], minlength=self.capacity)
+
+    def calculate_standard_node_functions(self):
+        calculate_array_node_functions(self, self.rows_by_type)
+        self.calculate_interface_node_functions()
+
+    def calculate_interface_node_functions(self):
+        # the Sensor and Actor nodes, which read from and write to the world adapter
+        rows = self.rows_by_type.get("Sensor", [])
+        if len(rows) > 0:
+            values = [self.world_adapter.get_datasource(self.rows[row].get_parameter("datasource")) for row in rows]
+            _set_gate_activations(self, "gen", np.array(rows, dtype=np.intp), np.array(values, dtype=float))
+        rows = self.rows_by_type.get("Actor", [])
+        if len(rows) > 0:
+            for row in rows:
+                self.world_adapter.add_to_datatarget(self.rows[row].get_parameter("datatarget"),
+                                                     float(self.slot_activations["gen"][row]))
+            rows = np.array(rows, dtype=np.intp)
+            _set_gate_activations(self, "gen", rows, self.slot_activations["gen"][rows])
+
+
+def _set_gate_activations(columns, gate_type, rows, values):
+    # the gate function, for many rows at once
+    parameters = columns.gate_parameters[gate_type]
+    values = np.where(values < parameters["threshold"][rows], 0.0, values) * parameters["amplification"][rows]
+    columns.gate_activations[gate_type][rows] = np.clip(values, parameters["minimum"][rows],
+                                                        parameters["maximum"][rows])
+
+
+def calculate_array_node_functions(columns, rows_by_type):
+    """
+    Computes the Pipe, Trigger and Register node functions on whole columns, the way ArrayNodenet does
+    :param columns: the ArrayNodenet, or anything with the same columns (see nodenetshards)
+    :param rows_by_type: the rows to compute, per node type
+    """
+    slots = columns.slot_activations
+    rows = np.asarray(rows_by_type.get("Pipe", []), dtype=np.intp)
+    if len(rows) > 0:
+        sub = slots["sub"][rows]
+        sub = np.where((sub > 0) & ((columns.has_por_links[rows] == 0) | (slots["por"][rows] > 0)), sub, 0.0)
+        sur = np.where(sub > 0, slots["sur"][rows], 0.0)
+        for gate_type, values in (("gen", slots["gen"][rows] + sur), ("por", sur), ("ret", sub), ("sub", sub),
+                                  ("sur", sur), ("cat", sub), ("exp", sur)):
+            _set_gate_activations(columns, gate_type, rows, values)
+    rows = np.asarray(rows_by_type.get("Trigger", []), dtype=np.intp)
+    if len(rows) > 0:
+        sub = np.maximum(slots["sub"][rows], 0.0)
+        response = columns.parameter_columns["response"][rows]
+        sur = slots["sur"][rows]
+        met = np.where(np.isnan(response), sur > 0, np.abs(sur - response) < 1e-9)
+        requested = sub > 0
+        countdowns = np.where(requested & ~met, columns.trigger_countdowns[rows] - 1,
+                              columns.trigger_countdowns[rows])
+        countdowns = np.where(requested, countdowns, columns.parameter_columns["timeout"][rows])
+        columns.trigger_countdowns[rows] = countdowns
+        sur = np.where(requested, np.where(met, 1.0, np.where(countdowns <= 0, -1.0, 0.0)), 0.0)
+        for gate_type, values in (("gen", sur), ("sub", sub), ("sur", sur)):
+            _set_gate_activations(columns, gate_type, rows, values)
+    rows = np.asarray(rows_by_type.get("Register", []), dtype=np.intp)
+    if len(rows) > 0:
+        _set_gate_activations(columns, "gen", rows, slots["gen"][rows])
+
+
+def grow_nodenet(nodenet_data, copies):
+    """
+    Returns nodenet data with the given number of copies of every Pipe node added, to measure the engines on nets
+    larger than the bundled ones. Links between Pipe nodes are copied between the copies, links to other nodes
+    (sensors, actors, registers, native modules) are copied to the same other node.
+    :param nodenet_data: the nodenet as loaded from its json file
+    :param copies: the number of copies of every Pipe node to add
+    """
+    nodes = dict(nodenet_data.get("nodes", {}))
+    links = dict(nodenet_data.get("links", {}))
+    pipe_uids = set(uid for uid, node_data in nodes.items() if node_data["type"] == "Pipe")
+    index = max([node_data.get("index", 0) for node_data in nodes.values()] + [0])
+    for copy in range(1, copies + 1):
+        def copy_uid(uid):
+            return "%s-%i" % (uid, copy) if uid in pipe_uids else uid
+        for uid in sorted(pipe_uids, key=lambda uid: nodes[uid].get("index", 0)):
+            index += 1
+            nodes[copy_uid(uid)] = dict(nodenet_data["nodes"][uid], uid=copy_uid(uid), index=index)
+        for link_data in nodenet_data.get("links", {}).values():
+            source_uid, target_uid = link_data["source_node_uid"], link_data["target_node_uid"]
+            if source_uid in pipe_uids or target_uid in pipe_uids:
+                link_uid = "%s-%i" % (link_data["uid"], copy)
+                links[link_uid] = dict(link_data, uid=link_uid, source_node_uid=copy_uid(source_uid),
+                                       target_node_uid=copy_uid(target_uid))
+    return dict(nodenet_data, nodes=nodes, links=links)
+
+
+def compare_engines(nodenet_path, steps=100, seed=0, world_path=None, engine_classes=None, copies=0):
+    """
+    Runs a nodenet file with DictNodenet and ArrayNodenet side by side, with the same random datasource
+    values and random seed, and checks that both engines end up with the same structure and activations
+    :param engine_classes: the two engines to compare, the reference first, defaults to DictNodenet and ArrayNodenet
+    :param copies: grow the nodenet by this many copies of its Pipe nodes first, see grow_nodenet
+    :return: the largest difference in activation seen, and the seconds each engine spent stepping
+    """
+    with open(nodenet_path) as file:
+        nodenet_data = json.load(file)
+    if copies > 0:
+        nodenet_data = grow_nodenet(nodenet_data, copies)
+    if world_path is None:
+        world_path = os.path.join(os.path.dirname(os.path.abspath(nodenet_path)), os.pardir, "worlds",
+                                  nodenet_data["world"] + ".json")
+    with open(world_path) as file:
+        world_data = json.load(file)
+
+    engines = []
+    for engine_class in engine_classes or (DictNodenet, ArrayNodenet):
+        # uids are counted up, so both engines create the same uids
+        counter = iter(range(sys.maxsize))
+        world_adapter = WorldAdapter.from_world(world_data, nodenet_data["worldadapter"])
+        engines.append(engine_class(nodenet_data, world_adapter,
+                                    uid_generator=lambda counter=counter: "%032x" % next(counter)))
+    for engine in engines:
+        seed_random(engine.netapi, seed)
+    datasource_random = random.Random(seed)
+    times = [0.0, 0.0]
+    difference = 0.0
+    for step in range(steps):
+        values = dict((key, float(datasource_random.random() < 0.3)) for key in engines[0].world_adapter.datasources)
+        for i, engine in enumerate(engines):
+            engine.world_adapter.datasources.update(values)
+            start = time.time()
+            engine.step()
+            times[i] += time.time() - start
+        reference, engine = engines
+        if [node and node.uid for node in reference.rows] != [node and node.uid for node in engine.rows]:
+            raise ValueError("Nodes differ after step %i" % step)
+        if set(reference.get_data()["links"]) != set(engine.get_data()["links"]):
+            raise ValueError("Links differ after step %i" % step)
+        for columns, other_columns in ((reference.gate_activations, engine.gate_activations),
+                                       (reference.slot_activations, engine.slot_activations)):
+            for key, column in columns.items():
+                difference = max(difference, float(np.max(np.abs(np.array(column) - other_columns[key]))))
+        if difference > 1e-9:
+            raise ValueError("Activations differ by %f after step %i" % (difference, step))
+    return difference, times
+
+
+if __name__ == "__main__":
+    # runs the given nodenet files (by default, the ones in nodenets/) with both engines, compares them and
+    # reports the time each engine took, optionally on nets grown by --copies copies of their Pipe nodes
+    import argparse
+    import glob
+    parser = argparse.ArgumentParser(description="Compares DictNodenet and ArrayNodenet on nodenet files.")
+    parser.add_argument("paths", nargs="*", help="nodenet files, defaults to the ones in nodenets/")
+    parser.add_argument("--steps", type=int, default=100)
+    parser.add_argument("--copies", type=int, default=0, help="copies of every Pipe node to add to each net")
+    args = parser.parse_args()
+    paths = args.paths or sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "nodenets",
+                                                        "*.json")))
+    for path in paths:
+        difference, times = compare_engines(path, steps=args.steps, copies=args.copies)
+        print("%s: engines agree (max difference %g), dict engine %.3fs (%.1f steps/s), array engine %.3fs "
+              "(%.1f steps/s)" % (path, difference, times[0], args.steps / times[0], times[1], args.steps / times[1]))
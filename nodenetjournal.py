@@ -0,0 +1,285 @@
+__author__ = 'rvuine'
+
+# An append-only change journal for nodenets, so a running net can be checkpointed at the cost of its changes
+# instead of rewriting the whole nodenet json.
+#
+# A NodenetJournal listens to the structure and state changes made through nettools (create_node, link,
+# unlink, delete_node, set_state, ...), collects the nodes they touch and, once per step, appends one line
+# to the journal file: the current image of every touched node (its fields and its outgoing links),
+# and the uids of the touched nodes that no longer exist. Lines are flushed to disk when they are written,
+# so a crash loses at most the step in progress. A line a crash has cut short is cut off when the journal is
+# attached again, and skipped when it is read.
+#
+# Replaying the journal onto the nodenet data it was started from (replay_journal, load_nodenet) yields the
+# structure of the running net. compact_journal folds the journal into the nodenet file and starts it over.
+#
+# Activations are not journaled, they change in every step for every node and are not needed to resume a net.
+# Changes made without going through nettools (i.e. in the editor) are not seen by the journal either,
+# a full save followed by truncate() is needed after those.
+
+import json
+import logging
+import os
+
+from nettools import *
+from nodenetsnapshot import SNAPSHOT_EXTENSION, load_snapshot, save_snapshot
+
+JOURNAL_EXTENSION = ".journal"
+
+
+class NodenetJournal(object):
+    """
+    Records the changes made to a nodenet through nettools in an append-only journal file.
+        journal = NodenetJournal(netapi, "nodenets/<uid>.journal")
+        journal.attach()
+        ... after every step:
+        journal.flush(step)
+    Changes recorded in a step are also flushed when the first change of a later step comes in.
+    """
+
+    def __init__(self, netapi, path):
+        self.netapi = netapi
+        self.path = path
+        self.dirty_nodes = {}
+        self.step = None
+        self.file = None
+
+    def attach(self):
+        add_structure_listener(self._record_structure_change)
+        add_state_listener(self._record_state_change)
+        _truncate_partial_line(self.path)
+        self.file = open(self.path, "a")
+
+    def detach(self):
+        self.flush()
+        remove_structure_listener(self._record_structure_change)
+        remove_state_listener(self._record_state_change)
+        self.file.close()
+        self.file = None
+
+    def _record_structure_change(self, nodes, netapi):
+        if netapi is self.netapi:
+            for node in nodes:
+                self._record(node)
+
+    def _record_state_change(self, node, netapi):
+        if netapi is self.netapi:
+            self._record(node)
+
+    def _record(self, node):
+        step = getattr(self.netapi, "step", None)
+        if step != self.step:
+            self.flush()
+            self.step = step
+        self.dirty_nodes[node.uid] = node
+
+    def flush(self, step=None):
+        """
+        Appends the changes recorded so far to the journal file
+        :param step: the step the changes belong to, defaults to the step they were recorded in
+        """
+        if len(self.dirty_nodes) == 0 or self.file is None:
+            return
+        images = {}
+        deleted = []
+        for uid in self.dirty_nodes:
+            try:
+                images[uid] = node_image(self.netapi.get_node(uid))
+            except KeyError:
+                deleted.append(uid)
+        entry = {"step": self.step if step is None else step, "nodes": images, "deleted": deleted}
+        self.file.write(json.dumps(entry, sort_keys=True) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.dirty_nodes = {}
+
+    def truncate(self):
+        """
+        Starts the journal over, i.e. after the nodenet has been saved in full
+        """
+        self.dirty_nodes = {}
+        if self.file is not None:
+            self.file.seek(0)
+            self.file.truncate()
+
+
+def _truncate_partial_line(path):
+    # cuts off a last line that a crash has left without its newline, so the next entry starts on a line of its own
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as file:
+        end = file.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            start = max(0, position - 4096)
+            file.seek(start)
+            newline = file.read(position - start).rfind(b"\n")
+            if newline >= 0:
+                position = start + newline + 1
+                break
+            position = start
+        if position < end:
+            file.truncate(position)
+
+
+def node_image(node):
+    """
+    Returns the journaled fields of a node: what is needed to recreate it, and its outgoing links
+    as a dict of gate names to lists of [target node uid, target slot name, weight, certainty]
+    """
+    links = {}
+    for gate_type in node.get_gate_types():
+        gate_links = node.get_gate(gate_type).get_links()
+        if len(gate_links) > 0:
+            links[gate_type] = [[link.target_node.uid, link.target_slot.type, link.weight, link.certainty]
+                                for link in gate_links]
+    image = {
+        "uid": node.uid,
+        "name": node.name,
+        "type": node.type,
+        "parent_nodespace": node.parent_nodespace,
+        "state": dict(getattr(node, "state", None) or {}),
+        "parameters": dict(getattr(node, "parameters", None) or {}),
+        "links": links
+    }
+    # only the gate parameters that differ from the defaults of the node's type, see nodenetengine
+    gate_parameters = getattr(node, "gate_parameters", None)
+    if gate_parameters is not None:
+        image["gate_parameters"] = dict((gate_type, dict(parameters))
+                                        for gate_type, parameters in gate_parameters.items())
+    position = getattr(node, "position", None)
+    if position is not None:
+        image["position"] = list(position)
+    return image
+
+
+def read_journal(path):
+    """
+    Returns the entries of a journal file. Lines that are not valid entries, i.e. a last line that was cut short
+    by a crash, are skipped with a warning.
+    """
+    entries = []
+    if not os.path.exists(path):
+        return entries
+    with open(path) as file:
+        for number, line in enumerate(file, 1):
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                logging.getLogger("nodenet").warning("Skipping line %i of journal %s, it is not a valid entry.",
+                                                     number, path)
+    return entries
+
+
+def replay_journal(nodenet_data, path):
+    """
+    Applies the entries of a journal file to nodenet data (as loaded from the nodenet json), in place
+    :param nodenet_data: the nodenet data the journal was started from
+    :param path: the journal file
+    :return: the number of entries applied
+    """
+    nodes = nodenet_data.setdefault("nodes", {})
+    links = nodenet_data.setdefault("links", {})
+    links_by_node = {}
+    for link_uid, link_data in links.items():
+        links_by_node.setdefault(link_data["source_node_uid"], set()).add(link_uid)
+        links_by_node.setdefault(link_data["target_node_uid"], set()).add(link_uid)
+
+    def remove_links(link_uids):
+        for link_uid in list(link_uids):
+            link_data = links.pop(link_uid, None)
+            if link_data is not None:
+                links_by_node[link_data["source_node_uid"]].discard(link_uid)
+                links_by_node[link_data["target_node_uid"]].discard(link_uid)
+
+    entries = read_journal(path)
+    for entry in entries:
+        for uid in entry["deleted"]:
+            nodes.pop(uid, None)
+            remove_links(links_by_node.get(uid, ()))
+            links_by_node.pop(uid, None)
+        for uid, image in entry["nodes"].items():
+            node_data = nodes.setdefault(uid, {
+                "activation": 0.0,
+                "gate_activations": {},
+                "gate_parameters": {},
+                "index": len(nodes),
+                "position": [0, 0],
+                "sheaves": {"default": {"activation": 0.0, "name": "default", "uid": "default"}},
+            })
+            for key in ("uid", "name", "type", "parent_nodespace", "state", "parameters", "position",
+                        "gate_parameters"):
+                if key in image:
+                    node_data[key] = image[key]
+            # the image holds all outgoing links of the node, replacing the ones it had
+            remove_links([link_uid for link_uid in links_by_node.get(uid, ())
+                          if links[link_uid]["source_node_uid"] == uid])
+            for gate_type, gate_links in image["links"].items():
+                for target_uid, slot_type, weight, certainty in gate_links:
+                    link_uid = "%s:%s:%s:%s" % (uid, gate_type, slot_type, target_uid)
+                    links[link_uid] = {
+                        "certainty": certainty,
+                        "source_gate_name": gate_type,
+                        "source_node_uid": uid,
+                        "target_node_uid": target_uid,
+                        "target_slot_name": slot_type,
+                        "uid": link_uid,
+                        "weight": weight
+                    }
+                    links_by_node.setdefault(uid, set()).add(link_uid)
+                    links_by_node.setdefault(target_uid, set()).add(link_uid)
+        if entry["step"] is not None:
+            nodenet_data["current_step"] = entry["step"]
+    return len(entries)
+
+
+def _read_nodenet(path):
+    if path.endswith(SNAPSHOT_EXTENSION):
+        return load_snapshot(path)
+    with open(path) as file:
+        return json.load(file)
+
+
+def _write_nodenet(nodenet_data, path):
+    # written next to the original and moved over it, so a crash leaves either the old or the new file
+    temp_path = path + ".tmp"
+    if path.endswith(SNAPSHOT_EXTENSION):
+        save_snapshot(nodenet_data, temp_path)
+    else:
+        with open(temp_path, "w") as file:
+            json.dump(nodenet_data, file, sort_keys=True, indent=4)
+    os.replace(temp_path, path)
+
+
+def load_nodenet(nodenet_path, journal_path=None):
+    """
+    Loads nodenet data from a nodenet json or snapshot file, with the changes in its journal applied
+    :param journal_path: defaults to the nodenet path with the journal extension
+    """
+    if journal_path is None:
+        journal_path = os.path.splitext(nodenet_path)[0] + JOURNAL_EXTENSION
+    nodenet_data = _read_nodenet(nodenet_path)
+    replay_journal(nodenet_data, journal_path)
+    return nodenet_data
+
+
+def compact_journal(nodenet_path, journal_path=None):
+    """
+    Folds a journal into its nodenet json or snapshot file and empties it
+    :return: the number of journal entries folded in
+    """
+    if journal_path is None:
+        journal_path = os.path.splitext(nodenet_path)[0] + JOURNAL_EXTENSION
+    nodenet_data = _read_nodenet(nodenet_path)
+    count = replay_journal(nodenet_data, journal_path)
+    if count > 0:
+        _write_nodenet(nodenet_data, nodenet_path)
+        open(journal_path, "w").close()
+    return count
+
+
+if __name__ == "__main__":
+    # folds the journals of the given nodenet files into them
+    import sys
+    for nodenet_path in sys.argv[1:]:
+        print("%s: %i journal entries compacted" % (nodenet_path, compact_journal(nodenet_path)))
@@ -0,0 +1,180 @@
+__author__ = 'rvuine'
+
+# Opt-in profiling of the native modules, as monitors of the nodenet.
+#
+# While a NodenetProfiler is enabled, the engine calls the native modules through it (see
+# DictNodenet.calculate_native_node_functions), and it counts the calls each module makes to the netapi.
+# For every step, it records per native module type and per native module node:
+#   wall_time               the seconds spent in the node function
+#   calls                   the number of node function calls
+#   netapi.<method>         the number of calls of that netapi method, i.e. netapi.create_node, netapi.link.
+#                           Calls the netapi makes to itself are counted as well, so a link_with_reciprocal
+#                           also counts as two links.
+# The values are kept as monitors in the nodenet's monitors dict, saved with the nodenet, with their values
+# by step, keyed by the step as a string like the runtime's monitors, so they are the same after a json round trip:
+#   {"uid": "profile:<node uid or type>:<metric>", "type": "profile", "name": ..., "node_uid": ..., "nodetype": ...,
+#    "target": <metric>, "values": {"<step>": value}}
+# Only the last `history` steps are kept.
+#
+# When no profiler is enabled, the engine makes one check per native module call, and the netapi is untouched.
+#
+# As a script, profiles a nodenet running against a StructuredObjects world and prints the totals:
+#   python nodenetprofiler.py nodenets/<uid>.json worlds/<uid>.json --steps 500
+
+import argparse
+import json
+import time
+
+from nodenetengine import DictNodenet, ArrayNodenet, np
+
+PROFILE_MONITOR_TYPE = "profile"
+
+
+class NodenetProfiler(object):
+    """
+    Profiles the native modules of a DictNodenet or ArrayNodenet.
+        profiler = NodenetProfiler(nodenet)
+        profiler.enable()
+        ... run the nodenet
+        profiler.disable()
+    """
+
+    def __init__(self, nodenet, history=1000):
+        """
+        :param history: the number of steps monitor values are kept for, None to keep all
+        """
+        self.nodenet = nodenet
+        self.history = history
+        self.current_node = None
+        self.step = None
+        # the values of the step in progress, and the totals since the profiler was created, by monitor uid
+        self.step_values = {}
+        self.totals = {}
+
+    def enable(self):
+        netapi = self.nodenet.netapi
+        for name in dir(type(netapi)):
+            if not name.startswith("_") and callable(getattr(type(netapi), name)):
+                # shadows the method on the instance only, so the netapi keeps its identity for nettools
+                setattr(netapi, name, self._counting(name, getattr(netapi, name)))
+        self.nodenet.profiler = self
+
+    def disable(self):
+        self.sample()
+        netapi = self.nodenet.netapi
+        for name in list(vars(netapi)):
+            if getattr(vars(netapi)[name], "profiled_method", None) == name:
+                delattr(netapi, name)
+        self.nodenet.profiler = None
+
+    def _counting(self, name, method):
+        metric = "netapi." + name
+
+        def counting_method(*args, **kwargs):
+            if self.current_node is not None:
+                self._add(self.current_node, metric, 1)
+            return method(*args, **kwargs)
+        counting_method.profiled_method = name
+        return counting_method
+
+    def call(self, nodefunction, node):
+        """
+        Calls the node function of a native module node, as the engine would, and records its costs
+        """
+        if self.nodenet.current_step != self.step:
+            self.sample()
+            self.step = self.nodenet.current_step
+        self.current_node = node
+        start = time.perf_counter()
+        try:
+            nodefunction(self.nodenet.netapi, node=node, sheaf="default", **node.parameters)
+        finally:
+            self.current_node = None
+            self._add(node, "wall_time", time.perf_counter() - start)
+            self._add(node, "calls", 1)
+
+    def _add(self, node, metric, value):
+        for target, node_uid, name in ((node.uid, node.uid, node.name), (node.type, None, node.type)):
+            uid = "profile:%s:%s" % (target, metric)
+            if uid not in self.step_values:
+                self.step_values[uid] = 0
+                if uid not in self.nodenet.monitors:
+                    self.nodenet.monitors[uid] = {
+                        "uid": uid,
+                        "type": PROFILE_MONITOR_TYPE,
+                        "name": "%s %s" % (name, metric),
+                        "node_uid": node_uid,
+                        "nodetype": node.type,
+                        "target": metric,
+                        "values": {}
+                    }
+            self.step_values[uid] += value
+
+    def sample(self):
+        """
+        Writes the values of the step in progress to the monitors
+        """
+        if self.step is None:
+            return
+        for uid, value in self.step_values.items():
+            self.totals[uid] = self.totals.get(uid, 0) + value
+            monitor = self.nodenet.monitors.get(uid)
+            if monitor is None:
+                continue
+            values = monitor["values"]
+            values[str(self.step)] = value
+            while self.history is not None and len(values) > self.history:
+                del values[next(iter(values))]
+        self.step_values = {}
+        self.step = None
+
+    def get_totals(self, by_node=False):
+        """
+        Returns the totals of all metrics since the profiler was created, by native module type or by node uid,
+        ordered by wall time, most expensive first
+        :return: a list of (type or node uid, {metric: total}) tuples
+        """
+        totals = {}
+        for uid, value in self.totals.items():
+            monitor = self.nodenet.monitors[uid]
+            if (monitor["node_uid"] is not None) == by_node:
+                key = monitor["node_uid"] if by_node else monitor["nodetype"]
+                totals.setdefault(key, {})[monitor["target"]] = value
+        return sorted(totals.items(), key=lambda item: -item[1].get("wall_time", 0))
+
+
+def remove_profile_monitors(nodenet):
+    """
+    Removes the monitors of the profiler from a nodenet
+    """
+    for uid in [uid for uid, monitor in nodenet.monitors.items() if monitor.get("type") == PROFILE_MONITOR_TYPE]:
+        del nodenet.monitors[uid]
+
+
+if __name__ == "__main__":
+    from structuredobjects import StructuredObjectsWorld
+
+    parser = argparse.ArgumentParser(description="Profiles the native modules of a nodenet.")
+    parser.add_argument("nodenet", help="the nodenet json file")
+    parser.add_argument("world", help="the world json file")
+    parser.add_argument("--steps", type=int, default=500)
+    parser.add_argument("--engine", choices=["array", "dict"], default="array" if np is not None else "dict")
+    args = parser.parse_args()
+
+    with open(args.nodenet) as file:
+        nodenet_data = json.load(file)
+    with open(args.world) as file:
+        world_data = json.load(file)
+    agent_uid = nodenet_data["uid"] if nodenet_data["uid"] in world_data.get("agents", {}) else None
+    world = StructuredObjectsWorld(world_data, agent_uid)
+    nodenet = {"array": ArrayNodenet, "dict": DictNodenet}[args.engine](nodenet_data, world)
+    profiler = NodenetProfiler(nodenet)
+    profiler.enable()
+    for step in range(args.steps):
+        nodenet.step()
+        world.update()
+    profiler.disable()
+    for nodetype, totals in profiler.get_totals():
+        print("%-32s %8.3fs %6i calls  %s" % (nodetype, totals["wall_time"], totals["calls"], ", ".join(
+            "%s %i" % (metric[len("netapi."):], value) for metric, value in sorted(totals.items())
+            if metric.startswith("netapi."))))
@@ -0,0 +1,408 @@
+__author__ = 'rvuine'
+
+# Sharded stepping of large nodenets, over worker processes.
+#
+# A ShardedNodenet is an ArrayNodenet whose link propagation and Pipe, Trigger and Register node functions (steps 1
+# and 2 of a step, see nodenetengine) are done by worker processes, one per shard. partition_rows spreads the rows
+# of the nodenet over the shards: nodes are clustered into schemas (nodes connected through sub links in the same
+# nodespace, i.e. a Scene or the protocol Chain with everything below it), and the schemas are spread so every shard
+# gets about as many incoming links as the others. A worker holds the links that end in the rows of its shard.
+#
+# The columns the standard node functions use (gate and slot activations, gate and node parameters, trigger
+# countdowns) live in one shared memory block. Once per step, every worker reads the gate activations of all rows,
+# so activation crosses shard boundaries without being copied, and writes the slot activations of the rows of its
+# shard. When all workers are done (a barrier), each computes the node functions of the rows of its shard, and
+# writes their gate activations. The main process does everything else: the Sensor and Actor nodes, which talk to
+# the world adapter, the native modules, which run on the netapi, and all structure changes. So the netapi works on
+# the whole nodenet as before, and only the link groups and rows that have changed are sent to the workers,
+# batched into one message per worker and step.
+#
+# Only link propagation and the Pipe, Trigger and Register node functions are sharded. The native modules (scene
+# import, protocol, planners) run in the main process on one core, and so do the Sensor and Actor nodes and all
+# structure changes, so nodenets that spend most of their step in native modules do not get faster with more shards.
+# Rows are partitioned by schema clustering only: nodespaces are not partitioned, i.e. all rows of a nodespace are
+# not kept on one shard unless sub links connect them.
+#
+# Rows created after the nodenet has been partitioned go to the shard with the fewest incoming links.
+# repartition() clusters all rows again, i.e. after many scenes have been imported.
+# The workers are stopped when the nodenet is closed or garbage collected.
+#
+# Behaves exactly like ArrayNodenet, up to floating point rounding. As a script, runs nodenet files with both
+# and compares them:
+#   python nodenetshards.py nodenets/<uid>.json --shards 4 --steps 100
+
+import argparse
+import heapq
+import multiprocessing
+import os
+import traceback
+import weakref
+
+from nodenetengine import (ArrayNodenet, GATE_PARAMETER_DEFAULTS, PARAMETER_COLUMNS, calculate_array_node_functions,
+                           compare_engines, np)
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:
+    shared_memory = None
+
+
+def partition_rows(nodenet, shards):
+    """
+    Spreads the rows of a nodenet over the given number of shards, keeping schemas together
+    :return: a list of the shard of every row
+    """
+    parents = list(range(len(nodenet.rows)))
+
+    def find(row):
+        while parents[row] != row:
+            parents[row] = parents[parents[row]]
+            row = parents[row]
+        return row
+
+    for link in nodenet.link_groups.get(("sub", "sub"), {}).values():
+        if link.source_node.parent_nodespace == link.target_node.parent_nodespace:
+            parents[find(link.target_node.index)] = find(link.source_node.index)
+
+    loads = [1] * len(nodenet.rows)
+    for links in nodenet.link_groups.values():
+        for link in links.values():
+            loads[link.target_node.index] += 1
+    schemas = {}
+    for row in range(len(nodenet.rows)):
+        schemas.setdefault(find(row), []).append(row)
+
+    # the largest schemas first, each to the shard with the lowest load so far
+    shard_loads = [(0, shard) for shard in range(shards)]
+    row_shards = [0] * len(nodenet.rows)
+    for rows in sorted(schemas.values(), key=lambda rows: (-sum(loads[row] for row in rows), rows[0])):
+        load, shard = heapq.heappop(shard_loads)
+        for row in rows:
+            row_shards[row] = shard
+        heapq.heappush(shard_loads, (load + sum(loads[row] for row in rows), shard))
+    return row_shards
+
+
+class SharedColumns(object):
+    """
+    The columns the workers of a ShardedNodenet use, as rows of one array in shared memory,
+    in the same dicts an ArrayNodenet keeps them in
+    """
+
+    def __init__(self, array, gate_types, slot_types):
+        columns = iter(array)
+        self.gate_activations = dict((gate_type, next(columns)) for gate_type in gate_types)
+        self.slot_activations = dict((slot_type, next(columns)) for slot_type in slot_types)
+        self.gate_parameters = dict(
+            (gate_type, dict((parameter, next(columns)) for parameter in GATE_PARAMETER_DEFAULTS))
+            for gate_type in gate_types)
+        self.parameter_columns = dict((key, next(columns)) for key in sorted(PARAMETER_COLUMNS))
+        self.trigger_countdowns = next(columns)
+        self.has_por_links = next(columns)
+
+    @staticmethod
+    def count(gate_types, slot_types):
+        return len(gate_types) * (1 + len(GATE_PARAMETER_DEFAULTS)) + len(slot_types) + len(PARAMETER_COLUMNS) + 2
+
+
+class ShardedNodenet(ArrayNodenet):
+    """
+    An ArrayNodenet that propagates activation over links and computes the standard node functions in worker
+    processes, one per shard.
+        nodenet = ShardedNodenet(nodenet_data, world_adapter, shards=4)
+        ... nodenet.step()
+        nodenet.close()
+    """
+
+    def __init__(self, nodenet_data=None, world_adapter=None, nodetypes=None, uid_generator=None, shards=None):
+        """
+        :param shards: the number of worker processes, defaults to the number of cores
+        """
+        if np is None or shared_memory is None:
+            raise ImportError("ShardedNodenet needs numpy and multiprocessing.shared_memory")
+        self.shard_count = shards or os.cpu_count() or 1
+        # the worker processes and the connections to them, the shared memory block of the columns,
+        # and the blocks the columns have been moved out of, until the workers have attached to the new ones
+        self.workers = []
+        self.blocks = []
+        self.retired_blocks = []
+        self.column_layout = None
+        self.shared_columns = None
+        # the shard of every row, the position of every row in its shard, and the rows of every shard
+        self.row_shards = []
+        self.row_positions = []
+        self.shard_rows = [[] for shard in range(self.shard_count)]
+        self.shard_loads = [0] * self.shard_count
+        # the link groups changed since the workers have last been sent them, and whether to send them everything
+        self.unsent_link_groups = set()
+        self.reset_shards = True
+        # whether nodes have been added or deleted since the workers have last been sent the rows of each type
+        self.changed_types = True
+        ArrayNodenet.__init__(self, nodenet_data, world_adapter, nodetypes, uid_generator)
+        # forked workers share the resource tracker of this process only if it is running already, otherwise each
+        # would start its own, which would unlink the blocks it has seen when the worker exits
+        resource_tracker.ensure_running()
+        self.barrier = multiprocessing.Barrier(self.shard_count)
+        for shard in range(self.shard_count):
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_shard_worker, args=(worker_connection, self.barrier),
+                                              daemon=True)
+            process.start()
+            self.workers.append((process, connection))
+        self._finalizer = weakref.finalize(self, _close_shards, self.workers, self.blocks, self.retired_blocks)
+        self.repartition()
+
+    def close(self):
+        """
+        Stops the worker processes and frees the shared memory. The nodenet can not be stepped afterwards.
+        """
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def repartition(self):
+        """
+        Spreads all rows over the shards anew, see partition_rows
+        """
+        if self.changed_link_groups:
+            self._update_link_arrays()
+        self.row_shards = []
+        self.row_positions = []
+        self.shard_rows = [[] for shard in range(self.shard_count)]
+        self.shard_loads = [0] * self.shard_count
+        for row, shard in enumerate(partition_rows(self, self.shard_count)):
+            self._assign_row(row, shard)
+        self.reset_shards = True
+
+    def _assign_row(self, row, shard):
+        self.row_shards.append(shard)
+        self.row_positions.append(len(self.shard_rows[shard]))
+        self.shard_rows[shard].append(row)
+        node = self.rows[row]
+        if node is not None:
+            self.shard_loads[shard] += 1 + sum(len(slot.links) for slot in node.slots.values())
+
+    def _add_node(self, uid, type, name, nodespace):
+        self.changed_types = True
+        return ArrayNodenet._add_node(self, uid, type, name, nodespace)
+
+    def delete_node(self, node):
+        self.changed_types = True
+        ArrayNodenet.delete_node(self, node)
+
+    def _update_link_arrays(self):
+        changed_link_groups = self.changed_link_groups
+        ArrayNodenet._update_link_arrays(self)
+        self.unsent_link_groups |= changed_link_groups
+        # a block for a new capacity gets a copy when it is created
+        if self.shared_columns is not None and len(self.shared_columns.has_por_links) == len(self.has_por_links):
+            self.shared_columns.has_por_links[:] = self.has_por_links
+
+    def _share_columns(self):
+        # moves the columns into a new shared memory block, if rows or types have been added since
+        layout = (self.capacity, tuple(self.gate_activations), tuple(self.slot_activations))
+        if layout == self.column_layout:
+            return False
+        # the workers attach to the new block in the next step, the old one is closed once they have
+        for block in self.blocks:
+            block.unlink()
+        self.retired_blocks.extend(self.blocks)
+        del self.blocks[:]
+        count = SharedColumns.count(layout[1], layout[2])
+        block = shared_memory.SharedMemory(create=True, size=max(8, count * self.capacity * 8))
+        shared = SharedColumns(np.ndarray((count, self.capacity), dtype=float, buffer=block.buf), layout[1], layout[2])
+        column_dicts = [(self.gate_activations, shared.gate_activations),
+                        (self.slot_activations, shared.slot_activations),
+                        (self.parameter_columns, shared.parameter_columns)]
+        column_dicts += [(self.gate_parameters[gate_type], shared.gate_parameters[gate_type])
+                         for gate_type in layout[1]]
+        for columns, shared_columns in column_dicts:
+            for key, shared_column in shared_columns.items():
+                shared_column[:] = columns[key]
+                columns[key] = shared_column
+        shared.trigger_countdowns[:] = self.trigger_countdowns
+        self.trigger_countdowns = shared.trigger_countdowns
+        # the nodenet keeps its own has_por_links, it is copied over whenever it is rebuilt
+        shared.has_por_links[:] = self.has_por_links
+        self.blocks.append(block)
+        self.shared_columns = shared
+        self.column_layout = layout
+        return True
+
+    def _get_shard_updates(self):
+        # the changes every worker has to be sent before the next step, None for workers without changes
+        updates = [{} for shard in range(self.shard_count)]
+        if self._share_columns():
+            attach = (self.blocks[0].name, self.column_layout[1], self.column_layout[2], self.capacity)
+            for update in updates:
+                update["attach"] = attach
+            self.reset_shards = True
+
+        new_rows = set()
+        for row in range(len(self.row_shards), len(self.rows)):
+            shard = self.shard_loads.index(min(self.shard_loads))
+            self._assign_row(row, shard)
+            new_rows.add(shard)
+        for shard, update in enumerate(updates):
+            if self.reset_shards or shard in new_rows:
+                update["rows"] = np.array(self.shard_rows[shard], dtype=np.intp)
+        row_shards = np.array(self.row_shards, dtype=np.intp)
+        row_positions = np.array(self.row_positions, dtype=np.intp)
+
+        if self.reset_shards or self.changed_types:
+            for update in updates:
+                update["types"] = {}
+            for type in ("Pipe", "Trigger", "Register"):
+                rows = np.array(self.rows_by_type.get(type, []), dtype=np.intp)
+                shards = row_shards[rows]
+                for shard, update in enumerate(updates):
+                    update["types"][type] = rows[shards == shard]
+            self.changed_types = False
+
+        if self.reset_shards:
+            keys = list(self.link_arrays)
+            for update in updates:
+                update["reset"] = True
+        else:
+            keys = self.unsent_link_groups
+        for key in keys:
+            for update in updates:
+                update.setdefault("links", {})[key] = None
+            if key not in self.link_arrays:
+                continue
+            sources, targets, weights = self.link_arrays[key]
+            shards = row_shards[targets]
+            for shard in np.unique(shards).tolist():
+                selected = shards == shard
+                updates[shard]["links"][key] = (sources[selected], row_positions[targets[selected]],
+                                                weights[selected])
+        self.unsent_link_groups = set()
+        self.reset_shards = False
+        return [update or None for update in updates]
+
+    def propagate_link_activation(self):
+        # the workers also compute the node functions of their rows, see calculate_standard_node_functions
+        if self.changed_link_groups or self.has_por_links is None or len(self.has_por_links) != self.capacity:
+            self._update_link_arrays()
+        for (process, connection), update in zip(self.workers, self._get_shard_updates()):
+            connection.send(("step", update))
+        errors = [connection.recv() for process, connection in self.workers]
+        for error in errors:
+            if error is not None:
+                self.barrier.reset()
+                raise RuntimeError("Shard worker failed:\n" + error)
+        _close_blocks(self.retired_blocks)
+
+    def calculate_standard_node_functions(self):
+        # the Pipe, Trigger and Register nodes have been computed by the workers, in propagate_link_activation
+        self.calculate_interface_node_functions()
+
+
+def _shard_worker(connection, barrier):
+    # computes the slot activations and then the node functions of the rows of one shard, once per "step" message,
+    # see ShardedNodenet
+    blocks = []
+    columns = None
+    rows = np.zeros(0, dtype=np.intp)
+    rows_by_type = {}
+    links = {}
+    while True:
+        message, update = connection.recv()
+        if message == "close":
+            break
+        try:
+            if update is not None:
+                if "attach" in update:
+                    block_name, gate_types, slot_types, capacity = update["attach"]
+                    columns = None
+                    for block in blocks:
+                        block.close()
+                    blocks = [shared_memory.SharedMemory(name=block_name)]
+                    count = SharedColumns.count(gate_types, slot_types)
+                    columns = SharedColumns(np.ndarray((count, capacity), dtype=float, buffer=blocks[0].buf),
+                                            gate_types, slot_types)
+                if "rows" in update:
+                    rows = update["rows"]
+                if "types" in update:
+                    rows_by_type = update["types"]
+                if update.get("reset"):
+                    links = {}
+                for key, arrays in update.get("links", {}).items():
+                    if arrays is None:
+                        links.pop(key, None)
+                    else:
+                        links[key] = arrays
+            activations = dict((slot_type, np.zeros(len(rows))) for slot_type in columns.slot_activations)
+            for (gate_type, slot_type), (sources, targets, weights) in links.items():
+                activations[slot_type] += np.bincount(
+                    targets, weights=weights * columns.gate_activations[gate_type][sources], minlength=len(rows))
+            for slot_type, values in activations.items():
+                columns.slot_activations[slot_type][rows] = values
+        except Exception:
+            # the other workers are waiting for this one at the barrier
+            barrier.abort()
+            connection.send(traceback.format_exc())
+            continue
+        try:
+            # the gate activations of all rows have been read when all workers have passed the barrier
+            barrier.wait()
+            calculate_array_node_functions(columns, rows_by_type)
+            connection.send(None)
+        except Exception:
+            connection.send(traceback.format_exc())
+    columns = None
+    for block in blocks:
+        block.close()
+
+
+def _close_blocks(blocks):
+    # closes the given blocks, except for the ones columns of the nodenet still refer to
+    for block in list(blocks):
+        try:
+            block.close()
+            blocks.remove(block)
+        except BufferError:
+            pass
+
+
+def _close_shards(workers, blocks, retired_blocks):
+    for process, connection in workers:
+        try:
+            connection.send(("close", None))
+        except (OSError, ValueError):
+            pass
+    for process, connection in workers:
+        process.join(1)
+        connection.close()
+    del workers[:]
+    for block in blocks:
+        block.unlink()          # the retired blocks have been unlinked when they were retired
+    # blocks columns of the nodenet still refer to are unmapped when the columns are gone
+    _close_blocks(blocks + retired_blocks)
+    del blocks[:]
+    del retired_blocks[:]
+
+
+if __name__ == "__main__":
+    import glob
+
+    parser = argparse.ArgumentParser(description="Runs nodenet files with ArrayNodenet and ShardedNodenet and "
+                                                 "compares them.")
+    parser.add_argument("nodenets", nargs="*", help="the nodenet json files, by default the ones in nodenets/")
+    parser.add_argument("--shards", type=int, default=None)
+    parser.add_argument("--steps", type=int, default=100)
+    args = parser.parse_args()
+
+    def sharded_nodenet(*args_, **kwargs):
+        return ShardedNodenet(*args_, shards=args.shards, **kwargs)
+
+    paths = args.nodenets or glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "nodenets", "*.json"))
+    for path in paths:
+        difference, times = compare_engines(path, args.steps, engine_classes=(ArrayNodenet, sharded_nodenet))
+        print("%s: engines agree (max difference %g), array engine %.3fs, sharded engine %.3fs" % (
+            path, difference, times[0], times[1]))
@@ -0,0 +1,386 @@
+__author__ = 'rvuine'
+
+# Columnar snapshots of nodenet files, as a compact alternative to the nodenet json.
+#
+# A snapshot holds the same data as the json file it was made from: load_snapshot(path) returns a dict
+# equal to the parsed json, including the int/float types of all numbers, so converting back loses nothing.
+#
+# Layout of a snapshot file:
+#   magic (8 bytes) | header length (uint32, little endian) | header (utf-8 json) | padding | column buffers
+# The header holds the nodenet's top level fields, the table of interned strings, the table of interned
+# json blocks (i.e. the gate_parameters dicts, which are the same for most nodes of a type),
+# and the type, offset and length of every column buffer.
+# Column buffers are little endian and 8-byte aligned, so they can be used straight from a memory map.
+#
+# Nodes and links are stored row by row in columns: strings (uids, names, types, gate and slot names)
+# as indices into the string table, numbers as float64 or int64, dicts as indices into the block table.
+# A node's links refer to nodes by row, the link uids are rebuilt from their endpoints on load.
+# Every row has a flags column recording which columns it uses and which of its numbers are ints,
+# anything that does not fit the columns goes into a per-row "extra" block.
+
+import array
+import contextlib
+import json
+import mmap
+import struct
+import sys
+
+SNAPSHOT_MAGIC = b"PIPESNP1"
+SNAPSHOT_EXTENSION = ".snapshot"
+
+# columns: (name, kind, field), kind being one of "string", "number", "int", "block", "node"
+NODE_COLUMNS = [
+    ("uid", "string", "uid"),
+    ("name", "string", "name"),
+    ("type", "string", "type"),
+    ("parent_nodespace", "string", "parent_nodespace"),
+    ("activation", "number", "activation"),
+    ("position_x", "number", ("position", 0)),
+    ("position_y", "number", ("position", 1)),
+    ("index", "int", "index"),
+    ("gate_parameters", "block", "gate_parameters"),
+    ("gate_activations", "block", "gate_activations"),
+    ("sheaves", "block", "sheaves"),
+    ("state", "block", "state"),
+    ("parameters", "block", "parameters"),
+]
+
+LINK_COLUMNS = [
+    ("source", "node", "source_node_uid"),
+    ("target", "node", "target_node_uid"),
+    ("source_gate", "string", "source_gate_name"),
+    ("target_slot", "string", "target_slot_name"),
+    ("weight", "number", "weight"),
+    ("certainty", "number", "certainty"),
+]
+
+_TYPECODES = {"string": "i", "node": "i", "block": "i", "number": "d", "int": "q", "flags": "Q", "extra": "i"}
+
+# flag bits per column: bit 2*i is set if column i holds the row's value, bit 2*i+1 if that value is an int
+# the two highest bits mark rows whose uid (links) or dict key (nodes and links) is not the default
+FLAG_UID_STORED = 1 << 62
+FLAG_KEY_STORED = 1 << 63
+
+
+class _Interner(object):
+    # maps values to indices into a table, identical values share an index
+
+    def __init__(self, key=None):
+        self.table = []
+        self.indices = {}
+        self.key = key
+
+    def add(self, value):
+        key = value if self.key is None else self.key(value)
+        if key not in self.indices:
+            self.indices[key] = len(self.table)
+            self.table.append(value)
+        return self.indices[key]
+
+
+def _canonical_json(value):
+    # distinguishes 0 from 0.0, unlike comparing the values themselves
+    return json.dumps(value, sort_keys=True)
+
+
+def _get_field(record, field):
+    # returns (found, value) for a field name or a (list field, index) tuple
+    if isinstance(field, tuple):
+        values = record.get(field[0])
+        if isinstance(values, list) and len(values) == 2:
+            return True, values[field[1]]
+        return False, None
+    if field in record:
+        return True, record[field]
+    return False, None
+
+
+def _fits_column(kind, value):
+    if kind == "string":
+        return isinstance(value, str)
+    if kind == "number":
+        return isinstance(value, (int, float)) and not isinstance(value, bool) and abs(value) < 2 ** 53
+    if kind == "int":
+        return isinstance(value, int) and not isinstance(value, bool) and -2 ** 63 <= value < 2 ** 63
+    if kind == "block":
+        return True
+    return False
+
+
+def _encode_rows(records, columns, strings, blocks, node_rows=None):
+    # returns a dict of column names to arrays, including the "flags" and "extra" columns
+    data = dict((name, array.array(_TYPECODES[kind])) for name, kind, field in columns)
+    data["flags"] = array.array(_TYPECODES["flags"])
+    data["extra"] = array.array(_TYPECODES["extra"])
+
+    for key, record in records:
+        flags = 0
+        columnized = set()
+        position_columnized = True
+        for i, (name, kind, field) in enumerate(columns):
+            found, value = _get_field(record, field)
+            if kind == "node":
+                found = found and value in node_rows
+            elif found:
+                found = _fits_column(kind, value)
+            if isinstance(field, tuple):
+                position_columnized = position_columnized and found
+            if not found:
+                data[name].append(-1 if _TYPECODES[kind] == "i" else 0)
+                continue
+            flags |= 1 << (2 * i)
+            if kind == "string":
+                data[name].append(strings.add(value))
+            elif kind == "node":
+                data[name].append(node_rows[value])
+            elif kind == "block":
+                data[name].append(blocks.add(value))
+            else:
+                data[name].append(value)
+                if isinstance(value, int):
+                    flags |= 1 << (2 * i + 1)
+            if not isinstance(field, tuple):
+                columnized.add(field)
+
+        if not position_columnized:
+            # positions only go into the columns as a whole
+            for i, (name, kind, field) in enumerate(columns):
+                if isinstance(field, tuple):
+                    flags &= ~(3 << (2 * i))
+
+        extra = dict((field, value) for field, value in record.items() if field not in columnized)
+        if position_columnized and "position" in extra:
+            del extra["position"]
+        if node_rows is not None:
+            # links: the uid is rebuilt from the endpoints, unless it is something else
+            if extra.get("uid") == _link_uid(record):
+                del extra["uid"]
+            else:
+                flags |= FLAG_UID_STORED
+            if key != record.get("uid"):
+                flags |= FLAG_KEY_STORED
+                extra["\0key"] = key
+        elif key != record.get("uid"):
+            flags |= FLAG_KEY_STORED
+            extra["\0key"] = key
+
+        data["flags"].append(flags)
+        data["extra"].append(blocks.add(extra) if len(extra) > 0 else -1)
+    return data
+
+
+def _link_uid(link):
+    return "%s:%s:%s:%s" % (link.get("source_node_uid"), link.get("source_gate_name"),
+                            link.get("target_slot_name"), link.get("target_node_uid"))
+
+
+def save_snapshot(nodenet_data, path):
+    """
+    Saves nodenet data (the parsed nodenet json) as a columnar snapshot
+    :param nodenet_data: a nodenet dict, as found in the nodenet json files
+    :param path: the file to write
+    """
+    strings = _Interner()
+    blocks = _Interner(key=_canonical_json)
+
+    nodes = nodenet_data.get("nodes", {})
+    links = nodenet_data.get("links", {})
+    node_rows = dict((node.get("uid"), row) for row, node in enumerate(nodes.values()))
+    if len(node_rows) != len(nodes):
+        node_rows = {}      # duplicate or missing uids, links keep their node uids in their extra blocks
+
+    columns = {}
+    for name, values in _encode_rows(nodes.items(), NODE_COLUMNS, strings, blocks).items():
+        columns["nodes." + name] = values
+    for name, values in _encode_rows(links.items(), LINK_COLUMNS, strings, blocks, node_rows).items():
+        columns["links." + name] = values
+
+    header = {
+        "version": 1,
+        "nodenet": dict((key, value) for key, value in nodenet_data.items() if key not in ("nodes", "links")),
+        "keys": list(nodenet_data.keys()),
+        "node_count": len(nodes),
+        "link_count": len(links),
+        "strings": strings.table,
+        "blocks": blocks.table,
+        "columns": {},
+    }
+
+    # the header holds the buffer offsets, which depend on the header's length: lay out the buffers
+    # relative to the end of the header, then fix the header size by padding it
+    relative_offset = 0
+    for name in sorted(columns):
+        values = columns[name]
+        header["columns"][name] = [values.typecode, relative_offset, len(values)]
+        relative_offset += _aligned(len(values) * values.itemsize)
+    header["data_offset"] = 0
+    header_bytes = b""
+    while len(SNAPSHOT_MAGIC) + 4 + len(header_bytes) > header["data_offset"]:
+        header["data_offset"] = _aligned(len(SNAPSHOT_MAGIC) + 4 + len(header_bytes))
+        header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    data_offset = header["data_offset"]
+
+    with open(path, "wb") as file:
+        file.write(SNAPSHOT_MAGIC)
+        file.write(struct.pack("<I", len(header_bytes)))
+        file.write(header_bytes)
+        file.write(b"\0" * (data_offset - len(SNAPSHOT_MAGIC) - 4 - len(header_bytes)))
+        for name in sorted(columns):
+            values = columns[name]
+            if sys.byteorder != "little":
+                values = array.array(values.typecode, values)
+                values.byteswap()
+            buffer = values.tobytes()
+            file.write(buffer)
+            file.write(b"\0" * (_aligned(len(buffer)) - len(buffer)))
+
+
+def _aligned(length):
+    return (length + 7) // 8 * 8
+
+
+@contextlib.contextmanager
+def read_snapshot_columns(path):
+    """
+    Maps a snapshot file and yields its header and its columns, without building the nodenet dict.
+    On little endian machines, the columns are memoryviews straight into the mapped file. They are released and the
+    file is unmapped when the context is left, so the columns must not be used after that:
+        with read_snapshot_columns(path) as (header, columns):
+            ...
+    :param path: the snapshot file
+    :return: a context manager for the header dict and a dict of column names to sequences of numbers
+    """
+    with open(path, "rb") as file:
+        buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(buffer)
+    columns = {}
+    try:
+        if buffer[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError("%s is not a nodenet snapshot" % path)
+        header_length = struct.unpack("<I", buffer[len(SNAPSHOT_MAGIC):len(SNAPSHOT_MAGIC) + 4])[0]
+        header_start = len(SNAPSHOT_MAGIC) + 4
+        header = json.loads(buffer[header_start:header_start + header_length].decode("utf-8"))
+
+        for name, (typecode, offset, length) in header["columns"].items():
+            start = header["data_offset"] + offset
+            itemsize = array.array(typecode).itemsize
+            if sys.byteorder == "little":
+                columns[name] = view[start:start + length * itemsize].cast(typecode)
+            else:
+                values = array.array(typecode, view[start:start + length * itemsize].tobytes())
+                values.byteswap()
+                columns[name] = values
+        yield header, columns
+    finally:
+        # the map can only be closed once no view into it is left, otherwise the file stays mapped (and on windows,
+        # locked) until the views are garbage collected
+        for column in columns.values():
+            if isinstance(column, memoryview):
+                column.release()
+        view.release()
+        buffer.close()
+
+
+def _decode_rows(count, prefix, columns_spec, header, columns, node_uids=None):
+    strings = header["strings"]
+    blocks = header["blocks"]
+    flags_column = columns[prefix + "flags"]
+    extra_column = columns[prefix + "extra"]
+    spec_columns = [columns[prefix + name] for name, kind, field in columns_spec]
+
+    records = []
+    for row in range(count):
+        flags = flags_column[row]
+        extra = extra_column[row]
+        record = {}
+        if extra >= 0:
+            record = json.loads(json.dumps(blocks[extra]))      # a copy, blocks are shared between rows
+        key = record.pop("\0key", None)
+        for i, (name, kind, field) in enumerate(columns_spec):
+            if not flags & (1 << (2 * i)):
+                continue
+            value = spec_columns[i][row]
+            if kind == "string":
+                value = strings[value]
+            elif kind == "node":
+                value = node_uids[value]
+            elif kind == "block":
+                value = json.loads(json.dumps(blocks[value]))
+            elif kind == "number" and flags & (1 << (2 * i + 1)):
+                value = int(value)
+            if isinstance(field, tuple):
+                record.setdefault(field[0], [None, None])[field[1]] = value
+            else:
+                record[field] = value
+        if node_uids is not None and not flags & FLAG_UID_STORED:
+            record["uid"] = _link_uid(record)
+        if not flags & FLAG_KEY_STORED:
+            key = record.get("uid")
+        records.append((key, record))
+    return records
+
+
+def load_snapshot(path):
+    """
+    Loads a columnar snapshot
+    :param path: the snapshot file
+    :return: the nodenet dict, equal to the one the snapshot was saved from
+    """
+    with read_snapshot_columns(path) as (header, columns):
+        nodes = _decode_rows(header["node_count"], "nodes.", NODE_COLUMNS, header, columns)
+        node_uids = [node.get("uid") for key, node in nodes]
+        links = _decode_rows(header["link_count"], "links.", LINK_COLUMNS, header, columns, node_uids)
+
+    nodenet_data = {}
+    for key in header["keys"]:
+        if key == "nodes":
+            nodenet_data[key] = dict(nodes)
+        elif key == "links":
+            nodenet_data[key] = dict(links)
+        else:
+            nodenet_data[key] = header["nodenet"][key]
+    return nodenet_data
+
+
+def convert_nodenet(json_path, snapshot_path=None):
+    """
+    Converts a nodenet json file to a snapshot and checks that the snapshot loads back to the same data
+    :param json_path: the nodenet json file
+    :param snapshot_path: the snapshot file to write, by default next to the json file
+    :return: the path of the snapshot file
+    """
+    if snapshot_path is None:
+        snapshot_path = json_path[:-len(".json")] if json_path.endswith(".json") else json_path
+        snapshot_path += SNAPSHOT_EXTENSION
+    with open(json_path) as file:
+        nodenet_data = json.load(file)
+    save_snapshot(nodenet_data, snapshot_path)
+    if _canonical_json(load_snapshot(snapshot_path)) != _canonical_json(nodenet_data):
+        raise ValueError("Snapshot of %s does not load back to the same nodenet" % json_path)
+    return snapshot_path
+
+
+def export_nodenet(snapshot_path, json_path):
+    """
+    Writes a snapshot back to a nodenet json file, formatted like the files in nodenets/
+    :param snapshot_path: the snapshot file
+    :param json_path: the nodenet json file to write
+    """
+    with open(json_path, "w") as file:
+        json.dump(load_snapshot(snapshot_path), file, sort_keys=True, indent=4)
+
+
+if __name__ == "__main__":
+    # converts the given nodenet json files (by default, the ones in nodenets/) to snapshots,
+    # and the given snapshot files back to json
+    import glob
+    import os
+    paths = sys.argv[1:] or glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "nodenets", "*.json"))
+    for path in paths:
+        if path.endswith(SNAPSHOT_EXTENSION):
+            json_path = path[:-len(SNAPSHOT_EXTENSION)] + ".json"
+            export_nodenet(path, json_path)
+            print("%s: %i -> %i bytes" % (json_path, os.path.getsize(path), os.path.getsize(json_path)))
+        else:
+            snapshot_path = convert_nodenet(path)
+            print("%s: %i -> %i bytes" % (snapshot_path, os.path.getsize(path), os.path.getsize(snapshot_path)))
@@ -1,19 +1,532 @@
 __author__ = 'rvuine'
 
+import hashlib
+import json
+import weakref
+from collections import OrderedDict
+from nettools import *
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# the range of fovea positions on both axes, relative to the center of the scene
+FOVEA_POSITIONS = range(-2, 3)
+
+# the recognition script imported for a fovea position:
+# F(x/y) with an Act/Sense script below, Act moves the fovea through mov-x/mov-y triggers,
+# Sense checks one proxy per active fovea sensor.
+# "{key}" values are replaced with the instantiation values, actor links with a weight of 0 are left out.
+FOVEA_FEATURE_TEMPLATE = {
+    "head": "feature",
+    "nodes": [
+        ("feature", "Pipe", "{name}"),
+        ("act", "Pipe", "{name}.Act"),
+        ("sense", "Pipe", "{name}.Sense"),
+        ("mov_x", "Trigger", "{name}.mov-x"),
+        ("mov_y", "Trigger", "{name}.mov-y"),
+    ],
+    "states": [
+        ("feature", "x", "{x}"),
+        ("feature", "y", "{y}"),
+    ],
+    "parameters": [
+        ("mov_x", "response", "{x}"),
+        ("mov_y", "response", "{y}"),
+        ("mov_x", "timeout", 3),
+        ("mov_y", "timeout", 3),
+    ],
+    "reciprocal_links": [
+        ("feature", "act", "subsur"),
+        ("feature", "sense", "subsur"),
+        ("act", "sense", "porret"),
+        ("act", "mov_x", "subsur"),
+        ("act", "mov_y", "subsur"),
+    ],
+    "links": [
+        ("feature", "gen", "feature", "gen", 0.98),    # gen loop
+        ("mov_x", "sur", "act", "sur", 0.5),
+        ("mov_y", "sur", "act", "sur", 0.5),
+    ],
+    "actors": [
+        ("mov_x", "fov_reset", 1),
+        ("mov_x", "fov_x", "{x}"),
+        ("mov_y", "fov_y", "{y}"),
+    ],
+    "sensors": [
+        ("mov_x", "fov-x"),
+        ("mov_y", "fov-y"),
+    ],
+    # one conditional sensor classificator below "sense" for each sensor given on instantiation
+    "sensor_proxies": ("sense", "Pipe", "{name}.{sensor}"),
+}
+
+# schemas are not descended into below this depth
+MAX_SCHEMA_DEPTH = 256
+
+# upper bound for the number of entries in the feature cache of a nodenet
+FEATURE_CACHE_SIZE = 2048
+
+# per netapi instance: an OrderedDict of (kind, head node uid) to collected features, least recently used first
+_feature_caches = weakref.WeakKeyDictionary()
+
+
+def fovea_key(x, y):
+    # node states are stored as json, so positions are keyed by strings
+    return str(x) + "/" + str(y)
+
+
+def get_fovea_index(scene, netapi):
+    """
+    Returns the fovea index of a scene: a dict of "x/y" position keys to the uids of the features covering them.
+    The index lives in the scene node's state, so it is stored with the nodenet.
+    Scenes without an index (i.e. from older nodenets) get one built from their sub field once.
+    :param scene: the head node of a scene
+    :param netapi: netapi
+    :return: the fovea index of the scene
+    """
+    index = scene.get_state('fovea_index')
+    if index is None:
+        index = {}
+        for sub_node in netapi.get_nodes_in_gate_field(scene, 'sub'):
+            x = sub_node.get_state('x')
+            y = sub_node.get_state('y')
+            if x is not None and y is not None:
+                index.setdefault(fovea_key(x, y), []).append(sub_node.uid)
+        set_state(scene, 'fovea_index', index, netapi)
+    return index
+
+
+def index_fovea_feature(scene, feature, netapi):
+    """
+    Records that the given feature covers its fovea position in the scene.
+    :param scene: the head node of a scene
+    :param feature: a feature node with x and y states
+    :param netapi: netapi
+    """
+    # the index is copied rather than changed in place, so an open fork keeps the index it replaces
+    index = dict(get_fovea_index(scene, netapi))
+    key = fovea_key(feature.get_state('x'), feature.get_state('y'))
+    uids = index.get(key, [])
+    if feature.uid not in uids:
+        index[key] = uids + [feature.uid]
+    set_state(scene, 'fovea_index', index, netapi)
+    recognition_index = _recognition_indexes.get(netapi, {}).get(scene.parent_nodespace)
+    if recognition_index is not None and scene.name.startswith("Scene-"):
+        features = _get_fovea_features(feature, netapi)
+        _record_recognition_undo(recognition_index, scene.uid, [feature.uid], netapi)
+        recognition_index.add_feature(scene.uid, feature.uid, recognition_index.get_bitset(features, create=True))
+
+
+def unindex_fovea_feature(scene, feature, netapi):
+    """
+    Removes the given feature from the fovea index of the scene, if the scene has one.
+    :param scene: the head node of a scene
+    :param feature: a feature node with x and y states
+    :param netapi: netapi
+    """
+    index = scene.get_state('fovea_index')
+    if index is None:
+        return
+    key = fovea_key(feature.get_state('x'), feature.get_state('y'))
+    uids = index.get(key, [])
+    if feature.uid in uids:
+        index = dict(index)
+        index[key] = [uid for uid in uids if uid != feature.uid]
+        if len(index[key]) == 0:
+            del index[key]
+        set_state(scene, 'fovea_index', index, netapi)
+    recognition_index = _recognition_indexes.get(netapi, {}).get(scene.parent_nodespace)
+    if recognition_index is not None:
+        _record_recognition_undo(recognition_index, scene.uid, [feature.uid], netapi)
+        recognition_index.remove_feature(scene.uid, feature.uid)
+
+
+def is_fovea_position_covered(scene, x, y, netapi):
+    """
+    Returns True if the scene has a feature for the given fovea position
+    """
+    return fovea_key(x, y) in get_fovea_index(scene, netapi)
+
+
+def get_uncovered_fovea_positions(scene, netapi):
+    """
+    Returns a list of the (x, y) fovea positions the scene has no feature for yet
+    """
+    index = get_fovea_index(scene, netapi)
+    return [(x, y) for y in FOVEA_POSITIONS for x in FOVEA_POSITIONS if fovea_key(x, y) not in index]
+
+
+def get_fovea_properties(scene, netapi):
+    """
+    Returns the set of properties the fovea sensors of the scene's features stand for, i.e. "red" for fovea-red
+    """
+    properties = set()
+    for uids in get_fovea_index(scene, netapi).values():
+        for uid in uids:
+            properties.update(datasource[len("fovea-"):] for key, datasource in
+                              _get_fovea_features(netapi.get_node(uid), netapi))
+    return properties
+
+
+# saccade planners: functions that return the fovea position the scene importer should look at next,
+# given a scene and the current fovea position, or None if there is nothing left to look at
+
+def random_saccade(scene, x, y, netapi):
+    """
+    Picks one of the uncovered fovea positions of the scene at random
+    """
+    candidates = [position for position in get_uncovered_fovea_positions(scene, netapi) if position != (x, y)]
+    if len(candidates) == 0:
+        return None
+    return get_random(netapi).choice(candidates)
+
+
+def scan_saccade(scene, x, y, netapi):
+    """
+    Picks the uncovered fovea position of the scene that follows the previously picked one in row order,
+    wrapping around. Scanning on from the previous pick rather than from where the fovea is makes sure
+    every position gets its turn, even if other schemas keep moving the fovea elsewhere.
+    """
+    candidates = [position for position in get_uncovered_fovea_positions(scene, netapi) if position != (x, y)]
+    if len(candidates) == 0:
+        return None
+    previous = scene.get_state('fovea_scan') or [x, y]
+    following = [(cy, cx) for cx, cy in candidates if (cy, cx) > (previous[1], previous[0])]
+    cy, cx = min(following) if len(following) > 0 else min((cy, cx) for cx, cy in candidates)
+    set_state(scene, 'fovea_scan', [cx, cy], netapi)
+    return cx, cy
+
+
+def presence_saccade(scene, x, y, netapi):
+    """
+    Scans the scene like scan_saccade, as long as the active presence sensors show a property
+    that no feature of the scene has been imported for
+    """
+    seen = get_fovea_properties(scene, netapi)
+    for sensor in netapi.get_nodes_active(scene.parent_nodespace, 'Sensor', 1, 'gen'):
+        if sensor.name.startswith("presence-") and sensor.name[len("presence-"):] not in seen:
+            return scan_saccade(scene, x, y, netapi)
+    return None
+
+
+SACCADE_PLANNERS = {
+    "random": random_saccade,
+    "scan": scan_saccade,
+    "presence": presence_saccade,
+}
+
+# the planner of scene importers without a saccade_planner parameter
+DEFAULT_SACCADE_PLANNER = "scan"
+
+
+# scene recognition: per nodespace, a bitset of the (fovea position, fovea datasource) features of every scene
+# ("Scene-..." nodes with fovea features), and the features the fovea has observed since the last new scene.
+# Matching the observations against all scenes is one AND and popcount, vectorized with numpy if available.
+
+# per netapi instance: a dict of nodespaces to their SceneRecognitionIndex
+_recognition_indexes = weakref.WeakKeyDictionary()
+
+if np is not None:
+    # the number of set bits of every byte value
+    _POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint16)
+
+
+class SceneRecognitionIndex(object):
+
+    def __init__(self):
+        self.bits = {}              # (fovea key, datasource) to bit number
+        self.rows = {}              # scene uid to row
+        self.scene_uids = []        # row to scene uid
+        self.feature_bitsets = []   # row to a dict of the scene's feature uids to their bitsets
+        self.bitsets = []           # row to the bitset of the scene, the union of the bitsets of its features
+        self.observations = set()   # the (fovea key, datasource) pairs observed since the last new scene
+        self.matrix = None          # the scene bitsets as a numpy byte matrix, rebuilt after changes
+
+    def get_bitset(self, features, create=False):
+        """
+        Returns the bitset of the given (fovea key, datasource) pairs
+        :param create: assign bits to unknown pairs, leave them out otherwise
+        """
+        bitset = 0
+        for feature in features:
+            if feature not in self.bits:
+                if not create:
+                    continue
+                self.bits[feature] = len(self.bits)
+            bitset |= 1 << self.bits[feature]
+        return bitset
+
+    def add_feature(self, scene_uid, feature_uid, bitset):
+        if scene_uid not in self.rows:
+            self.rows[scene_uid] = len(self.scene_uids)
+            self.scene_uids.append(scene_uid)
+            self.feature_bitsets.append({})
+            self.bitsets.append(0)
+        row = self.rows[scene_uid]
+        self.feature_bitsets[row][feature_uid] = bitset
+        self.bitsets[row] |= bitset
+        self.matrix = None
+
+    def remove_feature(self, scene_uid, feature_uid):
+        row = self.rows.get(scene_uid)
+        if row is None or feature_uid not in self.feature_bitsets[row]:
+            return
+        del self.feature_bitsets[row][feature_uid]
+        bitset = 0
+        for feature_bitset in self.feature_bitsets[row].values():
+            bitset |= feature_bitset
+        self.bitsets[row] = bitset
+        self.matrix = None
+
+    def remove_scene(self, scene_uid):
+        row = self.rows.pop(scene_uid, None)
+        if row is None:
+            return
+        for column in (self.scene_uids, self.feature_bitsets, self.bitsets):
+            del column[row]
+        for uid in self.scene_uids[row:]:
+            self.rows[uid] -= 1
+        self.matrix = None
+
+    def count_matches(self, bitset):
+        """
+        Returns the number of bits every scene has in common with the given bitset, by row
+        """
+        if np is None:
+            return [bin(scene_bitset & bitset).count("1") for scene_bitset in self.bitsets]
+        size = (len(self.bits) + 7) // 8
+        if self.matrix is None or self.matrix.shape[1] != size:
+            rows = b"".join(scene_bitset.to_bytes(size, "little") for scene_bitset in self.bitsets)
+            self.matrix = np.frombuffer(rows, dtype=np.uint8).reshape(len(self.bitsets), size)
+        observed = np.frombuffer(bitset.to_bytes(size, "little"), dtype=np.uint8)
+        return _POPCOUNT[self.matrix & observed].sum(axis=1).tolist()
+
+
+def _get_fovea_features(feature, netapi):
+    # the (fovea key, datasource) pairs of a feature: its position and the fovea sensors linked into its schema
+    key = fovea_key(feature.get_state('x'), feature.get_state('y'))
+    features = set()
+    for schema_node in traverse_schema(feature, netapi):
+        for slot_type in schema_node.get_slot_types():
+            for link in schema_node.get_slot(slot_type).get_links():
+                datasource = link.source_node.get_parameter("datasource") if link.source_node.type == "Sensor" else None
+                if datasource is not None and datasource.startswith("fovea-"):
+                    features.add((key, datasource))
+    return features
+
+
+def get_recognition_index(nodespace, netapi):
+    """
+    Returns the scene recognition index of the nodespace, built from the fovea indexes of its scenes once
+    """
+    indexes = _recognition_indexes.setdefault(netapi, {})
+    if nodespace not in indexes:
+        index = SceneRecognitionIndex()
+        for scene in find_nodes(nodespace, "Scene-", netapi):
+            for uids in get_fovea_index(scene, netapi).values():
+                for uid in uids:
+                    try:
+                        features = _get_fovea_features(netapi.get_node(uid), netapi)
+                    except KeyError:
+                        continue        # deleted without going through delete_schema
+                    index.add_feature(scene.uid, uid, index.get_bitset(features, create=True))
+        indexes[nodespace] = index
+    return indexes[nodespace]
+
+
+def _record_recognition_undo(index, scene_uid, feature_uids, netapi):
+    # restores the bitsets the given features of a scene have in the recognition index now, if an open fork is
+    # rolled back
+    row = index.rows.get(scene_uid)
+    previous = dict((uid, None if row is None else index.feature_bitsets[row].get(uid)) for uid in feature_uids)
+
+    def undo():
+        for feature_uid, bitset in previous.items():
+            if bitset is None:
+                index.remove_feature(scene_uid, feature_uid)
+            else:
+                index.add_feature(scene_uid, feature_uid, bitset)
+    record_undo(undo, netapi)
+
+
+def clear_recognition_index(netapi):
+    """
+    Drops all scene recognition indexes, i.e. after the nodenet has been edited without going through schematools
+    """
+    _recognition_indexes.pop(netapi, None)
+
+
+def record_fovea_observation(nodespace, x, y, fovea_sensors, netapi):
+    """
+    Records that the fovea sees the given active fovea sensors at the given position
+    """
+    index = get_recognition_index(nodespace, netapi)
+    for sensor in fovea_sensors:
+        index.observations.add((fovea_key(x, y), sensor.get_parameter("datasource") or sensor.name))
+
+
+def clear_fovea_observations(nodespace, netapi):
+    """
+    Forgets what the fovea has observed, i.e. because a new scene is shown
+    """
+    get_recognition_index(nodespace, netapi).observations.clear()
+
+
+def recognize_scenes(nodespace, netapi, complete=False):
+    """
+    Ranks the scenes of the nodespace by the number of features observed by the fovea they have,
+    without waiting for activation to spread through their recognition scripts.
+    :param nodespace: the nodespace of the scenes
+    :param netapi: netapi
+    :param complete: only return scenes that have every observed feature
+    :return: a list of (scene, number of observed features it has) tuples, best match first,
+    leaving out scenes without any observed feature
+    """
+    index = get_recognition_index(nodespace, netapi)
+    if len(index.observations) == 0:
+        return []
+    matches = index.count_matches(index.get_bitset(index.observations))
+    ranked = []
+    for row in sorted(range(len(matches)), key=lambda row: -matches[row]):
+        if matches[row] == 0 or (complete and matches[row] < len(index.observations)):
+            break
+        ranked.append((index.scene_uids[row], matches[row]))
+    result = []
+    for uid, count in ranked:
+        try:
+            result.append((netapi.get_node(uid), count))
+        except KeyError:
+            index.remove_scene(uid)     # deleted without going through delete_schema
+    return result
+
+
+def _resolve_template_value(value, values):
+    # "{key}" is replaced by the value itself, other strings are formatted, everything else is taken as it is
+    if isinstance(value, str):
+        if value.startswith("{") and value.endswith("}") and value[1:-1] in values:
+            return values[value[1:-1]]
+        return value.format(**values)
+    return value
+
+
+def instantiate_schema_template(template, nodespace, netapi, parent=None, sensors=(), **values):
+    """
+    Builds a schema from a declarative template (see FOVEA_FEATURE_TEMPLATE) as one batch.
+    The schema is only linked to its parent once it is complete, and if building it fails,
+    the nodes created so far are removed again, along with the sensors and actors created for it.
+    :param template: the template dict
+    :param nodespace: the nodespace to create the schema in
+    :param netapi: netapi
+    :param parent: if given, the schema head will be sub/sur linked to this node
+    :param sensors: the sensor nodes to create sensor proxies for
+    :param values: the values for the "{key}" placeholders in the template
+    :return: a dict of the template's node keys to the created nodes
+    """
+    nodes = {}
+    with StructureBatch(netapi) as batch:
+        for key, type, name in template["nodes"]:
+            nodes[key] = batch.create_node(type, nodespace, _resolve_template_value(name, values))
+        for key, state, value in template.get("states", []):
+            set_state(nodes[key], state, _resolve_template_value(value, values), netapi)
+        for key, parameter, value in template.get("parameters", []):
+            set_parameter(nodes[key], parameter, _resolve_template_value(value, values), netapi)
+        for source, target, linktype in template.get("reciprocal_links", []):
+            batch.link_with_reciprocal(nodes[source], nodes[target], linktype)
+        # plain links come second, so they can override the weights of reciprocal links
+        for source, gate, target, slot, weight in template.get("links", []):
+            batch.link(nodes[source], gate, nodes[target], slot, _resolve_template_value(weight, values))
+        for key, datatarget, weight in template.get("actors", []):
+            weight = _resolve_template_value(weight, values)
+            if weight != 0:
+                batch.link_actor(nodes[key], datatarget, weight)
+        for key, datasource in template.get("sensors", []):
+            batch.link_sensor(nodes[key], _resolve_template_value(datasource, values))
+        if "sensor_proxies" in template:
+            proxy_parent, type, name = template["sensor_proxies"]
+            for sensor in sensors:
+                proxy = batch.create_node(type, nodespace, _resolve_template_value(name, dict(values, sensor=sensor.name)))
+                batch.link_with_reciprocal(nodes[proxy_parent], proxy, "subsur")
+                batch.link_sensor(proxy, sensor.name)
+        if parent is not None:
+            batch.link_with_reciprocal(parent, nodes[template["head"]], "subsur")
+    return nodes
+
+
+def traverse_schema(node, netapi, visit=None, max_depth=MAX_SCHEMA_DEPTH):
+    """
+    Walks a schema along its sub links, iteratively and visiting every node only once.
+    Sub-schemas shared between several parents and looping links are visited once,
+    and deep schemas do not run into the recursion limit.
+    :param node: the head node of the schema
+    :param netapi: netapi
+    :param visit: an optional callback visit(node, sub_nodes), returning the sub nodes to descend into.
+    By default, all sub nodes are descended into.
+    :param max_depth: the nodes at this depth below the head are not descended into any further
+    :return: a list of the nodes visited, head first, in depth first order
+    """
+    visited_uids = set([node.uid])
+    visited_nodes = []
+    stack = [(node, 0)]
+    while len(stack) > 0:
+        current, depth = stack.pop()
+        visited_nodes.append(current)
+        sub_nodes = []
+        if "sub" in current.get_gate_types():
+            sub_nodes = netapi.get_nodes_in_gate_field(current, "sub")
+        if visit is not None:
+            sub_nodes = visit(current, sub_nodes)
+        if depth >= max_depth:
+            if len(sub_nodes) > 0:
+                netapi.logger.warning("Schema %s is deeper than %i nodes, not descending below %s.", node.name, max_depth, current.name)
+            continue
+        for sub_node in reversed(sub_nodes):
+            if sub_node.uid not in visited_uids:
+                visited_uids.add(sub_node.uid)
+                stack.append((sub_node, depth + 1))
+    return visited_nodes
+
 
 def delete_schema(node, netapi):
     """
-    Deletes the given schema fully, including the given head node
+    Deletes the given schema fully, including the given head node, except for sub schemas other schemas share
     :param node: the head node of a schema to be deleted
     :param netapi: natapi
     """
-    if "sub" in node.get_gate_types():
-        subs = netapi.get_nodes_in_gate_field(node, "sub")
-        for sub_node in subs:
-            if sub_node is not node:    # avoid infinite recursion on looping proxies
-                delete_schema(sub_node, netapi)
+    # sensors and actors are the nodenet's interface to the world, shared by all schemas linked to them
+    def schema_sub_nodes(current, sub_nodes):
+        return [sub_node for sub_node in sub_nodes if sub_node.type not in ("Sensor", "Actor")]
+
+    schema_nodes = traverse_schema(node, netapi, schema_sub_nodes)
+    schema_uids = set(schema_node.uid for schema_node in schema_nodes)
+
+    # sub schemas that are shared with other schemas (see merge_duplicate_schema) are kept, with everything below them
+    kept_uids = set()
+    for schema_node in schema_nodes[1:]:
+        if schema_node.uid not in kept_uids and any(sur_node.uid not in schema_uids for sur_node in
+                                                    netapi.get_nodes_in_gate_field(schema_node, "sur")):
+            kept_uids.update(kept_node.uid for kept_node in traverse_schema(schema_node, netapi, schema_sub_nodes))
+    if len(kept_uids) > 0:
+        schema_nodes = [schema_node for schema_node in schema_nodes if schema_node.uid not in kept_uids]
+        schema_uids -= kept_uids
+
+    # keep the fovea index of the scenes the deleted features belong to up to date
+    for schema_node in schema_nodes:
+        if schema_node.get_state('x') is not None and schema_node.get_state('y') is not None:
+            for sur_node in netapi.get_nodes_in_gate_field(schema_node, "sur"):
+                if sur_node.uid not in schema_uids:
+                    unindex_fovea_feature(sur_node, schema_node, netapi)
 
-    netapi.delete_node(node)
+    recognition_index = _recognition_indexes.get(netapi, {}).get(node.parent_nodespace)
+    if recognition_index is not None:
+        for schema_node in schema_nodes:
+            if schema_node.uid in recognition_index.rows:
+                _record_recognition_undo(recognition_index, schema_node.uid, list(
+                    recognition_index.feature_bitsets[recognition_index.rows[schema_node.uid]]), netapi)
+            recognition_index.remove_scene(schema_node.uid)
+
+    delete_nodes(reversed(schema_nodes), netapi)
 
 
 def create_merged_schema(schemas, netapi):
@@ -39,7 +552,7 @@ def merge_schemas(schemas, netapi):
     :param netapi: netapi
     """
     first_schema = schemas[0]
-    merged_head = netapi.create_node(first_schema.type, first_schema.parent_nodespace, first_schema.name)
+    merged_head = create_node(first_schema.type, first_schema.parent_nodespace, first_schema.name, netapi)
     merged_classifier_list = []
 
     for schema in schemas:
@@ -49,18 +562,18 @@ def merge_schemas(schemas, netapi):
             first_sub_schema = sub_schemas[0]
             if len(first_sub_schema.get_gate("por").get_links()) == len(sub_schemas):  # this is a classifier
                 merged_classifier_list.extend(sub_schemas)
-                netapi.delete_node(schema)
+                delete_node(schema, netapi)
             else:                                                                   # script or alternative
                 merged_classifier_list.append(schema)
-                netapi.unlink_direction(schema, "gen")
-                netapi.unlink_direction(schema, "por")
-                netapi.unlink_direction(schema, "ret")
-                netapi.unlink_direction(schema, "cat")
-                netapi.unlink_direction(schema, "exp")
+                unlink_direction(schema, "gen", netapi)
+                unlink_direction(schema, "por", netapi)
+                unlink_direction(schema, "ret", netapi)
+                unlink_direction(schema, "cat", netapi)
+                unlink_direction(schema, "exp", netapi)
 
     for schema in merged_classifier_list:
-        netapi.link_with_reciprocal(merged_head, schema, "subsur")
-    netapi.link_full(merged_classifier_list, "porret")
+        link_with_reciprocal(merged_head, schema, "subsur", netapi)
+    link_full(merged_classifier_list, "porret", netapi)
 
 
 def copy_schema(node, netapi):
@@ -74,78 +587,340 @@ def copy_schema(node, netapi):
     """
 
     original_schema_nodes = collect_schema_nodes(node, netapi)
-    copy_schema_nodes = {}
+    original_uids = set(original.uid for original in original_schema_nodes)
 
-    # copy all the nodes
+    # read the schema's link set once: every link leaving a schema node, and the links entering it from outside
+    original_links = []
     for original in original_schema_nodes:
-        copy_schema_node = netapi.create_node(original.type, original.parent_nodespace, original.name)
-        copy_schema_nodes[original.uid] = copy_schema_node
-
-    # now link them up
-    # links to copied nodes go to the copy, links to other nodes go to the original other nodes
-    for original in original_schema_nodes:
-        for slot_type in original.get_slot_types():
-            for link in original.get_slot(slot_type).get_links():
-                if link.source_node.uid in copy_schema_nodes:
-                    # link from copy
-                    if original.uid == node.uid and link.target_slot.type != "sur":
-                        break;  # don't por/ret or cat/exp link the copy of the head node
-                    netapi.link(
-                        copy_schema_nodes[link.source_node.uid],
-                        link.source_gate.type,
-                        copy_schema_nodes[original.uid],
-                        link.target_slot.type,
-                        link.weight,
-                        link.certainty)
-                else:
-                    # link from original
-                    if original.uid == node.uid and link.target_slot.type != "sur":
-                        break;  # don't por/ret or cat/exp link the copy of the head node
-                    netapi.link(
-                        link.source_node,
-                        link.source_gate.type,
-                        copy_schema_nodes[original.uid],
-                        link.target_slot.type,
-                        link.weight,
-                        link.certainty)
         for gate_type in original.get_gate_types():
-            for link in original.get_gate(gate_type).get_links():
-                if link.target_node.uid in copy_schema_nodes:
-                    # link to copy
-                    if original.uid == node.uid and link.source_gate.type != "sub":
-                        break;  # don't por/ret or cat/exp link the copy of the head node
-                    netapi.link(
-                        copy_schema_nodes[original.uid],
-                        link.source_gate.type,
-                        copy_schema_nodes[link.target_node.uid],
-                        link.target_slot.type,
-                        link.weight,
-                        link.certainty)
-                else:
-                    # link to original
-                    if original.uid == node.uid and link.source_gate.type != "sub":
-                        break;  # don't por/ret or cat/exp link the copy of the head node
-                    netapi.link(
-                        copy_schema_nodes[original.uid],
-                        link.source_gate.type,
-                        link.target_node,
-                        link.target_slot.type,
-                        link.weight,
-                        link.certainty)
+            original_links.extend(original.get_gate(gate_type).get_links())
+        for slot_type in original.get_slot_types():
+            for original_link in original.get_slot(slot_type).get_links():
+                if original_link.source_node.uid not in original_uids:
+                    original_links.append(original_link)
+
+    copy_schema_nodes = {}
+    with StructureBatch(netapi) as batch:
+        for original in original_schema_nodes:
+            copy_schema_nodes[original.uid] = batch.create_node(original.type, original.parent_nodespace, original.name)
+
+        # links to copied nodes go to the copy, links to other nodes go to the original other nodes
+        for original_link in original_links:
+            source_node = original_link.source_node
+            target_node = original_link.target_node
+            if source_node.uid == node.uid and original_link.source_gate.type != "sub":
+                continue    # don't por/ret or cat/exp link the copy of the head node
+            if target_node.uid == node.uid and original_link.target_slot.type != "sur":
+                continue    # same for links towards the head node
+            batch.link(
+                copy_schema_nodes.get(source_node.uid, source_node),
+                original_link.source_gate.type,
+                copy_schema_nodes.get(target_node.uid, target_node),
+                original_link.target_slot.type,
+                original_link.weight,
+                original_link.certainty)
 
     return copy_schema_nodes[node.uid]
 
 
 def collect_schema_nodes(node, netapi):
-    # collects all sub nodes (the whole schema)
-    sub_nodes = set()
-    sub_nodes.add(node)
-    if "sub" in node.get_gate_types():
-        subs = netapi.get_nodes_in_gate_field(node, "sub")
-        for sub_node in subs:
-            if sub_node is not node and sub_node.type == node.type:    # avoid infinite recursion on looping proxies
-                sub_nodes |= collect_schema_nodes(sub_node, netapi)
-    return sub_nodes
+    # collects all sub nodes (the whole schema), not descending into sub nodes of other types (i.e. sensors)
+    def same_type_sub_nodes(current, sub_nodes):
+        return [sub_node for sub_node in sub_nodes if sub_node.type == current.type]
+
+    return set(traverse_schema(node, netapi, same_type_sub_nodes))
+
+
+# protocol chains: a "Chain" node with the protocol elements proto-<index> below it, por-linked from the oldest
+# (the tail) to the newest (the head). Every element has the scenes protocolled for it below it, the ProtScenes,
+# and these have their Occurrences of known scenes below them.
+# The chain keeps the uids of its head and tail in its state, so neither has to be searched for.
+
+def get_protocol_chain(nodespace, netapi, create=False):
+    """
+    Returns the protocol chain of the nodespace, or None if there is none
+    :param nodespace: the nodespace to look in
+    :param netapi: netapi
+    :param create: create a chain with a first, empty protocol element if the nodespace has none
+    """
+    chains = find_nodes(nodespace, "Chain", netapi)
+    if len(chains) > 0:
+        return chains[0]   # todo: Handle cases with multiple protocols
+    if not create:
+        return None
+    chain = create_node("Pipe", nodespace, "Chain", netapi)
+    head = create_node("Pipe", nodespace, "proto-0", netapi)
+    set_state(head, "index", "0", netapi)
+    link_with_reciprocal(chain, head, "subsur", netapi)
+    set_state(chain, "head", head.uid, netapi)
+    set_state(chain, "tail", head.uid, netapi)
+    return chain
+
+
+def _get_protocol_end(chain, end, netapi):
+    uid = chain.get_state(end)
+    if uid is not None:
+        try:
+            return netapi.get_node(uid)
+        except KeyError:
+            pass
+    # chains without the state (i.e. from older nodenets) get it from their sub field once
+    open_gate = "por" if end == "head" else "ret"
+    node = netapi.get_nodes_in_gate_field(chain, "sub", [open_gate])[0]
+    set_state(chain, end, node.uid, netapi)
+    return node
+
+
+def get_protocol_head(chain, netapi):
+    """
+    Returns the newest element of a protocol chain, the pormost one
+    """
+    return _get_protocol_end(chain, "head", netapi)
+
+
+def get_protocol_tail(chain, netapi):
+    """
+    Returns the oldest element of a protocol chain, the retmost one
+    """
+    return _get_protocol_end(chain, "tail", netapi)
+
+
+def extend_protocol_chain(chain, netapi):
+    """
+    Appends a new, empty element to a protocol chain
+    :param chain: the Chain node of a protocol
+    :param netapi: netapi
+    :return: the new head of the protocol
+    """
+    head = get_protocol_head(chain, netapi)
+    index = int(head.get_state("index")) + 1
+    new_head = create_node("Pipe", chain.parent_nodespace, "proto-" + str(index), netapi)
+    set_state(new_head, "index", str(index), netapi)
+    link_with_reciprocal(chain, new_head, "subsur", netapi)
+    link_with_reciprocal(head, new_head, "porret", netapi)
+    set_state(chain, "head", new_head.uid, netapi)
+    return new_head
+
+
+def compact_protocol_chain(chain, retention, netapi):
+    """
+    Deletes the oldest elements of a protocol chain until no more than `retention` elements are left,
+    along with their ProtScenes and Occurrences. The scenes they refer to are kept.
+    The number of elements deleted over the life of the chain is kept in its "compacted" state.
+    If the chain is broken, i.e. an element has been deleted in the editor, compaction stops at the element
+    without a successor, which becomes the tail.
+    The protocol builder compacts its protocol after every new element, keeping the number of elements given
+    by its protocol_retention parameter. Without that parameter, the whole protocol is kept.
+    :param chain: the Chain node of a protocol
+    :param retention: the number of elements to keep, at least 1, or None to keep all
+    :param netapi: netapi
+    :return: the number of elements deleted
+    """
+    if retention is None:
+        return 0
+    retention = max(1, int(retention))
+    head_index = int(get_protocol_head(chain, netapi).get_state("index"))
+    tail = get_protocol_tail(chain, netapi)
+    expired_nodes = []
+    expired_count = 0
+    while head_index - int(tail.get_state("index")) >= retention:
+        successors = netapi.get_nodes_in_gate_field(tail, "por")
+        if len(successors) == 0:
+            netapi.logger.warning("Protocol chain %s is broken after %s, not compacting beyond it.", chain.name,
+                                  tail.name)
+            break
+        expired_nodes.append(tail)
+        for protocolled_scene in netapi.get_nodes_in_gate_field(tail, "sub"):
+            if protocolled_scene.name.startswith("ProtScene"):
+                expired_nodes.append(protocolled_scene)
+                for occurrence in netapi.get_nodes_in_gate_field(protocolled_scene, "sub"):
+                    if occurrence.name.startswith("Occurrence"):
+                        expired_nodes.append(occurrence)
+        expired_count += 1
+        tail = successors[0]
+    if chain.get_state("tail") != tail.uid:
+        set_state(chain, "tail", tail.uid, netapi)
+    if expired_count == 0:
+        return 0
+    delete_nodes(expired_nodes, netapi)
+    set_state(chain, "compacted", (chain.get_state("compacted") or 0) + expired_count, netapi)
+    return expired_count
+
+
+def get_cached_features(kind, node, netapi):
+    # returns the cached features of the given kind for the schema headed by node, or None
+    cache = _feature_caches.get(netapi)
+    if cache is None or (kind, node.uid) not in cache:
+        return None
+    cache.move_to_end((kind, node.uid))
+    return cache[(kind, node.uid)]
+
+
+def set_cached_features(kind, node, features, netapi):
+    cache = _feature_caches.setdefault(netapi, OrderedDict())
+    cache[(kind, node.uid)] = features
+    cache.move_to_end((kind, node.uid))
+    while len(cache) > FEATURE_CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+def invalidate_feature_cache(nodes, netapi):
+    """
+    Drops the cached features of the schemas headed by the given nodes and of all schemas above them
+    :param nodes: the nodes whose sub-structure has changed
+    :param netapi: netapi
+    """
+    cache = _feature_caches.get(netapi)
+    if not cache:
+        return
+    visited = set()
+    nodes = list(nodes)
+    while len(nodes) > 0:
+        node = nodes.pop()
+        if node.uid in visited:
+            continue
+        visited.add(node.uid)
+        cache.pop(('features', node.uid), None)
+        cache.pop(('visual', node.uid), None)
+        cache.pop(('hash', node.uid), None)
+        if "sur" in node.get_gate_types():
+            nodes.extend(netapi.get_nodes_in_gate_field(node, "sur"))
+        # the hashes of nodes cat-linked to a changed schema include its hash
+        if "exp" in node.get_gate_types():
+            nodes.extend(netapi.get_nodes_in_gate_field(node, "exp"))
+
+
+def clear_feature_cache(netapi):
+    """
+    Drops all cached features, i.e. after the nodenet has been edited without going through nettools
+    """
+    _feature_caches.pop(netapi, None)
+
+
+add_structure_listener(invalidate_feature_cache)
+
+
+def _hash_parts(*parts):
+    # a 64 bit hash of json serializable parts, the same in every process, unlike hash()
+    digest = hashlib.blake2b(json.dumps(parts, sort_keys=True).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+# the hash a node contributes to the hash of a node that is already being hashed, on looping links
+_CYCLE_HASH = _hash_parts("cycle")
+
+
+def get_schema_hash(node, netapi):
+    """
+    Returns a canonical structural hash of the schema headed by the given node, computed bottom-up:
+    the hash of a node covers its type and parameters, the datasources of the sensors linked to it,
+    the hashes of its sub nodes with the weights of their sub links, the por and ret links between these
+    sub nodes, and the hashes of the nodes it is cat-linked to.
+    Node names, uids and states are not part of the hash, so structurally equal schemas have equal hashes,
+    in every run and in every nodenet.
+    Hashes are kept in the feature cache, and recomputed from the cached hashes of unchanged sub schemas
+    after a change. The hashes of nodes that reach back into the nodes above them, or below MAX_SCHEMA_DEPTH,
+    depend on where the walk started, and are not cached.
+    :param node: the head node of the schema
+    :param netapi: netapi
+    :return: the hash, a 64 bit integer
+    """
+    hashes = {}
+    uncanonical_uids = set()
+    in_progress = set()
+    # post-order walk with an explicit stack: a node is pushed once to descend into it, and once more below
+    # its sub and cat nodes to be hashed after them
+    stack = [(node, 0, False)]
+    while len(stack) > 0:
+        current, depth, descended = stack.pop()
+        if not descended:
+            if current.uid in hashes or current.uid in in_progress:
+                continue
+            cached = get_cached_features('hash', current, netapi)
+            if cached is not None and cached[1] == _parameters_key(current):
+                hashes[current.uid] = cached[0]
+                continue
+            in_progress.add(current.uid)
+            stack.append((current, depth, True))
+            if depth < MAX_SCHEMA_DEPTH:
+                for child in reversed(_get_hashed_children(current, netapi)):
+                    if child.uid not in hashes and child.uid not in in_progress:
+                        stack.append((child, depth + 1, False))
+            continue
+
+        canonical = True
+
+        def child_hash(child):
+            # the hash of a node that is still being hashed, or that was not descended into, stands in as a cycle
+            nonlocal canonical
+            if child.uid not in hashes:
+                canonical = False
+                return _CYCLE_HASH
+            if child.uid in uncanonical_uids:
+                canonical = False
+            return hashes[child.uid]
+
+        gate_types = current.get_gate_types()
+        sensors = sorted(link.source_node.get_parameter("datasource") or ""
+                         for slot_type in current.get_slot_types()
+                         for link in current.get_slot(slot_type).get_links() if link.source_node.type == "Sensor")
+        sub_hashes = {}
+        sub_links = []
+        if "sub" in gate_types:
+            for link in current.get_gate("sub").get_links():
+                if link.target_node.uid not in sub_hashes:
+                    sub_hashes[link.target_node.uid] = child_hash(link.target_node)
+                sub_links.append((float(link.weight), sub_hashes[link.target_node.uid]))
+        sequence_links = []
+        for sub_node in netapi.get_nodes_in_gate_field(current, "sub") if "sub" in gate_types else []:
+            for linktype in ("por", "ret"):
+                if linktype in sub_node.get_gate_types():
+                    for link in sub_node.get_gate(linktype).get_links():
+                        if link.target_node.uid in sub_hashes:
+                            sequence_links.append((linktype, sub_hashes[sub_node.uid],
+                                                   sub_hashes[link.target_node.uid]))
+        categories = []
+        if "cat" in gate_types:
+            for category in netapi.get_nodes_in_gate_field(current, "cat"):
+                categories.append(child_hash(category))
+        in_progress.discard(current.uid)
+        hashes[current.uid] = _hash_parts(current.type, current.parameters or {}, sensors, sorted(sub_links),
+                                          sorted(sequence_links), sorted(categories))
+        if canonical:
+            set_cached_features('hash', current, (hashes[current.uid], _parameters_key(current)), netapi)
+        else:
+            uncanonical_uids.add(current.uid)
+    return hashes[node.uid]
+
+
+def _get_hashed_children(node, netapi):
+    # the nodes whose hashes are part of the hash of node, in the order get_schema_hash uses them
+    gate_types = node.get_gate_types()
+    children = []
+    if "sub" in gate_types:
+        children.extend(link.target_node for link in node.get_gate("sub").get_links())
+    if "cat" in gate_types:
+        children.extend(netapi.get_nodes_in_gate_field(node, "cat"))
+    return children
+
+
+def _parameters_key(node):
+    return json.dumps(node.parameters or {}, sort_keys=True)
+
+
+def invalidate_schema_hash(node, netapi):
+    """
+    Drops the cached hash of the given node, and the cached features above it, if its parameters have changed
+    since it was hashed. States are not part of the hash, so changing them keeps the cache.
+    :param node: the node whose state or parameters have changed
+    :param netapi: netapi
+    """
+    cache = _feature_caches.get(netapi)
+    if cache and ('hash', node.uid) in cache and cache[('hash', node.uid)][1] != _parameters_key(node):
+        invalidate_feature_cache([node], netapi)
+
+
+add_state_listener(invalidate_schema_hash)
 
 
 def collect_visual_feature_names(node, netapi):
@@ -153,19 +928,49 @@ def collect_visual_feature_names(node, netapi):
     # right now, this is using node names, which should be changed to use states instead
     # note that the reliance on strings is for convenience only, all the information in the strings is
     # also in the linkage structure towards sensors and could be extracted from there
+    cached = get_cached_features('visual', node, netapi)
+    if cached is not None:
+        return set(cached)
+
     visual_features = set()
 
     # look for sensor proxy nodes
-    if node.name.endswith(".Prx"):
-        visual_features.add(node.name)
+    for schema_node in traverse_schema(node, netapi):
+        if schema_node.name.endswith(".Prx"):
+            visual_features.add(schema_node.name)
 
-    if "sub" in node.get_gate_types():
-        subs = netapi.get_nodes_in_gate_field(node, "sub")
-        for sub_node in subs:
-            if sub_node is not node:    # avoid infinite recursion on looping proxies
-                visual_features |= collect_visual_feature_names(sub_node, netapi)
+    set_cached_features('visual', node, visual_features, netapi)
+    return set(visual_features)
+
+
+def get_feature_name(node, sub_field, netapi):
+    """
+    Returns the identity of the given node if it is a feature (see collect_features), None otherwise.
+    The identity of a feature is its structural hash (see get_schema_hash), so equal features
+    in different schemas have the same identity.
+    :param node: the node to check
+    :param sub_field: the nodes in the sub field of node
+    :param netapi: netapi
+    """
 
-    return visual_features
+    # a feature can be an exp of a single cat, read "inherit all features of this category"
+    if len(sub_field) == 0 and "cat" in node.get_gate_types():
+        cat_field = netapi.get_nodes_in_gate_field(node, "cat")
+        if len(cat_field) == 1:
+            return get_schema_hash(node, netapi)
+
+    # a feature can be a direct sensor standin/proxy
+    if len(sub_field) == 1:
+        if sub_field[0].type == "Sensor":
+            return get_schema_hash(node, netapi)
+
+    # a feature can be a script
+    if len(sub_field) > 1:
+        leftmost = netapi.get_nodes_in_gate_field(node, "sub", ["ret"])
+        if len(leftmost) == 1:
+            return get_schema_hash(node, netapi)
+
+    return None
 
 
 def collect_features(node, netapi):
@@ -178,56 +983,71 @@ def collect_features(node, netapi):
     Scripts and cats are opaque and will not be searched for features themselves.
     :param node: the head node of the schema to search
     :param netapi: netapi
-    :return: a set of features names, a dict of feature names to feature head nodes
+    :return: a set of feature identities, a dict of feature identities to feature head nodes
     """
 
+    cached = get_cached_features('features', node, netapi)
+    if cached is not None:
+        return set(cached[0]), dict(cached[1])
+
     feature_names = set()
     feature_nodes = {}
 
-    sub_field = netapi.get_nodes_in_gate_field(node, "sub")
+    def collect_feature(current, sub_field):
+        name = get_feature_name(current, sub_field, netapi)
+        if name is None:
+            return sub_field
+        feature_names.add(name)
+        feature_nodes[name] = current
+        return []               # features are opaque, don't search them for more features
 
-    is_a_feature = False
+    traverse_schema(node, netapi, collect_feature)
 
-    # a feature can be an exp of a single cat, read "inherit all features of this category"
-    if len(sub_field) == 0:
-        cat_field = netapi.get_nodes_in_gate_field(node, "cat")
-        if len(cat_field) == 1:
-            name = "exp-"+cat_field[0].uid
-            feature_names.add(name)
-            feature_nodes[name] = node
-            is_a_feature = True
+    set_cached_features('features', node, (feature_names, feature_nodes), netapi)
+    return set(feature_names), dict(feature_nodes)
 
-    # a feature can be a direct sensor standin/proxy
-    if len(sub_field) == 1:
-        if sub_field[0].type == "Sensor":
-            name = "sns-"+sub_field[0].get_parameter["datasource"]
-            feature_names.add(name)
-            feature_nodes[name] = node
-            is_a_feature = True
 
-    # a feature can be a script
-    if len(sub_field) > 1:
-        leftmost = netapi.get_nodes_in_gate_field(node, "sub", ["ret"])
-        if len(leftmost) == 1:
+def has_sufficient_feature_overlap(common_feature_count, feature_count1, feature_count2):
+    # abstractions are only built if at least a sixth of the two schemas' features are common
+    return common_feature_count >= (feature_count1 + feature_count2) / 6
+
 
-            # todo: check for real script equivalence instead of using this signature cheat
-            visual_feature_names = collect_visual_feature_names(node, netapi)
-            name = "scp-"
-            for vf_name in visual_feature_names:
-                name += vf_name
+def find_abstraction_candidate_pairs(schemas, netapi):
+    """
+    Finds the pairs of schemas that share enough features to be abstracted by create_common_feature_abstraction.
+    Schemas are paired through an inverted index of feature names to the schemas containing them,
+    so schemas without common features are never compared, and every pair is returned only once.
+    :param schemas: a list of schema head nodes, may contain duplicates and None
+    :param netapi: netapi
+    :return: a list of (schema1, schema2) tuples, in the order the schemas were given
+    """
+    candidates = []
+    known_uids = set()
+    for schema in schemas:
+        if schema is not None and schema.uid not in known_uids:
+            known_uids.add(schema.uid)
+            candidates.append(schema)
 
-            feature_names.add(name)
-            feature_nodes[name] = node
-            is_a_feature = True
+    feature_counts = []
+    schemas_by_feature = {}
+    for i, schema in enumerate(candidates):
+        feature_names, features = collect_features(schema, netapi)
+        feature_counts.append(len(feature_names))
+        for feature_name in feature_names:
+            schemas_by_feature.setdefault(feature_name, []).append(i)
 
-    if not is_a_feature and "sub" in node.get_gate_types():
-        for sub_node in sub_field:
-            if sub_node is not node:    # avoid infinite recursion on looping proxies
-                sub_names, sub_nodes = collect_features(sub_node, netapi)
-                feature_names |= sub_names
-                feature_nodes.update(sub_nodes)
+    common_feature_counts = {}
+    for indices in schemas_by_feature.values():
+        for a in range(len(indices)):
+            for b in range(a + 1, len(indices)):
+                pair = (indices[a], indices[b])
+                common_feature_counts[pair] = common_feature_counts.get(pair, 0) + 1
 
-    return feature_names, feature_nodes
+    pairs = []
+    for (i, j) in sorted(common_feature_counts):
+        if has_sufficient_feature_overlap(common_feature_counts[(i, j)], feature_counts[i], feature_counts[j]):
+            pairs.append((candidates[i], candidates[j]))
+    return pairs
 
 
 def create_common_feature_abstraction(schema1, schema2, netapi):
@@ -245,9 +1065,10 @@ def create_common_feature_abstraction(schema1, schema2, netapi):
     common_feature_names = feature_names_in_schema1 & feature_names_in_schema2      # that's intersection for you
 
     if len(common_feature_names) > 0:
-        netapi.logger.info("Common features of: "+str(schema1.name)+" and "+str(schema2.name)+": "+str(common_feature_names))
+        netapi.logger.info("Common features of: "+str(schema1.name)+" and "+str(schema2.name)+": "+
+                           str(sorted(features_in_schema1[name].name for name in common_feature_names)))
 
-    if len(common_feature_names) < (len(features_in_schema1)+len(feature_names_in_schema2)) / 6:
+    if not has_sufficient_feature_overlap(len(common_feature_names), len(features_in_schema1), len(feature_names_in_schema2)):
         return None             # do not do anything if less than a third of the schemas matches
 
     features = {}
@@ -255,36 +1076,331 @@ def create_common_feature_abstraction(schema1, schema2, netapi):
     features.update(features_in_schema2)
 
     # now build the new category
-    abstraction = netapi.create_node(schema1.type, schema1.parent_nodespace, "Common-"+schema1.name+"-and-"+schema2.name)
-    for common_feature_name in common_feature_names:
+    abstraction = create_node(schema1.type, schema1.parent_nodespace, "Common-"+schema1.name+"-and-"+schema2.name, netapi)
+    for common_feature_name in sorted(common_feature_names):
         feature = features[common_feature_name]
         feature_clone = copy_schema(feature, netapi)
-        netapi.link_with_reciprocal(abstraction, feature_clone, "subsur")
+        link_with_reciprocal(abstraction, feature_clone, "subsur", netapi)
 
     # por-ret the sub-field of the newly created abstraction
     feature_clones = netapi.get_nodes_in_gate_field(abstraction, "sub")
-    netapi.link_full(feature_clones, "porret")
+    link_full(feature_clones, "porret", netapi)
 
     # start to modify schema1
     # first, remove the common features
-    for common_feature_name in common_feature_names:
+    for common_feature_name in sorted(common_feature_names):
         feature = features[common_feature_name]
-        netapi.unlink(schema1, "sub", feature)
-        netapi.unlink(feature, "sur", schema1)
+        unlink(schema1, "sub", feature, netapi)
+        unlink(feature, "sur", schema1, netapi)
+        unindex_fovea_feature(schema1, feature, netapi)
     # second, install the new abstraction
-    nature = netapi.create_node(schema1.type, schema1.parent_nodespace, "Nature-"+abstraction.name)
-    netapi.link_with_reciprocal(schema1, nature, "subsur")
-    netapi.link_with_reciprocal(nature, abstraction, "catexp")
+    nature = create_node(schema1.type, schema1.parent_nodespace, "Nature-"+abstraction.name, netapi)
+    link_with_reciprocal(schema1, nature, "subsur", netapi)
+    link_with_reciprocal(nature, abstraction, "catexp", netapi)
 
     # start to modify schema2
     # first, remove the common features
-    for common_feature_name in common_feature_names:
+    for common_feature_name in sorted(common_feature_names):
         feature = features[common_feature_name]
-        netapi.unlink(schema2, "sub", feature)
-        netapi.unlink(feature, "sur", schema2)
+        unlink(schema2, "sub", feature, netapi)
+        unlink(feature, "sur", schema2, netapi)
+        unindex_fovea_feature(schema2, feature, netapi)
     # second, install the new abstraction
-    nature = netapi.create_node(schema2.type, schema2.parent_nodespace, "Nature-"+abstraction.name)
-    netapi.link_with_reciprocal(schema2, nature, "subsur")
-    netapi.link_with_reciprocal(nature, abstraction, "catexp")
+    nature = create_node(schema2.type, schema2.parent_nodespace, "Nature-"+abstraction.name, netapi)
+    link_with_reciprocal(schema2, nature, "subsur", netapi)
+    link_with_reciprocal(nature, abstraction, "catexp", netapi)
+
+    return abstraction
+
+
+# abstraction trials: the candidate abstractions of a set of schema pairs are built one after the other in a fork of
+# the nodenet (see NodenetFork), evaluated for a few steps, and rolled back. Then the best of them is built for good,
+# unless it makes the schemas of the pairs less active than they are without any abstraction.
+# The fork is only open while an abstraction is built, so the changes other native modules make during the
+# evaluation are kept. The candidates run on the live nodenet one after the other. So that their scores compare,
+# the datasource values read while the nodenet is evaluated without abstraction are recorded, and replayed to the
+# sensors for every candidate (see WorldAdapter.replay_datasources). Trials therefore need a world adapter that can
+# replay its datasources, like the ones of nodenetengine, or no world at all; start_abstraction_trial refuses others.
+
+# per netapi instance: a dict of the uids of the nodes running abstraction trials to their AbstractionTrial
+_abstraction_trials = weakref.WeakKeyDictionary()
+
+
+class AbstractionTrial(object):
+
+    def __init__(self, pairs, steps, tolerance):
+        self.pairs = pairs              # the candidate (schema1, schema2) pairs
+        self.steps = steps              # the number of steps every candidate is evaluated for
+        self.tolerance = tolerance      # the share of the score without abstractions a candidate may lose
+        self.candidate = -1             # the index of the pair being evaluated, -1 for no abstraction
+        self.step = 0                   # the number of steps the current candidate has been evaluated for
+        self.score = 0                  # the score of the current candidate so far
+        self.scores = []                # the scores without abstraction and of every pair, None if not built
+        self.fork = None                # the fork the current candidate has been built in
+        self.inputs = []                # the datasource values of every step without abstraction, to replay
+        self.abstraction = None         # the abstraction built for good when the trial has finished
+
+
+def _is_live(node, netapi):
+    # the node has been neither deleted nor deleted in a fork
+    try:
+        netapi.get_node(node.uid)
+    except KeyError:
+        return False
+    return not is_deleted(node, netapi)
+
+
+def _read_datasources(netapi):
+    # the datasource values the sensors have read in this step
+    world = netapi.world
+    if world is None:
+        return {}
+    return dict((key, world.get_datasource(key)) for key in world.get_available_datasources())
+
+
+def _replay_datasources(values, netapi):
+    # makes the sensors read the given values from the next step on, or the world's values again for None
+    if netapi.world is not None:
+        netapi.world.replay_datasources(values)
+
+
+def get_abstraction_trial(node, netapi):
+    """
+    Returns the abstraction trial the given node is running, or None
+    """
+    return _abstraction_trials.get(netapi, {}).get(node.uid)
+
+
+def start_abstraction_trial(node, pairs, netapi, steps=10, tolerance=0.1):
+    """
+    Starts trying the abstractions of the given schema pairs, see advance_abstraction_trial.
+    Raises a RuntimeError if the nodenet's world adapter cannot replay its datasources.
+    :param node: the node running the trial
+    :param pairs: a list of (schema1, schema2) tuples, as returned by find_abstraction_candidate_pairs
+    :param netapi: netapi
+    :param steps: the number of steps every abstraction is evaluated for
+    :param tolerance: the share of the activation of the schemas without abstractions an abstraction may lose
+    :return: the AbstractionTrial
+    """
+    if netapi.world is not None and not hasattr(netapi.world, "replay_datasources"):
+        raise RuntimeError("Abstraction trials need a world adapter that can replay its datasources, "
+                           "%s cannot" % type(netapi.world).__name__)
+    trial = AbstractionTrial(list(pairs), steps, tolerance)
+    _abstraction_trials.setdefault(netapi, {})[node.uid] = trial
+    return trial
+
+
+def advance_abstraction_trial(node, netapi):
+    """
+    Evaluates the current candidate of the node's abstraction trial for one more step, building the next candidate
+    in a fork first, or rolling the current one back after its last step.
+    A candidate's score is the activation of the schemas of all pairs, summed over its steps. Every candidate is
+    evaluated on the datasource values read in the steps without abstraction, replayed to the sensors.
+    After the last candidate, the one with the best score is built for good (see trial.abstraction),
+    if its score is not lower than the score without abstraction by more than the trial's tolerance.
+    :param node: the node running the trial
+    :param netapi: netapi
+    :return: True if the trial has finished
+    """
+    trial = get_abstraction_trial(node, netapi)
+
+    if trial.step == 0 and trial.candidate >= 0:
+        schema1, schema2 = trial.pairs[trial.candidate]
+        abstraction = None
+        trial.fork = NodenetFork(netapi).open()
+        try:
+            if _is_live(schema1, netapi) and _is_live(schema2, netapi):
+                abstraction = create_common_feature_abstraction(schema1, schema2, netapi)
+        finally:
+            trial.fork.suspend()
+        if abstraction is None:
+            trial.fork.rollback()
+            trial.fork = None
+            trial.step = trial.steps
+            trial.score = None
+
+    if trial.score is not None:
+        if trial.candidate < 0:
+            trial.inputs.append(_read_datasources(netapi))
+        for pair in trial.pairs:
+            trial.score += sum(schema.activation for schema in pair if _is_live(schema, netapi))
+        trial.step += 1
+
+    if trial.step < trial.steps:
+        if trial.candidate >= 0:
+            _replay_datasources(trial.inputs[trial.step], netapi)
+        return False
+    if trial.fork is not None:
+        trial.fork.rollback()
+        trial.fork = None
+    trial.scores.append(trial.score)
+    trial.candidate += 1
+    trial.step = 0
+    trial.score = 0
+    if trial.candidate < len(trial.pairs):
+        _replay_datasources(trial.inputs[0], netapi)
+        return False
+
+    _replay_datasources(None, netapi)
+    del _abstraction_trials[netapi][node.uid]
+    minimum_score = trial.scores[0] * (1 - trial.tolerance)
+    best = None
+    for i, score in enumerate(trial.scores[1:]):
+        if score is not None and score >= minimum_score and (best is None or score > trial.scores[best + 1]):
+            best = i
+    netapi.logger.info("Abstraction trial scores: %s, without abstraction: %s", trial.scores[1:], trial.scores[0])
+    if best is not None:
+        schema1, schema2 = trial.pairs[best]
+        if _is_live(schema1, netapi) and _is_live(schema2, netapi):
+            trial.abstraction = create_common_feature_abstraction(schema1, schema2, netapi)
+    return True
+
+
+# schema compaction: a pass over the Pipe nodes of a nodespace, a few nodes per step, that merges structurally
+# identical sub schemas onto one shared instance, and optionally deletes schemas that have not been active
+# for a number of steps and that nothing refers to. See compact_schemas.
+
+# the nodes of protocol chains are never compacted, their structure is maintained by the protocol functions
+PROTOCOL_NAME_PREFIXES = ("Chain", "proto-", "ProtScene", "Occurrence")
+
+# nodes are considered active in a step if their activation is above this
+IDLE_ACTIVATION = 0.01
+
+# per netapi instance: a dict of nodespaces to their SchemaCompaction
+_schema_compactions = weakref.WeakKeyDictionary()
+
+
+class SchemaCompaction(object):
+
+    def __init__(self):
+        self.queue = []         # the uids of the nodes still to be examined in the current pass, last one first
+        self.originals = {}     # schema hashes to the uid of the first node found with that hash in the current pass
+        self.last_active = {}   # node uids to the last step the node was active or first examined
+        self.passes = 0
+        self.merged = 0
+        self.collected = 0
+
+
+def _is_mergeable(node):
+    # sub schemas can be shared, as long as they are not part of a script: Pipe parents only listen to their
+    # sub nodes' sur links while they request them through their own sub links
+    return (node.type == "Pipe" and not node.name.startswith(PROTOCOL_NAME_PREFIXES) and
+            not node.get_gate("sur").empty and node.get_gate("por").empty and node.get_gate("ret").empty)
+
+
+def _is_unreferenced(node):
+    # a schema head that no schema, register or category link refers to
+    return (node.type == "Pipe" and not node.name.startswith(PROTOCOL_NAME_PREFIXES) and
+            node.get_gate("sur").empty and
+            all(node.get_slot(slot_type).empty for slot_type in ("sub", "cat", "por", "ret")))
+
+
+def merge_duplicate_schema(duplicate, original, netapi):
+    """
+    Makes everything linked to a schema use a structurally identical one (see get_schema_hash) instead,
+    and deletes the former.
+    :param duplicate: the head node of the schema to replace
+    :param original: the head node of the schema to keep
+    :param netapi: netapi
+    :return: True if the schemas have been merged, False if they are nested in each other
+    """
+    def schema_sub_nodes(current, sub_nodes):
+        return [sub_node for sub_node in sub_nodes if sub_node.type not in ("Sensor", "Actor")]
+
+    schema_uids = set(schema_node.uid for schema_node in traverse_schema(duplicate, netapi, schema_sub_nodes))
+    original_uids = set(schema_node.uid for schema_node in traverse_schema(original, netapi, schema_sub_nodes))
+    if original.uid in schema_uids or duplicate.uid in original_uids:
+        return False
+    schema_uids |= original_uids
+
+    # links to and from outside of the two schemas move from the duplicate to the original
+    for gate_type in duplicate.get_gate_types():
+        for gate_link in duplicate.get_gate(gate_type).get_links():
+            if gate_link.target_node.uid not in schema_uids:
+                link(original, gate_type, gate_link.target_node, gate_link.target_slot.type, netapi,
+                     gate_link.weight, gate_link.certainty)
+    for slot_type in duplicate.get_slot_types():
+        for slot_link in duplicate.get_slot(slot_type).get_links():
+            if slot_link.source_node.uid not in schema_uids:
+                link(slot_link.source_node, slot_link.source_gate.type, original, slot_type, netapi,
+                     slot_link.weight, slot_link.certainty)
+
+    # the scenes the duplicate has been a feature of have the original now
+    for sur_node in netapi.get_nodes_in_gate_field(duplicate, "sur"):
+        if duplicate.uid in [uid for uids in (sur_node.get_state('fovea_index') or {}).values() for uid in uids]:
+            index_fovea_feature(sur_node, original, netapi)
+
+    delete_schema(duplicate, netapi)
+    return True
+
+
+def get_schema_compaction(nodespace, netapi):
+    """
+    Returns the state of the schema compaction of the nodespace
+    """
+    return _schema_compactions.setdefault(netapi, {}).setdefault(nodespace, SchemaCompaction())
+
+
+def compact_schemas(nodespace, netapi, budget=32, idle_steps=None):
+    """
+    Examines the next `budget` Pipe nodes of the nodespace, one pass over all of them after the other.
+    A node that is structurally identical to one examined before in the same pass (see get_schema_hash), has the
+    same position states and can be shared (it has a parent and no por/ret links), is merged onto the earlier one.
+    If idle_steps is given, schema heads that nothing refers to and that have not been active for idle_steps steps
+    are deleted. Protocol chains are left alone.
+    :param nodespace: the nodespace to compact
+    :param netapi: netapi
+    :param budget: the number of nodes to examine in this call
+    :param idle_steps: the number of steps after which unreferenced schemas are deleted, None to keep them
+    :return: True if a pass has been completed in this call
+    """
+    compaction = get_schema_compaction(nodespace, netapi)
+    step = netapi.step
+
+    if idle_steps is not None:
+        for node in netapi.get_nodes_active(nodespace, "Pipe", IDLE_ACTIVATION):
+            compaction.last_active[node.uid] = step
+
+    if len(compaction.queue) == 0:
+        uids = [node.uid for node in netapi.get_nodes(nodespace) if node.type == "Pipe"]
+        compaction.queue = uids[::-1]
+        compaction.originals = {}
+        compaction.last_active = dict((uid, compaction.last_active.get(uid, step)) for uid in uids)
+
+    for i in range(min(budget, len(compaction.queue))):
+        uid = compaction.queue.pop()
+        try:
+            node = netapi.get_node(uid)
+        except KeyError:
+            continue            # deleted since the pass started
+        if is_deleted(node, netapi):
+            continue            # deleted in a fork, see NodenetFork
+
+        if idle_steps is not None and _is_unreferenced(node) and \
+                step - compaction.last_active.get(uid, step) >= idle_steps:
+            netapi.logger.debug("Schema compaction deleting unused schema %s.", node.name)
+            delete_schema(node, netapi)
+            compaction.collected += 1
+            continue
+
+        if not _is_mergeable(node):
+            continue
+        schema_hash = get_schema_hash(node, netapi)
+        original = None
+        if schema_hash in compaction.originals:
+            try:
+                original = netapi.get_node(compaction.originals[schema_hash])
+            except KeyError:
+                pass
+        if original is not None and _is_mergeable(original) and get_schema_hash(original, netapi) == schema_hash and \
+                (original.get_state('x'), original.get_state('y')) == (node.get_state('x'), node.get_state('y')):
+            netapi.logger.debug("Schema compaction merging %s onto %s.", node.name, original.name)
+            if merge_duplicate_schema(node, original, netapi):
+                compaction.merged += 1
+                continue
+        compaction.originals[schema_hash] = uid
 
-    return abstraction
\ No newline at end of file
+    if len(compaction.queue) == 0:
+        compaction.passes += 1
+        return True
+    return False
@@ -0,0 +1,148 @@
+__author__ = 'rvuine'
+
+# A headless simulation of the StructuredObjects world adapter, for running nodenets outside the runtime.
+#
+# The agent looks at one structured object: a 5x5 grid of cells (the shape_grid saved with the agent's scene
+# in the world file), each empty or holding a shape with a color and a type. The fovea sits on one cell,
+# at x and y from -2 to 2, with the cell for (x, y) at shape_grid[y + 2][x + 2].
+#
+# Datasources:
+#   fov-x, fov-y          the fovea position
+#   fovea-<color/type>    1 if the cell under the fovea has that color or type
+#   presence-<color/type> 1 if any cell of the object has that color or type
+#   major-newscene        1 in the first step after a new object has been shown
+# Datatargets:
+#   fov_reset             if positive, moves the fovea to 0/0 before fov_x and fov_y are applied
+#   fov_x, fov_y          move the fovea by that many cells, it stays within the grid
+#
+# The datasources only depend on the object and the fovea position, so they are precomputed once per object
+# as a sensor table of all datasource values for every fovea position (build_sensor_table). Reading the
+# sensors after a fovea move is a lookup in that table. With numpy, the tables of many objects can be
+# stacked (stack_sensor_tables) to read the sensors of many agents or runs at once (read_sensor_tables).
+
+import json
+from collections import OrderedDict
+
+from nodenetengine import WorldAdapter, np
+
+FOVEA_RANGE = 2
+
+# upper bound for the number of cached sensor tables
+SENSOR_TABLE_CACHE_SIZE = 256
+
+# (object, datasources) to sensor table, least recently used first
+_sensor_tables = OrderedDict()
+
+
+def _datasource_value(key, cell, present_properties, x, y):
+    if key.startswith("fovea-"):
+        return 1.0 if cell is not None and key[len("fovea-"):] in (cell["color"], cell["type"]) else 0.0
+    if key.startswith("presence-"):
+        return 1.0 if key[len("presence-"):] in present_properties else 0.0
+    if key == "fov-x":
+        return float(x)
+    if key == "fov-y":
+        return float(y)
+    # major-newscene is not a property of the object
+    return 0.0
+
+
+def build_sensor_table(shape_grid, datasources):
+    """
+    Returns the values of the given datasources for every fovea position on an object,
+    indexed by [fovea_y + FOVEA_RANGE][fovea_x + FOVEA_RANGE][datasource].
+    A float array if numpy is available, nested lists otherwise.
+    :param shape_grid: the shape_grid of the object
+    :param datasources: a list of datasource names
+    """
+    present_properties = set()
+    for row in shape_grid:
+        for cell in row:
+            if cell is not None:
+                present_properties.update((cell["color"], cell["type"]))
+    positions = range(-FOVEA_RANGE, FOVEA_RANGE + 1)
+    table = [[[_datasource_value(key, shape_grid[y + FOVEA_RANGE][x + FOVEA_RANGE], present_properties, x, y)
+               for key in datasources] for x in positions] for y in positions]
+    return np.array(table) if np is not None else table
+
+
+def get_sensor_table(shape_grid, datasources):
+    """
+    Returns the sensor table of an object, from the cache if it has been built before
+    """
+    key = (json.dumps(shape_grid, sort_keys=True), tuple(datasources))
+    table = _sensor_tables.pop(key, None)
+    if table is None:
+        table = build_sensor_table(shape_grid, datasources)
+    _sensor_tables[key] = table
+    while len(_sensor_tables) > SENSOR_TABLE_CACHE_SIZE:
+        _sensor_tables.popitem(last=False)
+    return table
+
+
+def stack_sensor_tables(shape_grids, datasources):
+    """
+    Returns the sensor tables of the given objects as one array, indexed by [object][y][x][datasource]
+    """
+    if np is None:
+        raise ImportError("stack_sensor_tables needs numpy")
+    return np.stack([get_sensor_table(shape_grid, datasources) for shape_grid in shape_grids])
+
+
+def read_sensor_tables(tables, objects, fovea_x, fovea_y):
+    """
+    Reads the datasources of many agents at once
+    :param tables: stacked sensor tables, see stack_sensor_tables
+    :param objects: the index of the object each agent is looking at, in the stacked tables
+    :param fovea_x: the fovea x position of each agent
+    :param fovea_y: the fovea y position of each agent
+    :return: an array of the datasource values, indexed by [agent][datasource]
+    """
+    return tables[np.asarray(objects), np.asarray(fovea_y) + FOVEA_RANGE, np.asarray(fovea_x) + FOVEA_RANGE]
+
+
+class StructuredObjectsWorld(WorldAdapter):
+    """
+    The StructuredObjects world adapter of one agent, on the scene saved with it in a world file.
+    Call update() after every nodenet step, to apply the datatargets and refresh the datasources.
+    """
+
+    def __init__(self, world_data, agent_uid=None):
+        declaration = world_data["worldadapters"]["StructuredObjects"]
+        WorldAdapter.__init__(self, declaration["datasources"], declaration["datatargets"])
+        agents = world_data.get("agents", {})
+        if agent_uid is None:
+            agent_uid = sorted(agents)[0]
+        self.show_scene(agents[agent_uid]["scene"])
+
+    def show_scene(self, scene):
+        """
+        Shows the agent a new object
+        :param scene: a dict with the object's shape_grid and the fovea position
+        """
+        self.shape_grid = scene["shape_grid"]
+        self.fovea_x = scene.get("fovea_x", 0)
+        self.fovea_y = scene.get("fovea_y", 0)
+        self.sensor_table_keys = list(self.datasources)
+        self.sensor_table = get_sensor_table(self.shape_grid, self.sensor_table_keys)
+        self.update_datasources(new_scene=True)
+
+    def get_cell(self, x, y):
+        if -FOVEA_RANGE <= x <= FOVEA_RANGE and -FOVEA_RANGE <= y <= FOVEA_RANGE:
+            return self.shape_grid[y + FOVEA_RANGE][x + FOVEA_RANGE]
+        return None
+
+    def update(self):
+        if self.datatargets.get("fov_reset", 0) > 0:
+            self.fovea_x = 0
+            self.fovea_y = 0
+        self.fovea_x = max(-FOVEA_RANGE, min(FOVEA_RANGE, self.fovea_x + int(round(self.datatargets.get("fov_x", 0)))))
+        self.fovea_y = max(-FOVEA_RANGE, min(FOVEA_RANGE, self.fovea_y + int(round(self.datatargets.get("fov_y", 0)))))
+        self.update_datasources()
+
+    def update_datasources(self, new_scene=False):
+        values = self.sensor_table[self.fovea_y + FOVEA_RANGE][self.fovea_x + FOVEA_RANGE]
+        if np is not None:
+            values = values.tolist()
+        self.datasources.update(zip(self.sensor_table_keys, values))
+        self.datasources["major-newscene"] = 1.0 if new_scene else 0.0
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules of this repository are top level modules, next to the tests directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
@@ -0,0 +1,96 @@
+import json
+import os
+
+from experimentrunner import PipelinedWorldAdapter, apply_overrides, run_experiment, run_experiments, step_pipelined
+from nodenetengine import WorldAdapter, np
+
+PACKAGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+NODENET_PATH = os.path.join(PACKAGE_PATH, "nodenets", "851def94d5f011e382990023dfa615aa.json")
+WORLD_PATH = os.path.join(PACKAGE_PATH, "worlds", "6df3bffaf95f11e38a330023dfa615aa.json")
+
+
+def _load(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def _metrics(result):
+    return dict((key, value) for key, value in result.items() if key != "wall_time")
+
+
+def test_same_seed_gives_same_metrics():
+    nodenet_data, world_data = _load(NODENET_PATH), _load(WORLD_PATH)
+    results = [run_experiment(nodenet_data, world_data, 300, seed=1, engine="dict") for run in range(2)]
+    assert results[0]["features_imported"] > 0
+    assert _metrics(results[0]) == _metrics(results[1])
+    if np is not None:
+        assert _metrics(run_experiment(nodenet_data, world_data, 300, seed=1, engine="array")) == _metrics(results[0])
+
+
+def test_pool_runs_match_single_runs():
+    overrides = [None, {"Importer": {"saccade_planner": "random"}}]
+    results = run_experiments(NODENET_PATH, WORLD_PATH, 200, seeds=[0, 1], overrides=overrides, processes=2,
+                              engine="dict")
+    nodenet_data, world_data = _load(NODENET_PATH), _load(WORLD_PATH)
+    expected = [run_experiment(nodenet_data, world_data, 200, seed, override, "dict")
+                for override in overrides for seed in [0, 1]]
+    assert [_metrics(result) for result in results] == [_metrics(result) for result in expected]
+
+
+def test_apply_overrides_leaves_the_nodenet_data_alone():
+    nodenet_data = _load(NODENET_PATH)
+    overridden = apply_overrides(nodenet_data, {"Importer": {"saccade_planner": "random"}})
+    importer_uid = [uid for uid, node_data in nodenet_data["nodes"].items() if node_data["name"] == "Importer"][0]
+    assert overridden["nodes"][importer_uid]["parameters"]["saccade_planner"] == "random"
+    assert "saccade_planner" not in (nodenet_data["nodes"][importer_uid].get("parameters") or {})
+
+
+class _EchoWorld(WorldAdapter):
+    # shows the last value written to the "out" datatarget in the "echo" datasource after an update
+
+    def __init__(self):
+        WorldAdapter.__init__(self, ["echo"], ["out"])
+
+    def update(self):
+        self.datasources["echo"] = self.datatargets["out"]
+
+
+class _CountingNodenet(object):
+    # writes the number of every step to the "out" datatarget, and records what it reads from "echo" in every step
+
+    def __init__(self, world_adapter):
+        self.world_adapter = world_adapter
+        self.read = []
+
+    def step(self):
+        self.read.append(self.world_adapter.get_datasource("echo"))
+        self.world_adapter.datatargets["out"] = float(len(self.read))
+
+
+def test_datasources_lag_the_datatargets_by_the_sensor_lag():
+    world = _EchoWorld()
+    nodenet = _CountingNodenet(world)
+    for step in range(10):
+        nodenet.step()
+        world.update()
+
+    pipelined_world = _EchoWorld()
+    pipelined_nodenet = _CountingNodenet(PipelinedWorldAdapter(pipelined_world))
+    steps = []
+    step_pipelined(pipelined_nodenet, 10, steps.append)
+    assert steps == list(range(10))
+
+    # step n reads what step n - sensor_lag - 1 has written, or 0 before the first step
+    for nodenet in (nodenet, pipelined_nodenet):
+        lag = nodenet.world_adapter.sensor_lag
+        assert nodenet.read == [float(max(0, step - lag - 1)) for step in range(1, 11)]
+    assert (world.sensor_lag, pipelined_nodenet.world_adapter.sensor_lag) == (0, 1)
+
+
+def test_world_latency_only_changes_the_wall_time():
+    nodenet_data, world_data = _load(NODENET_PATH), _load(WORLD_PATH)
+    for pipelined in (False, True):
+        result = run_experiment(nodenet_data, world_data, 100, engine="dict", pipelined=pipelined)
+        latent = run_experiment(nodenet_data, world_data, 100, engine="dict", pipelined=pipelined, world_latency=0.001)
+        assert latent["wall_time"] >= 0.1
+        assert dict(_metrics(latent), world_latency=0.0) == _metrics(result)
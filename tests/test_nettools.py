@@ -0,0 +1,204 @@
+import pytest
+
+from nettools import *
+from nodenetengine import ArrayNodenet, DictNodenet, WorldAdapter, np
+
+ENGINES = [DictNodenet, ArrayNodenet] if np is not None else [DictNodenet]
+
+
+def _create_netapi(datasources=(), datatargets=()):
+    return DictNodenet(world_adapter=WorldAdapter(datasources, datatargets)).netapi
+
+
+def _gate_links(node, gate_type):
+    return [(link.target_node.uid, link.target_slot.type) for link in node.get_gate(gate_type).get_links()]
+
+
+def test_name_registry_finds_nodes_by_prefix():
+    netapi = _create_netapi()
+    scene2 = create_node("Pipe", "Root", "Scene-2", netapi)
+    scene1 = create_node("Pipe", "Root", "Scene-1", netapi)
+    create_node("Pipe", "Root", "Chain", netapi)
+    assert find_nodes("Root", "Scene-", netapi) == [scene1, scene2]
+    delete_node(scene1, netapi)
+    assert find_nodes("Root", "Scene-", netapi) == [scene2]
+    assert find_nodes("Root", "Occurrence", netapi) == []
+
+
+def test_name_registry_is_rebuilt_after_invalidation():
+    netapi = _create_netapi()
+    find_nodes("Root", "Scene-", netapi)
+    scene = netapi.create_node("Pipe", "Root", "Scene-1")
+    assert find_nodes("Root", "Scene-", netapi) == []
+    invalidate_name_registry(netapi)
+    assert find_nodes("Root", "Scene-", netapi) == [scene]
+
+
+def test_name_registry_removes_nodes_renamed_outside_nettools():
+    netapi = _create_netapi()
+    scene1 = create_node("Pipe", "Root", "Scene-1", netapi)
+    scene2 = create_node("Pipe", "Root", "Scene-2", netapi)
+    last = create_node("Pipe", "Root", "Scene-3", netapi)
+    find_nodes("Root", "Scene-", netapi)
+    scene1.name = "Scene-2"
+    last.name = "Scene-4"
+    delete_node(scene1, netapi)
+    assert find_nodes("Root", "Scene-", netapi) == [scene2, last]
+    delete_node(last, netapi)
+    assert find_nodes("Root", "Scene-", netapi) == [scene2]
+
+
+def test_interface_registry_finds_imported_sensors_and_actors():
+    netapi = _create_netapi(["fovea_x", "fovea_y"], ["fov_x"])
+    import_sensors("Root", netapi)
+    import_actors("Root", netapi)
+    registry = get_interface_registry("Root", netapi)
+    sensor = registry.get("Sensor", "fovea_x")
+    assert sensor.type == "Sensor" and sensor.get_parameter("datasource") == "fovea_x"
+    assert registry.get("Actor", "fov_x").get_parameter("datatarget") == "fov_x"
+    assert registry.get("Sensor", "unknown") is None
+
+    # importing again for the same world adapter creates nothing
+    node_count = len(netapi.get_nodes("Root"))
+    import_sensors("Root", netapi)
+    import_actors("Root", netapi)
+    assert len(netapi.get_nodes("Root")) == node_count
+
+    # linking uses the imported nodes
+    pipe = create_node("Pipe", "Root", "Pipe", netapi)
+    link_sensor(pipe, "fovea_y", netapi)
+    link_actor(pipe, "fov_x", netapi)
+    assert len(netapi.get_nodes("Root")) == node_count + 1
+    assert [link.source_node for link in pipe.get_slot("sur").get_links()] == [registry.get("Sensor", "fovea_y")]
+    assert [link.target_node for link in pipe.get_gate("sub").get_links()] == [registry.get("Actor", "fov_x")]
+
+
+def test_interface_registry_follows_new_datasources_and_deleted_sensors():
+    netapi = _create_netapi(["fovea_x"])
+    import_sensors("Root", netapi)
+    netapi.world.datasources["fovea_y"] = 0
+    import_sensors("Root", netapi)
+    registry = get_interface_registry("Root", netapi)
+    assert registry.get("Sensor", "fovea_y") is not None
+
+    # deleting a sensor drops the registry, to be rebuilt without it
+    delete_node(registry.get("Sensor", "fovea_x"), netapi)
+    assert get_interface_registry("Root", netapi).get("Sensor", "fovea_x") is None
+    import_sensors("Root", netapi)
+    assert sorted(node.get_parameter("datasource") for node in netapi.get_nodes("Root")) == ["fovea_x", "fovea_y"]
+
+
+def test_import_without_world_does_nothing():
+    netapi = _create_netapi()
+    netapi.nodenet.world_adapter = None
+    import_sensors("Root", netapi)
+    import_actors("Root", netapi)
+    assert netapi.get_nodes("Root") == []
+
+
+def _create_lit_nodenet(engine_class):
+    # a nodenet whose sensors for the "light" datasource are active once it is switched on
+    world_adapter = WorldAdapter(["light"])
+    return engine_class(world_adapter=world_adapter)
+
+
+def _create_sensor(name, netapi):
+    sensor = create_node("Sensor", "Root", name, netapi)
+    set_parameter(sensor, "datasource", "light", netapi)
+    return sensor
+
+
+@pytest.mark.parametrize("engine_class", ENGINES, ids=lambda engine_class: engine_class.__name__)
+def test_activation_watch_follows_threshold_crossings(engine_class):
+    nodenet = _create_lit_nodenet(engine_class)
+    netapi = nodenet.netapi
+    _create_sensor("Scene-1", netapi)
+    watch = get_activation_watch("Root", "Scene-", 0.5, netapi)
+    assert get_activation_watch("Root", "Scene-", 0.5, netapi) is watch
+    nodenet.step()
+    assert not watch.any_active()
+
+    netapi.world.datasources["light"] = 1.0
+    nodenet.step()
+    assert watch.any_active()
+    netapi.world.datasources["light"] = 0.0
+    nodenet.step()
+    assert not watch.any_active()
+
+    # nodes created through nettools are watched from then on
+    netapi.world.datasources["light"] = 1.0
+    first = find_nodes("Root", "Scene-1", netapi)[0]
+    delete_node(first, netapi)
+    second = _create_sensor("Scene-2", netapi)
+    nodenet.step()
+    assert watch.any_active()
+    delete_node(second, netapi)
+    assert not watch.any_active()
+
+
+@pytest.mark.parametrize("engine_class", ENGINES, ids=lambda engine_class: engine_class.__name__)
+def test_activation_watch_forgets_nodes_deleted_through_the_netapi(engine_class):
+    nodenet = _create_lit_nodenet(engine_class)
+    netapi = nodenet.netapi
+    netapi.world.datasources["light"] = 1.0
+    sensor = _create_sensor("Scene-1", netapi)
+    watch = get_activation_watch("Root", "Scene-", 0.5, netapi)
+    nodenet.step()
+    assert watch.any_active()
+    netapi.delete_node(sensor)
+    assert not watch.any_active()
+
+
+def test_fork_rollback_restores_the_nodenet():
+    netapi = _create_netapi()
+    scene = create_node("Pipe", "Root", "Scene-1", netapi)
+    feature = create_node("Pipe", "Root", "Feature", netapi)
+    other = create_node("Pipe", "Root", "Other", netapi)
+    link_with_reciprocal(scene, feature, "subsur", netapi)
+    set_state(scene, "x", 1, netapi)
+    links_before = _gate_links(scene, "sub"), _gate_links(feature, "sur")
+
+    fork = NodenetFork(netapi).open()
+    created = create_node("Pipe", "Root", "Nature", netapi)
+    link_with_reciprocal(scene, created, "subsur", netapi)
+    unlink(scene, "sub", feature, netapi)
+    set_state(scene, "x", 2, netapi)
+    set_state(scene, "y", 3, netapi)
+    set_parameter(scene, "name", "Changed", netapi)
+    delete_node(other, netapi)
+    assert is_deleted(other, netapi)
+    fork.rollback()
+
+    assert (_gate_links(scene, "sub"), _gate_links(feature, "sur")) == links_before
+    assert created.uid not in [node.uid for node in netapi.get_nodes("Root")]
+    assert scene.get_state("x") == 1 and scene.get_state("y") is None
+    assert scene.get_parameter("name") is None
+    assert not is_deleted(other, netapi)
+    assert find_nodes("Root", "Other", netapi) == [other]
+    assert find_nodes("Root", "Nature", netapi) == []
+
+
+def test_fork_commit_keeps_the_changes():
+    netapi = _create_netapi()
+    scene = create_node("Pipe", "Root", "Scene-1", netapi)
+    other = create_node("Pipe", "Root", "Other", netapi)
+    with NodenetFork(netapi):
+        feature = create_node("Pipe", "Root", "Feature", netapi)
+        link_with_reciprocal(scene, feature, "subsur", netapi)
+        delete_node(other, netapi)
+    assert _gate_links(scene, "sub") == [(feature.uid, "sub")]
+    assert other.uid not in [node.uid for node in netapi.get_nodes("Root")]
+    assert not is_deleted(other, netapi)
+
+
+def test_nested_fork_rollback_keeps_the_outer_changes():
+    netapi = _create_netapi()
+    scene = create_node("Pipe", "Root", "Scene-1", netapi)
+    outer = NodenetFork(netapi).open()
+    set_state(scene, "x", 1, netapi)
+    inner = NodenetFork(netapi).open()
+    set_state(scene, "x", 2, netapi)
+    inner.rollback()
+    assert scene.get_state("x") == 1
+    outer.rollback()
+    assert scene.get_state("x") is None
@@ -0,0 +1,113 @@
+import glob
+import json
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from nettools import seed_random
+from nodenetengine import ArrayNodenet, DictNodenet, compare_engines, grow_nodenet
+from structuredobjects import StructuredObjectsWorld
+
+PACKAGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+NODENET_PATHS = sorted(glob.glob(os.path.join(PACKAGE_PATH, "nodenets", "*.json")))
+
+
+def _load(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def _create_engine(engine_class, nodenet_data, world_data):
+    # both engines count up the uids of the nodes they create, so they create the same uids
+    counter = iter(range(1 << 62))
+    agent_uid = nodenet_data["uid"] if nodenet_data["uid"] in world_data.get("agents", {}) else None
+    world = StructuredObjectsWorld(world_data, agent_uid)
+    nodenet = engine_class(nodenet_data, world, uid_generator=lambda: "%032x" % next(counter))
+    seed_random(nodenet.netapi, 0)
+    return nodenet, world
+
+
+@pytest.mark.parametrize("path", NODENET_PATHS, ids=os.path.basename)
+def test_engines_agree_on_random_datasources(path):
+    difference, times = compare_engines(path, steps=100)
+    assert difference <= 1e-9
+
+
+@pytest.mark.parametrize("path", NODENET_PATHS, ids=os.path.basename)
+def test_engines_agree_on_grown_nodenets(path):
+    nodenet_data = _load(path)
+    grown_data = grow_nodenet(nodenet_data, 3)
+    pipe_count = sum(1 for node_data in nodenet_data["nodes"].values() if node_data["type"] == "Pipe")
+    assert len(grown_data["nodes"]) == len(nodenet_data["nodes"]) + 3 * pipe_count
+    difference, times = compare_engines(path, steps=30, copies=3)
+    assert difference <= 1e-9
+
+
+@pytest.mark.parametrize("path", NODENET_PATHS, ids=os.path.basename)
+def test_engines_agree_on_the_world(path):
+    nodenet_data = _load(path)
+    world_data = _load(os.path.join(PACKAGE_PATH, "worlds", nodenet_data["world"] + ".json"))
+    engines = [_create_engine(engine_class, nodenet_data, world_data) for engine_class in (DictNodenet, ArrayNodenet)]
+    for step in range(300):
+        for nodenet, world in engines:
+            nodenet.step()
+            world.update()
+        (reference, reference_world), (nodenet, world) = engines
+        assert [node and node.uid for node in reference.rows] == [node and node.uid for node in nodenet.rows]
+        assert set(reference.get_data()["links"]) == set(nodenet.get_data()["links"])
+        for columns, other_columns in ((reference.gate_activations, nodenet.gate_activations),
+                                       (reference.slot_activations, nodenet.slot_activations)):
+            for key, column in columns.items():
+                assert np.allclose(column, other_columns[key], rtol=0, atol=1e-9), (step, key)
+        assert reference_world.datasources == world.datasources
+    assert len(reference.nodes) > len(nodenet_data["nodes"])
+
+
+def _with_full_gate_parameters(nodenet_data, nodenet):
+    # the nodenet data as the runtime saves it: every node with the parameters of all its gates
+    nodenet_data = json.loads(json.dumps(nodenet_data))
+    for node_data in nodenet_data["nodes"].values():
+        node_data["gate_parameters"] = nodenet.nodes[node_data["uid"]].get_gate_parameters()
+    return nodenet_data
+
+
+@pytest.mark.parametrize("engine_class", [DictNodenet, ArrayNodenet], ids=lambda engine_class: engine_class.__name__)
+def test_gate_parameter_overrides_round_trip_through_get_data(engine_class):
+    nodenet_data = _load(NODENET_PATHS[0])
+    nodenet = engine_class(nodenet_data)
+    full_parameters = dict((uid, nodenet.nodes[uid].get_gate_parameters()) for uid in nodenet.nodes)
+
+    # parameters equal to the defaults are not kept
+    loaded = engine_class(_with_full_gate_parameters(nodenet_data, nodenet))
+    assert all(node.gate_parameters == {} for node in loaded.nodes.values()
+               if not nodenet.nodes[node.uid].gate_parameters)
+    assert dict((uid, loaded.nodes[uid].get_gate_parameters()) for uid in loaded.nodes) == full_parameters
+
+    pipes = [node for node in loaded.nodes.values() if node.type == "Pipe"][:3]
+    for node in pipes[:2]:
+        node.set_gate_parameter("gen", "threshold", 0.5)
+    # setting a parameter to its default is no override
+    pipes[2].set_gate_parameter("gen", "maximum", pipes[2].get_gate_parameters()["gen"]["maximum"])
+    # nodes with the same overrides share them, and changing them copies them
+    assert pipes[0].gate_parameters is pipes[1].gate_parameters
+    pipes[1].set_gate_parameter("gen", "amplification", 2.0)
+    assert pipes[0].gate_parameters == {"gen": {"threshold": 0.5}}
+    assert pipes[1].gate_parameters == {"gen": {"threshold": 0.5, "amplification": 2.0}}
+    assert pipes[2].gate_parameters == {}
+
+    data = json.loads(json.dumps(loaded.get_data()))
+    assert data["nodes"][pipes[1].uid]["gate_parameters"] == {"gen": {"threshold": 0.5, "amplification": 2.0}}
+    reloaded = engine_class(data)
+    for uid in loaded.nodes:
+        assert reloaded.nodes[uid].gate_parameters == loaded.nodes[uid].gate_parameters
+        assert reloaded.nodes[uid].get_gate_parameters() == loaded.nodes[uid].get_gate_parameters()
+    for column, other_column in zip(loaded.gate_parameters["gen"].values(), reloaded.gate_parameters["gen"].values()):
+        assert list(column) == list(other_column)
+
+    # None resets a parameter to the default
+    pipes[1].set_gate_parameter("gen", "amplification", None)
+    pipes[1].set_gate_parameter("gen", "threshold", None)
+    assert pipes[1].gate_parameters == {}
+    assert pipes[1].get_gate_parameters() == full_parameters[pipes[1].uid]
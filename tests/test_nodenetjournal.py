@@ -0,0 +1,106 @@
+import json
+import os
+import random
+
+from nettools import *
+from nodenetengine import DictNodenet, WorldAdapter
+from nodenetjournal import NodenetJournal, load_nodenet, read_journal
+
+PACKAGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+NODENET_PATH = os.path.join(PACKAGE_PATH, "nodenets", "851def94d5f011e382990023dfa615aa.json")
+
+
+def _create_nodenet():
+    with open(NODENET_PATH) as file:
+        nodenet_data = json.load(file)
+    with open(os.path.join(PACKAGE_PATH, "worlds", "%s.json" % nodenet_data["world"])) as file:
+        world_data = json.load(file)
+    world_adapter = WorldAdapter.from_world(world_data, nodenet_data["worldadapter"])
+    counter = iter(range(10 ** 9))
+    nodenet = DictNodenet(nodenet_data, world_adapter, uid_generator=lambda: "%032x" % next(counter))
+    seed_random(nodenet.netapi, 0)
+    return nodenet
+
+
+def _run(nodenet, steps, seed=0):
+    datasources = nodenet.world_adapter.datasources
+    generator = random.Random(seed)
+    for step in range(steps):
+        datasources.update((key, float(generator.random() < 0.3)) for key in datasources)
+        nodenet.step()
+
+
+def _assert_same_structure(nodenet, nodenet_data):
+    running_data = nodenet.get_data()
+    assert set(running_data["nodes"]) == set(nodenet_data["nodes"])
+    assert set(running_data["links"]) == set(nodenet_data["links"])
+    for uid, node_data in running_data["nodes"].items():
+        assert node_data["parameters"] == nodenet_data["nodes"][uid]["parameters"]
+
+
+def test_replayed_journal_matches_running_nodenet(tmp_path):
+    journal_path = str(tmp_path / "nodenet.journal")
+    nodenet = _create_nodenet()
+    journal = NodenetJournal(nodenet.netapi, journal_path)
+    journal.attach()
+    _run(nodenet, 300)
+    journal.detach()
+    assert len(read_journal(journal_path)) > 0
+    _assert_same_structure(nodenet, load_nodenet(NODENET_PATH, journal_path))
+
+
+def test_journal_resumes_after_crash(tmp_path):
+    journal_path = str(tmp_path / "nodenet.journal")
+    nodenet = _create_nodenet()
+    journal = NodenetJournal(nodenet.netapi, journal_path)
+    journal.attach()
+    _run(nodenet, 150)
+    journal.detach()
+    entry_count = len(read_journal(journal_path))
+    with open(journal_path, "a") as file:
+        file.write('{"step": 151, "nodes": {"')
+
+    journal = NodenetJournal(nodenet.netapi, journal_path)
+    journal.attach()
+    _run(nodenet, 150, seed=1)
+    journal.detach()
+    entries = read_journal(journal_path)
+    with open(journal_path) as file:
+        assert len(file.readlines()) == len(entries)
+    assert len(entries) > entry_count
+    _assert_same_structure(nodenet, load_nodenet(NODENET_PATH, journal_path))
+
+
+def test_read_journal_skips_invalid_lines(tmp_path):
+    journal_path = str(tmp_path / "nodenet.journal")
+    with open(journal_path, "w") as file:
+        file.write('{"step": 1, "nodes": {}, "deleted": []}\n')
+        file.write('{"step": 2, "nod\n')
+        file.write('{"step": 3, "nodes": {}, "deleted": []}\n')
+        file.write('{"step": 4, "nodes": {}, "del')
+    assert [entry["step"] for entry in read_journal(journal_path)] == [1, 3]
+    assert read_journal(str(tmp_path / "missing.journal")) == []
+
+
+def test_signal_sources_are_journaled_once():
+    nodenet = DictNodenet(world_adapter=WorldAdapter())
+    netapi = nodenet.netapi
+    source = create_node("SignalSource", "Root", "Signal", netapi)
+    set_parameter(source, "step", 9, netapi)
+    changes = []
+
+    def record_state_change(node, changed_netapi):
+        changes.append(node)
+
+    add_state_listener(record_state_change)
+    try:
+        signals = []
+        for step in range(150):
+            nodenet.step()
+            signals.append(source.get_gate("linear").activation)
+    finally:
+        remove_state_listener(record_state_change)
+    assert changes == [source]
+    # a source saved with a step counter continues where it left off
+    assert signals[:3] == [-0.8, -0.78, -0.76]
+    assert signals[40] == 0 and signals[90] == -1
@@ -0,0 +1,52 @@
+import json
+import os
+
+from nodenetengine import DictNodenet
+from nodenetprofiler import NodenetProfiler, remove_profile_monitors
+from structuredobjects import StructuredObjectsWorld
+
+PACKAGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+NODENET_PATH = os.path.join(PACKAGE_PATH, "nodenets", "242fed22ac9811e4a99c6c40088a61aa.json")
+WORLD_PATH = os.path.join(PACKAGE_PATH, "worlds", "6df3bffaf95f11e38a330023dfa615aa.json")
+
+
+def _run_profiled(steps, history):
+    with open(NODENET_PATH) as file:
+        nodenet_data = json.load(file)
+    with open(WORLD_PATH) as file:
+        world_data = json.load(file)
+    agent_uid = nodenet_data["uid"] if nodenet_data["uid"] in world_data.get("agents", {}) else None
+    world = StructuredObjectsWorld(world_data, agent_uid)
+    nodenet = DictNodenet(nodenet_data, world)
+    profiler = NodenetProfiler(nodenet, history=history)
+    profiler.enable()
+    for step in range(steps):
+        nodenet.step()
+        world.update()
+    profiler.disable()
+    return nodenet, profiler
+
+
+def test_monitor_values_are_keyed_by_step_strings():
+    nodenet, profiler = _run_profiled(20, history=5)
+    monitors = [monitor for monitor in nodenet.monitors.values() if monitor["type"] == "profile"]
+    assert monitors
+    for monitor in monitors:
+        assert all(isinstance(step, str) for step in monitor["values"])
+        assert 0 < len(monitor["values"]) <= 5
+    # the native modules run before the step counter is increased, so the last step is current_step - 1
+    calls = nodenet.monitors["profile:%s:calls" % profiler.get_totals()[0][0]]
+    assert sorted(calls["values"], key=int) == [str(step) for step in range(nodenet.current_step - 5,
+                                                                            nodenet.current_step)]
+    # the values stay the same when the nodenet is saved and loaded
+    data = json.loads(json.dumps(nodenet.get_data()))
+    assert data["monitors"] == nodenet.monitors
+
+
+def test_disable_restores_the_netapi():
+    nodenet, profiler = _run_profiled(5, history=None)
+    assert nodenet.profiler is None
+    assert not [name for name in vars(nodenet.netapi) if hasattr(vars(nodenet.netapi)[name], "profiled_method")]
+    assert all(totals["calls"] > 0 for nodetype, totals in profiler.get_totals())
+    remove_profile_monitors(nodenet)
+    assert not [monitor for monitor in nodenet.monitors.values() if monitor["type"] == "profile"]
@@ -0,0 +1,82 @@
+import glob
+import json
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+shared_memory = pytest.importorskip("multiprocessing.shared_memory")
+
+from nettools import seed_random
+from nodenetengine import ArrayNodenet
+from nodenetshards import ShardedNodenet
+from structuredobjects import StructuredObjectsWorld
+
+PACKAGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+NODENET_PATHS = sorted(glob.glob(os.path.join(PACKAGE_PATH, "nodenets", "*.json")))
+
+
+def _load(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def _create_engine(create_nodenet, nodenet_data, world_data):
+    # both engines count up the uids of the nodes they create, so they create the same uids
+    counter = iter(range(1 << 62))
+    agent_uid = nodenet_data["uid"] if nodenet_data["uid"] in world_data.get("agents", {}) else None
+    world = StructuredObjectsWorld(world_data, agent_uid)
+    nodenet = create_nodenet(nodenet_data, world, uid_generator=lambda: "%032x" % next(counter))
+    seed_random(nodenet.netapi, 0)
+    return nodenet, world
+
+
+def _sharded_nodenet(*args, **kwargs):
+    return ShardedNodenet(*args, shards=3, **kwargs)
+
+
+@pytest.mark.parametrize("path", NODENET_PATHS, ids=os.path.basename)
+def test_sharded_nodenet_agrees_with_array_nodenet(path):
+    nodenet_data = _load(path)
+    world_data = _load(os.path.join(PACKAGE_PATH, "worlds", nodenet_data["world"] + ".json"))
+    engines = [_create_engine(create_nodenet, nodenet_data, world_data)
+               for create_nodenet in (ArrayNodenet, _sharded_nodenet)]
+    (reference, reference_world), (nodenet, world) = engines
+    with nodenet:
+        for step in range(200):
+            for engine, engine_world in engines:
+                engine.step()
+                engine_world.update()
+            assert [node and node.uid for node in reference.rows] == [node and node.uid for node in nodenet.rows]
+            assert set(reference.get_data()["links"]) == set(nodenet.get_data()["links"])
+            for columns, other_columns in ((reference.gate_activations, nodenet.gate_activations),
+                                           (reference.slot_activations, nodenet.slot_activations)):
+                for key, column in columns.items():
+                    assert np.allclose(column, other_columns[key], rtol=0, atol=1e-9), (step, key)
+            assert reference_world.datasources == world.datasources
+    assert len(reference.nodes) > len(nodenet_data["nodes"])
+
+
+def test_close_stops_workers_and_frees_shared_memory():
+    nodenet_data = _load(NODENET_PATHS[0])
+    world_data = _load(os.path.join(PACKAGE_PATH, "worlds", nodenet_data["world"] + ".json"))
+    nodenet, world = _create_engine(_sharded_nodenet, nodenet_data, world_data)
+    for step in range(5):
+        nodenet.step()
+        world.update()
+    processes = [process for process, connection in nodenet.workers]
+    block_names = [block.name for block in nodenet.blocks + nodenet.retired_blocks]
+    assert len(processes) == 3 and all(process.is_alive() for process in processes)
+    assert block_names
+
+    nodenet.close()
+    assert nodenet.workers == [] and nodenet.blocks == [] and nodenet.retired_blocks == []
+    for process in processes:
+        process.join(5)
+        assert not process.is_alive()
+    for name in block_names:
+        with pytest.raises(FileNotFoundError):
+            shared_memory.SharedMemory(name=name)
+
+    # closing again does nothing
+    nodenet.close()
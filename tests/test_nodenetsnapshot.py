@@ -0,0 +1,65 @@
+import glob
+import json
+import os
+
+import pytest
+
+from nodenetengine import DictNodenet, WorldAdapter
+from nodenetsnapshot import convert_nodenet, load_snapshot, read_snapshot_columns, save_snapshot
+
+PACKAGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+NODENET_PATHS = sorted(glob.glob(os.path.join(PACKAGE_PATH, "nodenets", "*.json")))
+
+
+def _canonical(nodenet_data):
+    return json.dumps(nodenet_data, sort_keys=True)
+
+
+def _is_mapped(path):
+    with open("/proc/self/maps") as file:
+        return any(line.rstrip("\n").endswith(os.path.realpath(path)) for line in file)
+
+
+@pytest.mark.parametrize("path", NODENET_PATHS, ids=os.path.basename)
+def test_snapshot_round_trip(path, tmp_path):
+    with open(path) as file:
+        nodenet_data = json.load(file)
+    snapshot_path = str(tmp_path / "nodenet.snapshot")
+    save_snapshot(nodenet_data, snapshot_path)
+    assert _canonical(load_snapshot(snapshot_path)) == _canonical(nodenet_data)
+
+
+def test_snapshot_round_trip_of_running_nodenet(tmp_path):
+    with open(NODENET_PATHS[0]) as file:
+        nodenet_data = json.load(file)
+    nodenet = DictNodenet(nodenet_data, WorldAdapter())
+    for step in range(50):
+        nodenet.step()
+    running_data = nodenet.get_data()
+    snapshot_path = str(tmp_path / "nodenet.snapshot")
+    save_snapshot(running_data, snapshot_path)
+    assert _canonical(load_snapshot(snapshot_path)) == _canonical(running_data)
+
+
+def test_convert_nodenet(tmp_path):
+    snapshot_path = convert_nodenet(NODENET_PATHS[0], str(tmp_path / "nodenet.snapshot"))
+    with open(NODENET_PATHS[0]) as file:
+        assert _canonical(load_snapshot(snapshot_path)) == _canonical(json.load(file))
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/maps"), reason="needs /proc/self/maps")
+def test_snapshot_files_are_unmapped_after_loading(tmp_path):
+    snapshot_path = convert_nodenet(NODENET_PATHS[0], str(tmp_path / "nodenet.snapshot"))
+    with read_snapshot_columns(snapshot_path) as (header, columns):
+        assert _is_mapped(snapshot_path)
+        assert len(columns["nodes.flags"]) == header["node_count"]
+    assert not _is_mapped(snapshot_path)
+    load_snapshot(snapshot_path)
+    assert not _is_mapped(snapshot_path)
+
+    invalid_path = str(tmp_path / "invalid.snapshot")
+    with open(invalid_path, "wb") as file:
+        file.write(b"\0" * 64)
+    with pytest.raises(ValueError):
+        load_snapshot(invalid_path)
+    assert not _is_mapped(invalid_path)
@@ -0,0 +1,614 @@
+import itertools
+import json
+import os
+import random
+
+import pytest
+
+import schematools
+from nettools import *
+from nodenetengine import DictNodenet, WorldAdapter
+from schematools import *
+
+PACKAGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+WORLD_PATH = os.path.join(PACKAGE_PATH, "worlds", "6df3bffaf95f11e38a330023dfa615aa.json")
+
+
+def _load(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def _create_netapi(import_interface_nodes=True):
+    world_adapter = WorldAdapter.from_world(_load(WORLD_PATH), "StructuredObjects")
+    netapi = DictNodenet(world_adapter=world_adapter).netapi
+    if not import_interface_nodes:
+        return netapi
+    import_sensors("Root", netapi)
+    import_actors("Root", netapi)
+    return netapi
+
+
+def _add_feature(scene, x, y, datasources, netapi):
+    registry = get_interface_registry("Root", netapi)
+    sensors = [registry.get("Sensor", datasource) for datasource in datasources]
+    feature = instantiate_schema_template(FOVEA_FEATURE_TEMPLATE, "Root", netapi, parent=scene, sensors=sensors,
+                                          name="F(%i/%i)" % (x, y), x=x, y=y)["feature"]
+    index_fovea_feature(scene, feature, netapi)
+    return feature
+
+
+def _create_scene(name, features, netapi):
+    scene = create_node("Pipe", "Root", name, netapi)
+    for x, y, datasources in features:
+        _add_feature(scene, x, y, datasources, netapi)
+    return scene
+
+
+def test_fovea_index_tracks_imported_and_deleted_features():
+    netapi = _create_netapi()
+    scene = _create_scene("Scene-1", [(0, 0, ["fovea-green"]), (1, -1, ["fovea-brown"])], netapi)
+    feature = netapi.get_nodes_in_gate_field(scene, "sub")[1]
+    assert sorted(get_fovea_index(scene, netapi)) == ["0/0", "1/-1"]
+    assert is_fovea_position_covered(scene, 1, -1, netapi)
+    assert not is_fovea_position_covered(scene, -1, 1, netapi)
+    assert len(get_uncovered_fovea_positions(scene, netapi)) == len(FOVEA_POSITIONS) ** 2 - 2
+
+    delete_schema(feature, netapi)
+    assert sorted(get_fovea_index(scene, netapi)) == ["0/0"]
+    assert not is_fovea_position_covered(scene, 1, -1, netapi)
+
+
+def test_fovea_index_is_built_from_the_sub_field_of_older_scenes():
+    netapi = _create_netapi()
+    scene = _create_scene("Scene-1", [(0, 0, ["fovea-green"]), (2, 1, ["fovea-brown"])], netapi)
+    index = get_fovea_index(scene, netapi)
+    scene.state.pop("fovea_index")
+    assert get_fovea_index(scene, netapi) == index
+
+
+def test_feature_cache_is_invalidated_by_structure_changes():
+    netapi = _create_netapi()
+    scene = _create_scene("Scene-1", [(0, 0, ["fovea-green"])], netapi)
+    assert len(collect_features(scene, netapi)[0]) == 1
+    assert get_cached_features("features", scene, netapi) is not None
+
+    feature = _add_feature(scene, 1, 0, ["fovea-brown"], netapi)
+    assert get_cached_features("features", scene, netapi) is None
+    assert len(collect_features(scene, netapi)[0]) == 2
+
+    # changes deep below the scene invalidate it as well
+    sense = netapi.get_nodes_in_gate_field(feature, "sub")[1]
+    collect_features(scene, netapi)
+    link_with_reciprocal(sense, create_node("Pipe", "Root", "Extra", netapi), "subsur", netapi)
+    assert get_cached_features("features", scene, netapi) is None
+
+    unlink(scene, "sub", feature, netapi)
+    unlink(feature, "sur", scene, netapi)
+    assert len(collect_features(scene, netapi)[0]) == 1
+
+
+def test_cached_features_are_copies():
+    netapi = _create_netapi()
+    scene = _create_scene("Scene-1", [(0, 0, ["fovea-green"])], netapi)
+    feature_names, features = collect_features(scene, netapi)
+    feature_names.clear()
+    features.clear()
+    assert len(collect_features(scene, netapi)[0]) == 1
+
+
+def _all_pairs(schemas, netapi):
+    # the pairs structure_abstraction_builder tried before the inverted index: every pair of distinct schemas
+    # with common features that pass the overlap threshold
+    pairs = []
+    for schema1, schema2 in itertools.combinations(schemas, 2):
+        feature_names1 = collect_features(schema1, netapi)[0]
+        feature_names2 = collect_features(schema2, netapi)[0]
+        common_feature_count = len(feature_names1 & feature_names2)
+        if common_feature_count > 0 and \
+                has_sufficient_feature_overlap(common_feature_count, len(feature_names1), len(feature_names2)):
+            pairs.append((schema1, schema2))
+    return pairs
+
+
+def test_candidate_pairs_equal_all_pairs():
+    netapi = _create_netapi()
+    generator = random.Random(0)
+    datasources = ["fovea-green", "fovea-brown", "fovea-red", "fovea-com"]
+    schemas = []
+    for i in range(12):
+        features = []
+        for x, y in generator.sample([(x, y) for x in range(-1, 2) for y in range(-1, 2)], generator.randint(1, 4)):
+            features.append((x, y, [generator.choice(datasources)]))
+        schemas.append(_create_scene("Scene-%i" % i, features, netapi))
+    pairs = find_abstraction_candidate_pairs(schemas + [None, schemas[0]], netapi)
+    assert len(pairs) > 0
+    assert pairs == _all_pairs(schemas, netapi)
+
+
+class _BrokenSensor(object):
+    # fails the template's sensor proxies, after the mov triggers have been linked to the fovea actors and sensors
+    pass
+
+
+def _instantiate_broken_feature(scene, netapi):
+    try:
+        instantiate_schema_template(FOVEA_FEATURE_TEMPLATE, "Root", netapi, parent=scene, sensors=[_BrokenSensor()],
+                                    name="F(1/1)", x=1, y=1)
+    except AttributeError:
+        return
+    assert False, "the broken sensor should have failed the instantiation"
+
+
+def test_failed_template_instantiation_leaves_nothing_behind():
+    netapi = _create_netapi(import_interface_nodes=False)
+    scene = create_node("Pipe", "Root", "Scene-1", netapi)
+    _instantiate_broken_feature(scene, netapi)
+    assert netapi.get_nodes("Root") == [scene]
+    assert scene.get_gate("sub").empty
+    registry = get_interface_registry("Root", netapi)
+    assert registry.get("Sensor", "fov-x") is None and registry.get("Actor", "fov_x") is None
+    assert find_nodes("Root", "F(", netapi) == []
+
+    # the sensors and actors are created again for the next feature
+    feature = _add_feature(scene, 1, 1, [], netapi)
+    assert get_interface_registry("Root", netapi).get("Sensor", "fov-x") is not None
+    assert [node.name for node in netapi.get_nodes_in_gate_field(scene, "sub")] == [feature.name]
+
+
+def test_failed_template_instantiation_is_rolled_back_through_forks_and_listeners():
+    netapi = _create_netapi(import_interface_nodes=False)
+    scene = create_node("Pipe", "Root", "Scene-1", netapi)
+    changed_nodes = []
+
+    def record_state_change(node, changed_netapi):
+        changed_nodes.append(node)
+
+    add_state_listener(record_state_change)
+    try:
+        fork = NodenetFork(netapi).open()
+        _instantiate_broken_feature(scene, netapi)
+        # inside the fork, the nodes are only unlinked until the fork is committed or rolled back
+        assert all(is_deleted(node, netapi) for node in netapi.get_nodes("Root") if node is not scene)
+        assert "F(1/1)" in [node.name for node in changed_nodes]
+        fork.rollback()
+    finally:
+        remove_state_listener(record_state_change)
+    assert netapi.get_nodes("Root") == [scene]
+    assert get_interface_registry("Root", netapi).get("Actor", "fov_x") is None
+
+
+def _node_names(netapi):
+    return sorted(node.name for node in netapi.get_nodes("Root"))
+
+
+def test_delete_schema_keeps_shared_sub_schemas_and_interface_nodes():
+    netapi = _create_netapi()
+    interface_nodes = _node_names(netapi)
+    scene1 = _create_scene("Scene-1", [(0, 0, ["fovea-green"])], netapi)
+    scene2 = _create_scene("Scene-2", [(1, 0, ["fovea-brown"])], netapi)
+    shared = netapi.get_nodes_in_gate_field(scene1, "sub")[0]
+    link_with_reciprocal(scene2, shared, "subsur", netapi)
+    own = netapi.get_nodes_in_gate_field(scene2, "sub")[0]
+    shared_schema = _node_names(netapi)
+
+    delete_schema(scene2, netapi)
+    assert own.name not in _node_names(netapi)
+    assert _node_names(netapi) == [name for name in shared_schema if not name.startswith(("Scene-2", "F(1/0)"))]
+    assert netapi.get_nodes_in_gate_field(scene1, "sub") == [shared]
+
+    delete_schema(scene1, netapi)
+    assert _node_names(netapi) == interface_nodes
+
+
+def test_delete_schema_follows_looping_links_once():
+    netapi = _create_netapi()
+    interface_nodes = _node_names(netapi)
+    head = create_node("Pipe", "Root", "Head", netapi)
+    first = create_node("Pipe", "Root", "First", netapi)
+    second = create_node("Pipe", "Root", "Second", netapi)
+    link_with_reciprocal(head, first, "subsur", netapi)
+    link_with_reciprocal(first, second, "subsur", netapi)
+    link_with_reciprocal(second, first, "subsur", netapi)
+    assert [node.name for node in traverse_schema(head, netapi)] == ["Head", "First", "Second"]
+    delete_schema(head, netapi)
+    assert _node_names(netapi) == interface_nodes
+
+
+def test_traverse_schema_stops_at_the_depth_limit():
+    netapi = _create_netapi()
+    chain = [create_node("Pipe", "Root", "Node-%03i" % i, netapi) for i in range(MAX_SCHEMA_DEPTH + 10)]
+    for parent, child in zip(chain, chain[1:]):
+        link_with_reciprocal(parent, child, "subsur", netapi)
+    assert len(traverse_schema(chain[0], netapi)) == MAX_SCHEMA_DEPTH + 1
+    assert len(traverse_schema(chain[0], netapi, max_depth=5)) == 6
+    # deep schemas do not run into the recursion limit
+    assert len(collect_schema_nodes(chain[0], netapi)) == MAX_SCHEMA_DEPTH + 1
+
+
+def _schema_links(nodes):
+    # the links leaving and entering the given nodes, with the nodes of the schema named by their position in it
+    positions = dict((node.uid, "#%i" % i) for i, node in enumerate(nodes))
+    links = []
+    for node in nodes:
+        for gate_type in node.get_gate_types():
+            for gate_link in node.get_gate(gate_type).get_links():
+                target = positions.get(gate_link.target_node.uid, gate_link.target_node.uid)
+                links.append((positions[node.uid], gate_type, target, gate_link.target_slot.type, gate_link.weight))
+        for slot_type in node.get_slot_types():
+            for slot_link in node.get_slot(slot_type).get_links():
+                if slot_link.source_node.uid not in positions:
+                    links.append((slot_link.source_node.uid, slot_link.source_gate.type, positions[node.uid],
+                                  slot_type, slot_link.weight))
+    return sorted(links)
+
+
+def test_copy_schema_copies_internal_links_once_and_keeps_external_links():
+    netapi = _create_netapi()
+    scene = _create_scene("Scene-1", [(1, 0, ["fovea-green", "fovea-brown"])], netapi)
+    feature = netapi.get_nodes_in_gate_field(scene, "sub")[0]
+    # the copy covers the Pipe nodes below the feature, the mov triggers are outside of it like the sensors
+    originals = sorted(collect_schema_nodes(feature, netapi), key=lambda node: node.name)
+    original_links = _schema_links(originals)
+
+    link_calls = []
+    netapi_link = netapi.link
+
+    def counting_link(*args):
+        link_calls.append(args)
+        return netapi_link(*args)
+
+    netapi.link = counting_link
+    copy = copy_schema(feature, netapi)
+    del netapi.link
+
+    copies = sorted(collect_schema_nodes(copy, netapi), key=lambda node: node.name)
+    assert [node.name for node in copies] == [node.name for node in originals]
+    assert all(node.uid not in [original.uid for original in originals] for node in copies)
+    # the head of the copy is only linked through its sub gate and sur slot, so it is not linked to the scene
+    head = "#%i" % originals.index(feature)
+    expected_links = [link for link in original_links
+                      if not (link[0] == head and link[1] != "sub") and not (link[2] == head and link[3] != "sur")]
+    assert _schema_links(copies) == expected_links
+    assert len(expected_links) > len(originals)
+    # the mov triggers and the fovea sensors are shared with the original
+    mov_x = find_nodes("Root", "F(1/0).mov-x", netapi)[0]
+    assert any(link[2] == mov_x.uid for link in expected_links)
+    # every link is created once
+    assert len(link_calls) == len(expected_links)
+    assert netapi.get_nodes_in_gate_field(scene, "sub") == [feature]
+
+
+def test_scan_saccade_visits_every_uncovered_position_once_per_round():
+    netapi = _create_netapi()
+    scene = _create_scene("Scene-1", [(0, 0, ["fovea-green"]), (1, -1, ["fovea-brown"])], netapi)
+    uncovered = get_uncovered_fovea_positions(scene, netapi)
+    x, y = 0, 0
+    visited = []
+    for i in range(len(uncovered)):
+        x, y = scan_saccade(scene, x, y, netapi)
+        visited.append((x, y))
+    # in row order, starting after the fovea position, and wrapping around
+    assert sorted(visited) == sorted(uncovered)
+    assert visited == [position for position in uncovered if (position[1], position[0]) > (0, 0)] + \
+        [position for position in uncovered if (position[1], position[0]) < (0, 0)]
+    assert scan_saccade(scene, x, y, netapi) == visited[0]
+
+    # moving the fovea elsewhere does not restart the scan
+    assert scan_saccade(scene, *visited[-1], netapi=netapi) == visited[1]
+
+
+def test_saccade_planners_only_pick_uncovered_positions():
+    netapi = _create_netapi()
+    seed_random(netapi, 0)
+    scene = _create_scene("Scene-1", [(x, y, ["fovea-green"]) for x, y in
+                                      [(0, 0), (1, 0), (2, 0), (-1, 2)]], netapi)
+    uncovered = get_uncovered_fovea_positions(scene, netapi)
+    for i in range(50):
+        assert random_saccade(scene, 0, 0, netapi) in uncovered
+    assert random_saccade(scene, *uncovered[0], netapi=netapi) != uncovered[0]
+
+    full = _create_scene("Scene-2", [(x, y, ["fovea-green"]) for y in FOVEA_POSITIONS for x in FOVEA_POSITIONS],
+                         netapi)
+    for name, planner in SACCADE_PLANNERS.items():
+        assert planner(full, 0, 0, netapi) is None
+
+
+def test_presence_saccade_scans_while_a_present_property_is_not_imported():
+    netapi = _create_netapi()
+    scene = _create_scene("Scene-1", [(0, 0, ["fovea-green", "fovea-cir"])], netapi)
+    registry = get_interface_registry("Root", netapi)
+    assert get_fovea_properties(scene, netapi) == {"green", "cir"}
+
+    registry.get("Sensor", "presence-green").get_gate("gen").gate_function(1)
+    assert presence_saccade(scene, 0, 0, netapi) is None
+
+    registry.get("Sensor", "presence-red").get_gate("gen").gate_function(1)
+    assert presence_saccade(scene, 0, 0, netapi) == (1, 0)
+
+
+def _create_protocol(length, netapi):
+    # a protocol chain of `length` elements, each referring to a scene through a ProtScene and an Occurrence
+    chain = get_protocol_chain("Root", netapi, create=True)
+    for i in range(length):
+        if i > 0:
+            extend_protocol_chain(chain, netapi)
+        protocolled_scene = create_node("Pipe", "Root", "ProtScene-%i" % i, netapi)
+        occurrence = create_node("Pipe", "Root", "Occurrence-%i" % i, netapi)
+        link_with_reciprocal(get_protocol_head(chain, netapi), protocolled_scene, "subsur", netapi)
+        link_with_reciprocal(protocolled_scene, occurrence, "subsur", netapi)
+        link_with_reciprocal(occurrence, create_node("Pipe", "Root", "Scene-%i" % i, netapi), "subsur", netapi)
+    return chain
+
+
+def test_compact_protocol_chain_keeps_the_newest_elements():
+    netapi = _create_netapi(import_interface_nodes=False)
+    chain = _create_protocol(6, netapi)
+    assert compact_protocol_chain(chain, None, netapi) == 0
+    assert compact_protocol_chain(chain, 4, netapi) == 2
+    assert compact_protocol_chain(chain, 4, netapi) == 0
+    assert [node.name for node in find_nodes("Root", "proto-", netapi)] == ["proto-2", "proto-3", "proto-4", "proto-5"]
+    assert get_protocol_tail(chain, netapi).name == "proto-2"
+    assert [node.name for node in find_nodes("Root", "ProtScene-", netapi)] == ["ProtScene-%i" % i for i in range(2, 6)]
+    assert [node.name for node in find_nodes("Root", "Occurrence-", netapi)] == \
+        ["Occurrence-%i" % i for i in range(2, 6)]
+    assert len(find_nodes("Root", "Scene-", netapi)) == 6
+    assert chain.get_state("compacted") == 2
+
+    extend_protocol_chain(chain, netapi)
+    assert compact_protocol_chain(chain, 1, netapi) == 4
+    assert get_protocol_tail(chain, netapi) is get_protocol_head(chain, netapi)
+    assert chain.get_state("compacted") == 6
+
+
+def test_compact_protocol_chain_stops_where_the_chain_is_broken():
+    netapi = _create_netapi(import_interface_nodes=False)
+    chain = _create_protocol(6, netapi)
+    # an element deleted without going through the schema tools, i.e. in the editor
+    netapi.delete_node(find_nodes("Root", "proto-3", netapi)[0])
+    invalidate_name_registry(netapi)
+
+    assert compact_protocol_chain(chain, 2, netapi) == 2
+    assert get_protocol_tail(chain, netapi).name == "proto-2"
+    assert compact_protocol_chain(chain, 2, netapi) == 0
+    assert [node.name for node in find_nodes("Root", "proto-", netapi)] == ["proto-2", "proto-4", "proto-5"]
+
+
+def test_structurally_equal_schemas_have_equal_hashes():
+    netapi = _create_netapi()
+    scene1 = _create_scene("Scene-1", [(0, 0, ["fovea-green"]), (1, 0, ["fovea-brown"])], netapi)
+    scene2 = _create_scene("Scene-2", [(1, 0, ["fovea-brown"]), (0, 0, ["fovea-green"])], netapi)
+    scene3 = _create_scene("Scene-3", [(0, 0, ["fovea-green"]), (1, 0, ["fovea-red"])], netapi)
+    assert get_schema_hash(scene1, netapi) == get_schema_hash(scene2, netapi)
+    assert get_schema_hash(scene1, netapi) != get_schema_hash(scene3, netapi)
+    assert collect_features(scene1, netapi)[0] == collect_features(scene2, netapi)[0]
+
+    # the hash does not depend on the uids, so it is the same in another nodenet
+    other_netapi = _create_netapi()
+    other = _create_scene("Scene-1", [(0, 0, ["fovea-green"]), (1, 0, ["fovea-brown"])], other_netapi)
+    assert get_schema_hash(other, other_netapi) == get_schema_hash(scene1, netapi)
+
+
+def test_schema_hash_is_invalidated_by_parameter_and_link_changes_only():
+    netapi = _create_netapi()
+    scene = _create_scene("Scene-1", [(0, 0, ["fovea-green"])], netapi)
+    feature = netapi.get_nodes_in_gate_field(scene, "sub")[0]
+    scene_hash = get_schema_hash(scene, netapi)
+
+    set_state(feature, "seen", True, netapi)
+    assert get_cached_features("hash", scene, netapi) is not None
+    assert get_schema_hash(scene, netapi) == scene_hash
+
+    set_parameter(feature, "threshold", 1, netapi)
+    assert get_cached_features("hash", scene, netapi) is None
+    assert get_schema_hash(scene, netapi) != scene_hash
+
+    # and by link changes below the scene
+    scene_hash = get_schema_hash(scene, netapi)
+    link_with_reciprocal(feature, create_node("Pipe", "Root", "Extra", netapi), "subsur", netapi)
+    assert get_cached_features("hash", scene, netapi) is None
+    assert get_schema_hash(scene, netapi) != scene_hash
+
+
+def test_schema_hashes_in_cycles_are_not_cached():
+    netapi = _create_netapi()
+    first = create_node("Pipe", "Root", "First", netapi)
+    second = create_node("Pipe", "Root", "Second", netapi)
+    head = create_node("Pipe", "Root", "Head", netapi)
+    leaf = create_node("Pipe", "Root", "Leaf", netapi)
+    link_with_reciprocal(first, second, "subsur", netapi)
+    link_with_reciprocal(second, first, "subsur", netapi)
+    link_with_reciprocal(head, first, "subsur", netapi)
+    link_with_reciprocal(head, leaf, "subsur", netapi)
+    get_schema_hash(head, netapi)
+    assert get_cached_features("hash", leaf, netapi) is not None
+    for node in (head, first, second):
+        assert get_cached_features("hash", node, netapi) is None
+
+
+
+def _scan_scenes(observations, netapi):
+    # the number of observations every scene has, by looking at the features of every scene in turn
+    counts = {}
+    for scene in find_nodes("Root", "Scene-", netapi):
+        features = set()
+        for uids in get_fovea_index(scene, netapi).values():
+            for uid in uids:
+                key = fovea_key(netapi.get_node(uid).get_state("x"), netapi.get_node(uid).get_state("y"))
+                features.update((key, sensor.get_parameter("datasource")) for sensor in
+                                _get_linked_sensors(netapi.get_node(uid), netapi))
+        if len(features & observations) > 0:
+            counts[scene.uid] = len(features & observations)
+    return counts
+
+
+def _get_linked_sensors(feature, netapi):
+    return [link.source_node for node in traverse_schema(feature, netapi) for slot_type in node.get_slot_types()
+            for link in node.get_slot(slot_type).get_links()
+            if link.source_node.type == "Sensor" and link.source_node.name.startswith("fovea-")]
+
+
+@pytest.mark.parametrize("with_numpy", [True, False])
+def test_recognize_scenes_agrees_with_a_scan_over_all_scenes(with_numpy, monkeypatch):
+    if with_numpy:
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(schematools, "np", None)
+    netapi = _create_netapi()
+    rng = random.Random(0)
+    datasources = ["fovea-green", "fovea-brown", "fovea-red", "fovea-com", "fovea-cir"]
+    positions = [(x, y) for y in FOVEA_POSITIONS for x in FOVEA_POSITIONS]
+    for i in range(12):
+        _create_scene("Scene-%i" % i, [(x, y, rng.sample(datasources, rng.randint(1, 2)))
+                                       for x, y in rng.sample(positions, rng.randint(1, 4))], netapi)
+    for trial in range(30):
+        if trial == 15:
+            # changes to the scenes are followed by the index
+            delete_schema(find_nodes("Root", "Scene-3", netapi)[0], netapi)
+            _add_feature(find_nodes("Root", "Scene-5", netapi)[0], 2, 2, ["fovea-red"], netapi)
+        clear_fovea_observations("Root", netapi)
+        observations = set()
+        registry = get_interface_registry("Root", netapi)
+        for x, y in rng.sample(positions, rng.randint(1, 8)):
+            sensors = [registry.get("Sensor", datasource) for datasource in rng.sample(datasources, 2)]
+            record_fovea_observation("Root", x, y, sensors, netapi)
+            observations.update((fovea_key(x, y), sensor.get_parameter("datasource")) for sensor in sensors)
+
+        ranked = recognize_scenes("Root", netapi)
+        counts = _scan_scenes(observations, netapi)
+        assert dict((scene.uid, count) for scene, count in ranked) == counts
+        assert [count for scene, count in ranked] == sorted(counts.values(), reverse=True)
+        assert [scene.uid for scene, count in recognize_scenes("Root", netapi, complete=True)] == \
+            [uid for uid, count in counts.items() if count == len(observations)]
+
+
+def _is_alive(uid, netapi):
+    try:
+        netapi.get_node(uid)
+    except KeyError:
+        return False
+    return True
+
+
+def test_merge_duplicate_schema_rewires_the_links_to_the_duplicate():
+    netapi = _create_netapi()
+    scene1 = _create_scene("Scene-1", [(0, 0, ["fovea-green"])], netapi)
+    scene2 = _create_scene("Scene-2", [(0, 0, ["fovea-green"]), (1, 0, ["fovea-red"])], netapi)
+    original = netapi.get_nodes_in_gate_field(scene1, "sub")[0]
+    duplicate = netapi.get_nodes_in_gate_field(scene2, "sub")[0]
+    category = create_node("Pipe", "Root", "Green", netapi)
+    link_with_reciprocal(duplicate, category, "catexp", netapi)
+    scene2_hash = get_schema_hash(scene2, netapi)
+    duplicate_nodes = [node.uid for node in traverse_schema(duplicate, netapi) if node.type == "Pipe"]
+
+    assert not merge_duplicate_schema(scene1, original, netapi)      # nested in each other
+    assert merge_duplicate_schema(duplicate, original, netapi)
+    assert not any(_is_alive(uid, netapi) for uid in duplicate_nodes)
+    assert original.uid in [node.uid for node in netapi.get_nodes_in_gate_field(scene2, "sub")]
+    assert get_fovea_index(scene2, netapi)["0/0"] == [original.uid]
+    assert [node.uid for node in netapi.get_nodes_in_gate_field(original, "cat")] == [category.uid]
+    assert get_schema_hash(scene2, netapi) == scene2_hash
+
+
+def test_compact_schemas_merges_duplicates_in_time_slices():
+    nodenet_data = _load(os.path.join(PACKAGE_PATH, "nodenets", "242fed22ac9811e4a99c6c40088a61aa.json"))
+    netapi = DictNodenet(nodenet_data, WorldAdapter.from_world(_load(WORLD_PATH), "StructuredObjects")).netapi
+    scene_hashes = dict((scene.uid, get_schema_hash(scene, netapi)) for scene in find_nodes("Root", "Scene-", netapi))
+    node_count = len(netapi.get_nodes("Root"))
+    pipe_count = len([node for node in netapi.get_nodes("Root") if node.type == "Pipe"])
+
+    calls = 1
+    while not compact_schemas("Root", netapi, budget=50):
+        calls += 1
+    assert calls == (pipe_count + 49) // 50
+    compaction = get_schema_compaction("Root", netapi)
+    assert compaction.merged > 0
+    # the four copies of F(0/-2) are chained by por/ret links, but their sub-schemas are shared now
+    assert len(find_nodes("Root", "F(0/-2).Rec", netapi)) < 4
+    assert len(netapi.get_nodes("Root")) < node_count
+    assert dict((uid, get_schema_hash(netapi.get_node(uid), netapi)) for uid in scene_hashes) == scene_hashes
+
+    # a second pass finds nothing left to merge
+    merged = compaction.merged
+    while not compact_schemas("Root", netapi, budget=50):
+        pass
+    assert compaction.merged == merged
+
+
+def test_compact_schemas_collects_idle_unreferenced_schemas():
+    netapi = _create_netapi()
+    scene = _create_scene("Scene-1", [(0, 0, ["fovea-green"])], netapi)
+    referenced = _create_scene("Scene-2", [(1, 0, ["fovea-red"])], netapi)
+    register = create_node("Register", "Root", "ImporterScene", netapi)
+    link(register, "gen", referenced, "sub", netapi)
+    chain = _create_protocol(2, netapi)
+
+    compact_schemas("Root", netapi, idle_steps=3, budget=1000)
+    for i in range(3):
+        netapi.nodenet.step()
+    compact_schemas("Root", netapi, idle_steps=3, budget=1000)
+    assert not _is_alive(scene.uid, netapi)
+    assert _is_alive(referenced.uid, netapi)
+    assert _is_alive(chain.uid, netapi) and len(find_nodes("Root", "proto-", netapi)) == 2
+    assert get_schema_compaction("Root", netapi).collected == 1
+
+
+def _create_overlapping_scenes(netapi):
+    shared = [(0, 0, ["fovea-green"]), (1, 0, ["fovea-brown"]), (0, 1, ["fovea-com"])]
+    return [_create_scene("Scene-1", shared + [(-1, 0, ["fovea-red"])], netapi),
+            _create_scene("Scene-2", shared + [(1, 1, ["fovea-cir"])], netapi)]
+
+
+def _snapshot(netapi):
+    # the nodes and links of the nodespace
+    return (sorted((node.uid, node.name) for node in netapi.get_nodes("Root")),
+            sorted((link.source_node.uid, link.source_gate.type, link.target_node.uid, link.target_slot.type)
+                   for node in netapi.get_nodes("Root") for gate_type in node.get_gate_types()
+                   for link in node.get_gate(gate_type).get_links()))
+
+
+def test_abstraction_trial_rolls_back_every_candidate():
+    netapi = _create_netapi()
+    pairs = find_abstraction_candidate_pairs(_create_overlapping_scenes(netapi), netapi)
+    assert len(pairs) == 1
+    builder = create_node("Pipe", "Root", "Builder", netapi)
+    before = _snapshot(netapi)
+    netapi.world.datasources["fovea-red"] = 1.0
+    trial = start_abstraction_trial(builder, pairs, netapi, steps=3)
+    steps = 0
+    while not advance_abstraction_trial(builder, netapi):
+        if trial.candidate >= 0:
+            # the world changes, but the candidate reads the datasource values read without abstraction
+            netapi.world.datasources["fovea-red"] = 0.0
+            assert netapi.world.get_datasource("fovea-red") == 1.0
+            if trial.step == 0:
+                # the next candidate is built in the next step, the previous one has been rolled back
+                assert _snapshot(netapi) == before
+            else:
+                assert len(find_nodes("Root", "Nature", netapi)) == 2
+        netapi.nodenet.step()
+        steps += 1
+    assert steps == 5
+    assert len(trial.scores) == 2
+    assert get_abstraction_trial(builder, netapi) is None
+    assert netapi.world.get_datasource("fovea-red") == 0.0
+    # a single sensor does not activate the scenes, so the candidate is as good as no abstraction and built for good
+    assert trial.scores == [0, 0]
+    assert trial.abstraction is not None
+    assert len(find_nodes("Root", "Nature", netapi)) == 2
+
+
+def test_abstraction_trials_need_a_world_that_can_replay():
+    netapi = _create_netapi()
+    pairs = find_abstraction_candidate_pairs(_create_overlapping_scenes(netapi), netapi)
+    builder = create_node("Pipe", "Root", "Builder", netapi)
+
+    class LiveWorld(object):
+        pass
+
+    netapi.nodenet.world_adapter = LiveWorld()
+    with pytest.raises(RuntimeError):
+        start_abstraction_trial(builder, pairs, netapi)
+    assert get_abstraction_trial(builder, netapi) is None
+    netapi.nodenet.world_adapter = None
+    assert start_abstraction_trial(builder, pairs, netapi) is get_abstraction_trial(builder, netapi)
@@ -0,0 +1,95 @@
+import json
+import os
+import random
+
+import pytest
+
+import structuredobjects
+from structuredobjects import FOVEA_RANGE, StructuredObjectsWorld, get_sensor_table, read_sensor_tables, \
+    stack_sensor_tables
+
+PACKAGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+WORLD_PATH = os.path.join(PACKAGE_PATH, "worlds", "6df3bffaf95f11e38a330023dfa615aa.json")
+POSITIONS = range(-FOVEA_RANGE, FOVEA_RANGE + 1)
+
+
+def _load_world():
+    with open(WORLD_PATH) as file:
+        return json.load(file)
+
+
+def _random_shape_grid(rng):
+    colors = ["green", "brown", "red", "navy", "white", "charcoal", "purple"]
+    types = ["com", "ver", "cir"]
+    return [[{"color": rng.choice(colors), "type": rng.choice(types)} if rng.random() < 0.4 else None
+             for x in POSITIONS] for y in POSITIONS]
+
+
+def _inspect_grid(shape_grid, x, y, datasource):
+    # the datasource values found by looking at the grid, as the adapter did before the sensor tables
+    cell = shape_grid[y + FOVEA_RANGE][x + FOVEA_RANGE]
+    if datasource.startswith("fovea-"):
+        return 1.0 if cell is not None and datasource[len("fovea-"):] in (cell["color"], cell["type"]) else 0.0
+    if datasource.startswith("presence-"):
+        return 1.0 if any(cell is not None and datasource[len("presence-"):] in (cell["color"], cell["type"])
+                          for row in shape_grid for cell in row) else 0.0
+    return {"fov-x": float(x), "fov-y": float(y)}.get(datasource, 0.0)
+
+
+def _show(world, shape_grid, x, y):
+    world.show_scene({"shape_grid": shape_grid, "fovea_x": x, "fovea_y": y})
+    return dict(world.datasources)
+
+
+def test_sensor_tables_agree_with_grid_inspection():
+    world_data = _load_world()
+    world = StructuredObjectsWorld(world_data)
+    rng = random.Random(0)
+    shape_grids = [world.shape_grid] + [_random_shape_grid(rng) for i in range(20)]
+    for shape_grid in shape_grids:
+        for y in POSITIONS:
+            for x in POSITIONS:
+                datasources = _show(world, shape_grid, x, y)
+                assert datasources.pop("major-newscene") == 1.0
+                assert datasources == {key: _inspect_grid(shape_grid, x, y, key) for key in datasources}
+
+
+def test_fovea_moves_read_the_table_at_the_new_position():
+    world = StructuredObjectsWorld(_load_world())
+    world.datatargets.update({"fov_x": 1, "fov_y": -5})
+    world.update()
+    assert (world.fovea_x, world.fovea_y) == (1, -FOVEA_RANGE)
+    assert world.datasources["major-newscene"] == 0.0
+    assert {key: value for key, value in world.datasources.items() if key != "major-newscene"} == \
+        {key: _inspect_grid(world.shape_grid, 1, -FOVEA_RANGE, key) for key in world.datasources
+         if key != "major-newscene"}
+    world.datatargets.update({"fov_reset": 1, "fov_x": 0, "fov_y": 0})
+    world.update()
+    assert (world.datasources["fov-x"], world.datasources["fov-y"]) == (0.0, 0.0)
+
+
+def test_batched_reads_agree_with_single_reads():
+    pytest.importorskip("numpy")
+    world = StructuredObjectsWorld(_load_world())
+    rng = random.Random(1)
+    shape_grids = [_random_shape_grid(rng) for i in range(5)]
+    datasources = sorted(world.datasources)
+    tables = stack_sensor_tables(shape_grids, datasources)
+    agents = [(rng.randrange(len(shape_grids)), rng.choice(POSITIONS), rng.choice(POSITIONS)) for i in range(30)]
+    values = read_sensor_tables(tables, *zip(*agents))
+    assert values.shape == (len(agents), len(datasources))
+    for (index, x, y), row in zip(agents, values.tolist()):
+        assert row == [_inspect_grid(shape_grids[index], x, y, key) for key in datasources]
+
+
+def test_sensor_table_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(structuredobjects, "SENSOR_TABLE_CACHE_SIZE", 3)
+    monkeypatch.setattr(structuredobjects, "_sensor_tables", structuredobjects.OrderedDict())
+    rng = random.Random(2)
+    shape_grids = [_random_shape_grid(rng) for i in range(5)]
+    first = get_sensor_table(shape_grids[0], ["fovea-green"])
+    assert get_sensor_table(shape_grids[0], ["fovea-green"]) is first
+    for shape_grid in shape_grids[1:]:
+        get_sensor_table(shape_grid, ["fovea-green"])
+    assert len(structuredobjects._sensor_tables) == 3
+    assert get_sensor_table(shape_grids[0], ["fovea-green"]) is not first